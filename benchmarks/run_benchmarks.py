@@ -0,0 +1,348 @@
+import argparse
+import datetime
+import importlib
+import json
+import logging
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import time
+import numpy as np
+import pandas as pd
+from benchmarks.synthetic import make_inputs
+from tools.network_io import read_network, write_network
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the largest network each entry point is run on unless --no_limits is given (flow_scaling and gauge_scaling
+# delineate a catchment per segment)
+SIZE_LIMITS = {'flow_scaling': 2000, 'gauge_scaling': 2000}
+
+# benchmark cases that run an entry point in another way, and the modules they need beyond the requirements
+EXTRA_CASES = {'network_attributes_partitioned': 'network_attributes'}
+CASE_MODULES = {'network_attributes_partitioned': ('dask', 'dask_geopandas', 'pyarrow')}
+
+
+def console_scripts(setup_file: str = os.path.join(REPO, 'setup.py')):
+    """
+    Reads the console_scripts entry points from setup.py
+    :param setup_file: path to setup.py
+    :return: dict of script name to (module, function)
+    """
+
+    with open(setup_file) as f:
+        text = f.read()
+
+    return {name: (module, func) for name, module, func in
+            re.findall(r"['\"](\w+)\s*=\s*([\w.]+):(\w+)['\"]", text)}
+
+
+def missing_module(case: str):
+    """
+    :param case: a benchmark case name
+    :return: the first module the case needs that can't be imported, or None
+    """
+
+    for module in CASE_MODULES.get(case, ()):
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            return module
+
+    return None
+
+
+def network_copy(network: str, work_dir: str):
+    """
+    Copies a network layer (with any sidecar files) into a working directory so a tool can modify it
+    :param network: path to the network
+    :param work_dir: directory to copy the network to
+    :return: path to the copy
+    """
+
+    base = os.path.splitext(os.path.basename(network))[0]
+    src_dir = os.path.dirname(network)
+    for name in os.listdir(src_dir):
+        if os.path.splitext(name)[0] == base:
+            shutil.copy(os.path.join(src_dir, name), work_dir)
+
+    return os.path.join(work_dir, os.path.basename(network))
+
+
+def script_args(script: str, inputs: dict, work_dir: str):
+    """
+    Command line arguments to run an entry point on the synthetic inputs
+    :param script: the console script name
+    :param inputs: the inputs from make_inputs
+    :param work_dir: a directory for the tool's outputs
+    :return: list of arguments, or None if the script has no benchmark case
+    """
+
+    net = network_copy(inputs['network'], work_dir)
+    epsg = str(inputs['epsg'])
+    search_dist = str(inputs['search_dist'])
+
+    if script == 'segment_network':
+        return [net, str(inputs['seg_length']), os.path.join(work_dir, 'segmented' + os.path.splitext(net)[1])]
+    if script == 'sinuosity':
+        return [net, epsg]
+    if script == 'slope':
+        return [net, inputs['dem'], epsg, search_dist]
+    if script == 'drainage_area':
+        return [net, inputs['drainage_area'], epsg, search_dist]
+    if script == 'network_topology':
+        return [net, str(inputs['first_feature']), inputs['dem']]
+    if script == 'flow_scaling':
+        return [net, str(inputs['meas_id']), inputs['dem'], inputs['precip']]
+    if script == 'gauge_scaling':
+        # gauges at the outlet and on the upstream halves of the two links that meet above it, clear of the confluence
+        gauges = os.path.join(work_dir, 'gauges.csv')
+        pd.DataFrame({'reach_id': [1, 2, 4], 'gauge_id': ['g1', 'g2', 'g4']}).to_csv(gauges, index=False)
+        return [net, gauges, inputs['dem'], inputs['precip']]
+    if script == 'raster_index':
+        # index a copy, so the index isn't left beside the shared inputs for the other cases to use
+        dem = os.path.join(work_dir, os.path.basename(inputs['dem']))
+        shutil.copy(inputs['dem'], dem)
+        return [dem]
+    if script == 'upstream_accumulation':
+        # every segment is drawn downstream, so the copy is labelled with that rather than running network_topology
+        dn = read_network(net)
+        dn['topo_flip'] = 0
+        write_network(dn, net)
+        return [net, '--sum', 'ds_link']
+    if script in ('network_attributes', 'network_attributes_partitioned'):
+        args = ['run', net, net, '--stages', 'sinuosity', 'slope', 'drainage_area', 'network_topology',
+                '--dem', inputs['dem'], '--search_dist', search_dist, '--drainage_area', inputs['drainage_area'],
+                '--da_search_dist', search_dist, '--first_feature', str(inputs['first_feature'])]
+        if script == 'network_attributes_partitioned':
+            # partitioned runs write a GeoParquet dataset directory beside the copy rather than replacing it
+            args[2] = partitioned_output(work_dir)
+            args += ['--partition_size', str(max(inputs['n_segments'] // 4, 1)), '--workers', '2']
+        return args
+
+    return None
+
+
+def partitioned_output(work_dir: str):
+    """
+    :param work_dir: the working directory of a network_attributes_partitioned case
+    :return: path to the GeoParquet dataset the case writes
+    """
+
+    return os.path.join(work_dir, 'partitioned.parquet')
+
+
+def run_script(script: str, module: str, func: str, args: list, log_file: str):
+    """
+    Runs an entry point in a child process and measures it
+    :param script: the console script name
+    :param module: the entry point module
+    :param func: the entry point function
+    :param args: command line arguments
+    :param log_file: path to write the process output to
+    :return: dict of wall_s, cpu_s, peak_rss_mb (None where the platform can't report it) and returncode
+    """
+
+    cmd = [sys.executable, '-c', f'import sys; from {module} import {func}; sys.argv[0] = "{script}"; {func}()'] + args
+    with open(log_file, 'w') as log:
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, cwd=REPO, stdout=log, stderr=subprocess.STDOUT)
+        if hasattr(os, 'wait4'):
+            _, status, usage = os.wait4(proc.pid, 0)
+            wall = time.perf_counter() - start
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            # ru_maxrss is in kB on linux and bytes on macOS
+            scale = 2**20 if sys.platform == 'darwin' else 2**10
+            cpu, peak = usage.ru_utime + usage.ru_stime, usage.ru_maxrss / scale
+        else:
+            proc.wait()
+            wall = time.perf_counter() - start
+            cpu, peak = None, None
+
+    return {'wall_s': wall, 'cpu_s': cpu, 'peak_rss_mb': peak, 'returncode': proc.returncode}
+
+
+def check_topology(network: str):
+    """
+    Compares the topology found by network_topology with the known topology of a synthetic network
+    :param network: path to a synthetic network with the topology fields
+    :return: the fraction of segments whose downstream segment is the known one
+    """
+
+    dn = read_network(network)
+    rid = dict(zip(dn.index, dn['rid']))
+    expected = np.array([rid.get(ds) for ds in dn['ds_link']], dtype=float)
+    found = dn['rid_ds'].values.astype(float)
+    match = np.isclose(found, expected) | (np.isnan(found) & np.isnan(expected))
+
+    return float(match.mean())
+
+
+def run_benchmarks(sizes: list, data_dir: str, scripts: list = None, repeat: int = 1, net_format: str = 'shp',
+                   no_limits: bool = False, seed: int = 0, max_cells: int = 2048**2):
+    """
+    Times and memory-profiles every console script entry point on synthetic inputs of several sizes
+    :param sizes: list of network sizes (number of segments)
+    :param data_dir: directory for the generated inputs and tool outputs
+    :param scripts: optional list of entry point names to run (defaults to all of them)
+    :param repeat: the number of times to run each case; the fastest run is kept
+    :param net_format: the network file format (shp, parquet or fgb)
+    :param no_limits: run every entry point at every size, ignoring SIZE_LIMITS
+    :param seed: random seed for the synthetic inputs
+    :param max_cells: the maximum number of cells of the synthetic DEMs
+    :return: dict of run metadata and results
+    """
+
+    entry_points = console_scripts()
+    entry_points.update({case: entry_points[script] for case, script in EXTRA_CASES.items() if script in entry_points})
+    results = []
+    for size in sizes:
+        inputs = make_inputs(os.path.join(data_dir, f'inputs_{size}_{seed}'), size, seed, net_format, max_cells)
+        for script, (module, func) in sorted(entry_points.items()):
+            if scripts is not None and script not in scripts:
+                continue
+            if not no_limits and size > SIZE_LIMITS.get(script, size):
+                print(f'skipping {script} with {size} segments')
+                continue
+            module_missing = missing_module(script)
+            if module_missing is not None:
+                print(f'skipping {script}: {module_missing} can not be imported')
+                continue
+
+            best = None
+            for _ in range(repeat):
+                work_dir = os.path.join(data_dir, 'work', f'{script}_{size}')
+                if os.path.exists(work_dir):
+                    shutil.rmtree(work_dir)
+                os.makedirs(work_dir)
+                args = script_args(script, inputs, work_dir)
+                if args is None:
+                    break
+                res = run_script(script, module, func, args, os.path.join(work_dir, 'log.txt'))
+                if best is None or res['wall_s'] < best['wall_s']:
+                    best = res
+            if best is None:
+                print(f'no benchmark case for {script}')
+                continue
+
+            best.update({'script': script, 'size': size})
+            if script == 'network_attributes_partitioned' and best['returncode'] == 0:
+                best['topology_match'] = check_topology(partitioned_output(work_dir))
+            elif script in ('network_topology', 'network_attributes') and best['returncode'] == 0:
+                best['topology_match'] = check_topology(os.path.join(work_dir, os.path.basename(inputs['network'])))
+            results.append(best)
+            print(f"{script} {size}: {best['wall_s']:.2f} s, {best['peak_rss_mb'] or 0:.0f} MB"
+                  f"{'' if best['returncode'] == 0 else ' (failed)'}")
+
+    commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO, capture_output=True, text=True).stdout.strip()
+
+    return {
+        'meta': {
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'), 'commit': commit or None,
+            'python': platform.python_version(), 'platform': platform.platform(), 'format': net_format,
+            'seed': seed, 'max_cells': max_cells
+        },
+        'results': results
+    }
+
+
+def failures(results: dict):
+    """
+    Lists the cases that failed or didn't find the known topology of the synthetic network
+    :param results: results from run_benchmarks
+    :return: list of failure descriptions
+    """
+
+    failed = []
+    for r in results['results']:
+        case = f"{r['script']} ({r['size']} segments)"
+        if r['returncode'] != 0:
+            failed.append(f"{case} exited with code {r['returncode']}")
+        elif r.get('topology_match', 1.) < 1.:
+            failed.append(f"{case} topology match {r['topology_match']:.3f}")
+
+    return failed
+
+
+def compare(results: dict, baseline: dict, tolerance: float = 0.25, memory_tolerance: float = 0.25):
+    """
+    Flags cases that are slower, use more memory or fail where the baseline did not
+    :param results: results from run_benchmarks
+    :param baseline: stored results to compare against
+    :param tolerance: the allowed fractional increase in wall time
+    :param memory_tolerance: the allowed fractional increase in peak memory
+    :return: list of regression descriptions
+    """
+
+    base = {(r['script'], r['size']): r for r in baseline['results']}
+    regressions = []
+    for r in results['results']:
+        b = base.get((r['script'], r['size']))
+        if b is None:
+            continue
+        case = f"{r['script']} ({r['size']} segments)"
+        if r['returncode'] != 0 and b['returncode'] == 0:
+            regressions.append(f'{case} failed')
+            continue
+        if r['wall_s'] > b['wall_s'] * (1 + tolerance):
+            regressions.append(f"{case} time {b['wall_s']:.2f} s -> {r['wall_s']:.2f} s")
+        if r['peak_rss_mb'] and b['peak_rss_mb'] and r['peak_rss_mb'] > b['peak_rss_mb'] * (1 + memory_tolerance):
+            regressions.append(f"{case} memory {b['peak_rss_mb']:.0f} MB -> {r['peak_rss_mb']:.0f} MB")
+        if r.get('topology_match', 1.) < b.get('topology_match', 1.):
+            regressions.append(f"{case} topology match {b['topology_match']:.3f} -> {r['topology_match']:.3f}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', help='Network sizes (number of segments) to benchmark.', type=int, nargs='+',
+                        default=[1000, 10000])
+    parser.add_argument('--scripts', help='Only run these entry points (or benchmark cases).', type=str, nargs='+')
+    parser.add_argument('--data_dir', help='Directory for synthetic inputs and outputs.', type=str,
+                        default=os.path.join(REPO, 'benchmarks', 'data'))
+    parser.add_argument('--out', help='Path to save the results JSON.', type=str)
+    parser.add_argument('--baseline', help='Path to a results JSON to check for regressions against.', type=str)
+    parser.add_argument('--repeat', help='The number of runs of each case (the fastest is kept).', type=int,
+                        default=1)
+    parser.add_argument('--format', help='The network file format.', type=str, choices=['shp', 'parquet', 'fgb'],
+                        default='shp')
+    parser.add_argument('--tolerance', help='Allowed fractional increase in wall time.', type=float, default=0.25)
+    parser.add_argument('--memory_tolerance', help='Allowed fractional increase in peak memory.', type=float,
+                        default=0.25)
+    parser.add_argument('--no_limits', help='Run every entry point at every size.', action='store_true')
+    parser.add_argument('--seed', help='Random seed for the synthetic inputs.', type=int, default=0)
+    parser.add_argument('--max_cells', help='The maximum number of cells of the synthetic DEMs.', type=int,
+                        default=2048**2)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    results = run_benchmarks(args.sizes, args.data_dir, args.scripts, args.repeat, args.format, args.no_limits,
+                             args.seed, args.max_cells)
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    failed = failures(results)
+    for failure in failed:
+        print(f'FAILED: {failure}')
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, args.memory_tolerance)
+        for regression in regressions:
+            print(f'REGRESSION: {regression}')
+        if len(regressions) == 0:
+            print('no regressions')
+
+    if len(failed) > 0 or len(regressions) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+import argparse
+import json
+import logging
+import os
+import warnings
+import numpy as np
+import geopandas as gpd
+import rasterio
+from rasterio.transform import from_origin
+from scipy.ndimage import distance_transform_edt
+from shapely.errors import ShapelyDeprecationWarning
+from shapely.geometry import LineString
+from shapely.strtree import STRtree
+from tools.network_io import write_network
+
+log = logging.getLogger(__name__)
+
+# bump when the generated data changes so cached inputs are rebuilt
+VERSION = 2
+EPSG = 32612
+ORIGIN = (400000., 4500000.)
+
+
+def fractal_surface(shape, beta: float = 2.2, seed: int = 0):
+    """
+    Generates a fractal (1/f noise) surface by spectral synthesis
+    :param shape: (rows, cols) of the surface
+    :param beta: the spectral exponent; larger values give smoother surfaces
+    :param seed: random seed
+    :return: a float32 array scaled to [0, 1]
+    """
+
+    rng = np.random.default_rng(seed)
+    ky = np.fft.fftfreq(shape[0])[:, None]
+    kx = np.fft.rfftfreq(shape[1])[None, :]
+    k = np.sqrt(kx**2 + ky**2)
+    k[0, 0] = np.inf
+    coeff = k**(-beta / 2) * (rng.normal(size=k.shape) + 1j * rng.normal(size=k.shape))
+    surf = np.fft.irfft2(coeff, s=shape)
+    surf = (surf - surf.min()) / (surf.max() - surf.min())
+
+    return surf.astype(np.float32)
+
+
+def dendritic_network(n_segments: int, leaf_length: float = 150., seed: int = 0):
+    """
+    Generates a binary-branching stream network with a known topology that doesn't cross itself. Links are stored in
+    breadth-first (heap) order, so link 0 is the outlet and the downstream link of link k is (k - 1) // 2. Each link
+    is a three vertex line drawn from its upstream to its downstream end. The tree is laid out as an H-tree: every
+    link's subtree has a rectangle of its own, which is split in two at the link's upstream end, across the link, for
+    the subtrees of its two tributaries, so straight links can only meet at their ends. Links run north-south and
+    east-west at alternate levels.
+    :param n_segments: the number of links
+    :param leaf_length: the approximate length of the most upstream links
+    :param seed: random seed
+    :return: dict of arrays: up_x, up_y, mid_x, mid_y, down_x, down_y, length, parent, dist_down (flow distance from
+    the outlet to the downstream end of each link) and n_upstream (number of links upstream, including the link)
+    """
+
+    rng = np.random.default_rng(seed)
+    depth = int(np.floor(np.log2(n_segments)))
+    # the rectangles halve in each direction every two levels
+    size = leaf_length * 2 ** (int(np.ceil(depth / 2)) + 1)
+
+    k = np.arange(n_segments)
+    parent = (k - 1) // 2
+    # the rectangle (x_min, y_min, x_max, y_max) of each link's subtree and where its upstream end is in it
+    box = np.empty((n_segments, 4))
+    up = np.empty((n_segments, 2))
+    down = np.empty((n_segments, 2))
+    box[0] = (ORIGIN[0] - size / 2, ORIGIN[1], ORIGIN[0] + size / 2, ORIGIN[1] + size)
+    down[0] = ORIGIN
+    up[0] = (ORIGIN[0], ORIGIN[1] + size * rng.uniform(0.45, 0.55))
+
+    for level in range(1, depth + 1):
+        idx = np.arange(2**level - 1, min(2**(level + 1) - 1, n_segments))
+        par = parent[idx]
+        first = idx % 2 == 1
+        frac = rng.uniform(0.45, 0.55, len(idx))
+        down[idx] = up[par]
+        box[idx] = box[par]
+        if level % 2 == 1:
+            # the parent runs north-south, so its rectangle is split into west and east halves
+            box[idx, 2] = np.where(first, up[par, 0], box[par, 2])
+            box[idx, 0] = np.where(first, box[par, 0], up[par, 0])
+            up[idx, 0] = box[idx, 0] + frac * (box[idx, 2] - box[idx, 0])
+            up[idx, 1] = up[par, 1]
+        else:
+            box[idx, 3] = np.where(first, up[par, 1], box[par, 3])
+            box[idx, 1] = np.where(first, box[par, 1], up[par, 1])
+            up[idx, 0] = up[par, 0]
+            up[idx, 1] = box[idx, 1] + frac * (box[idx, 3] - box[idx, 1])
+
+    length = np.hypot(*(up - down).T)
+    dist_down = np.zeros(n_segments)
+    for kk in range(1, n_segments):
+        dist_down[kk] = dist_down[parent[kk]] + length[parent[kk]]
+
+    # bend each link at its middle so sinuosity is not always 1, keeping straight any link whose bend would cross
+    # another link. Bends are no deeper than those of the upstream links, so long links don't reach into the
+    # rectangles beside them
+    along = (up - down) / length[:, None]
+    offset = rng.uniform(-0.15, 0.15, n_segments) * np.minimum(length, leaf_length)
+    mid = (up + down) / 2 + offset[:, None] * np.column_stack([-along[:, 1], along[:, 0]])
+    straight = (up + down) / 2
+    bent = np.ones(n_segments, dtype=bool)
+    while True:
+        lines = [LineString([u, m, d]) for u, m, d in zip(up, np.where(bent[:, None], mid, straight), down)]
+        # Shapely 1.8 warns on every STRtree that the class changes in 2.0; without items it stores the position of
+        # each line, which query_items returns
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', ShapelyDeprecationWarning)
+            tree = STRtree(lines)
+        crossing = set()
+        for a in np.flatnonzero(bent):
+            for b in tree.query_items(lines[a]):
+                if b != a and lines[a].intersects(lines[b]):
+                    shared = {tuple(up[a]), tuple(down[a])} & {tuple(up[b]), tuple(down[b])}
+                    hit = lines[a].intersection(lines[b])
+                    if not (hit.geom_type == 'Point' and (hit.x, hit.y) in shared):
+                        crossing.update(c for c in (a, b) if bent[c])
+        if len(crossing) == 0:
+            break
+        bent[list(crossing)] = False
+    mid = np.where(bent[:, None], mid, straight)
+
+    n_upstream = np.ones(n_segments, dtype=np.int64)
+    for kk in range(n_segments - 1, 0, -1):
+        n_upstream[parent[kk]] += n_upstream[kk]
+
+    return {
+        'up_x': up[:, 0], 'up_y': up[:, 1], 'mid_x': mid[:, 0], 'mid_y': mid[:, 1],
+        'down_x': down[:, 0], 'down_y': down[:, 1], 'length': length, 'parent': parent,
+        'dist_down': dist_down, 'n_upstream': n_upstream
+    }
+
+
+def densify(net: dict, spacing: float):
+    """
+    Points along every link of a network
+    :param net: a network from dendritic_network
+    :param spacing: the approximate distance between points
+    :return: arrays x, y, flow distance from the outlet and link index of every point
+    """
+
+    xs, ys, dists, links = [], [], [], []
+    n = len(net['length'])
+    # the upstream half then the downstream half of each link
+    for (ax, ay), (bx, by) in ((('up_x', 'up_y'), ('mid_x', 'mid_y')), (('mid_x', 'mid_y'), ('down_x', 'down_y'))):
+        x0, y0, x1, y1 = net[ax], net[ay], net[bx], net[by]
+        piece = np.hypot(x1 - x0, y1 - y0)
+        counts = np.ceil(piece / spacing).astype(np.int64) + 1
+        link = np.repeat(np.arange(n), counts)
+        start = np.repeat(np.cumsum(counts) - counts, counts)
+        t = (np.arange(counts.sum()) - start) / np.repeat(counts - 1, counts)
+        xs.append(x0[link] + t * (x1 - x0)[link])
+        ys.append(y0[link] + t * (y1 - y0)[link])
+        # flow distance falls linearly from the upstream to the downstream end of the link
+        frac = t / 2 if ax == 'up_x' else 0.5 + t / 2
+        dists.append(net['dist_down'][link] + net['length'][link] * (1 - frac))
+        links.append(link)
+
+    return np.concatenate(xs), np.concatenate(ys), np.concatenate(dists), np.concatenate(links)
+
+
+def make_rasters(net: dict, out_dir: str, max_cells: int = 2048**2, channel_gradient: float = 0.01,
+                 hill_gradient: float = 0.15, relief: float = 20., seed: int = 0):
+    """
+    Builds a DEM with the network carved into it, a drainage area raster and a precipitation gradient raster
+    :param net: a network from dendritic_network
+    :param out_dir: directory to write dem.tif, drainage_area.tif and precip.tif to
+    :param max_cells: the maximum number of DEM cells; the resolution is coarsened to stay within it
+    :param channel_gradient: the slope of the channels
+    :param hill_gradient: the slope of the hillslopes away from the channels
+    :param relief: the amplitude of the fractal roughness added to the hillslopes
+    :param seed: random seed
+    :return: the DEM resolution
+    """
+
+    xs = np.concatenate([net['up_x'], net['mid_x'], net['down_x']])
+    ys = np.concatenate([net['up_y'], net['mid_y'], net['down_y']])
+    res = max(10., float(np.sqrt((xs.max() - xs.min()) * (ys.max() - ys.min()) / max_cells)))
+    margin = 10 * res + 0.05 * max(xs.max() - xs.min(), ys.max() - ys.min())
+    left, top = xs.min() - margin, ys.max() + margin
+    # the outlet sits on the bottom edge of the DEM
+    bottom = ORIGIN[1] - res / 2
+    height = int(np.ceil((top - bottom) / res))
+    width = int(np.ceil((xs.max() + margin - left) / res))
+    transform = from_origin(left, top, res, res)
+
+    # burn the channels in so each cell takes the lowest channel elevation that crosses it
+    px, py, pdist, plink = densify(net, res / 2)
+    cols, rows = ~transform * (px, py)
+    rows, cols = rows.astype(np.int64), cols.astype(np.int64)
+    keep = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    order = np.argsort(-pdist[keep], kind='stable')
+    flat = (rows[keep] * width + cols[keep])[order]
+    channel = np.full(height * width, np.nan)
+    channel_link = np.full(height * width, -1, dtype=np.int64)
+    channel[flat] = channel_gradient * pdist[keep][order]
+    channel_link[flat] = plink[keep][order]
+    channel = channel.reshape(height, width)
+
+    # hillslopes rise away from the nearest channel cell with fractal roughness
+    dist, (near_r, near_c) = distance_transform_edt(np.isnan(channel), sampling=res, return_indices=True)
+    rough = fractal_surface((height, width), seed=seed)
+    dem = channel[near_r, near_c] + hill_gradient * dist + relief * rough * (1 - np.exp(-dist / (5 * res)))
+
+    # drainage area (km2) of the nearest channel, assuming each link drains an equal share of the DEM
+    link_area = height * width * res**2 / 1e6 / len(net['length'])
+    da = net['n_upstream'][channel_link.reshape(height, width)[near_r, near_c]] * link_area
+
+    profile = {
+        'driver': 'GTiff', 'height': height, 'width': width, 'count': 1, 'dtype': 'float32', 'crs': f'EPSG:{EPSG}',
+        'transform': transform, 'nodata': -9999., 'tiled': True, 'blockxsize': 256, 'blockysize': 256
+    }
+    with rasterio.open(os.path.join(out_dir, 'dem.tif'), 'w', **profile) as dst:
+        dst.write(dem.astype(np.float32), 1)
+    with rasterio.open(os.path.join(out_dir, 'drainage_area.tif'), 'w', **profile) as dst:
+        dst.write(da.astype(np.float32), 1)
+
+    # precipitation increases to the north on a coarser grid than the DEM
+    p_height, p_width = int(np.ceil(height / 4)), int(np.ceil(width / 4))
+    gradient = np.linspace(1000., 300., p_height, dtype=np.float32)[:, None]
+    precip = gradient + 50. * fractal_surface((p_height, p_width), seed=seed + 1)
+    profile.update(height=p_height, width=p_width, transform=from_origin(left, top, res * 4, res * 4),
+                   blockxsize=128, blockysize=128)
+    with rasterio.open(os.path.join(out_dir, 'precip.tif'), 'w', **profile) as dst:
+        dst.write(precip.astype(np.float32), 1)
+
+    return res
+
+
+def make_inputs(out_dir: str, n_segments: int, seed: int = 0, net_format: str = 'shp', max_cells: int = 2048**2):
+    """
+    Generates (or reuses previously generated) reproducible benchmark inputs
+    :param out_dir: directory to write the inputs to
+    :param n_segments: the number of network segments
+    :param seed: random seed
+    :param net_format: the network file extension (shp, parquet or fgb)
+    :param max_cells: the maximum number of DEM cells
+    :return: dict of input paths and tool parameters
+    """
+
+    info_path = os.path.join(out_dir, 'inputs.json')
+    if os.path.exists(info_path):
+        with open(info_path) as f:
+            info = json.load(f)
+        if info['version'] == VERSION and info['n_segments'] == n_segments and info['seed'] == seed and \
+                info['network'].endswith(net_format) and info['max_cells'] == max_cells:
+            return info
+
+    os.makedirs(out_dir, exist_ok=True)
+    log.info(f'generating inputs with {n_segments} segments')
+    net = dendritic_network(max(n_segments // 2, 1), seed=seed)
+    res = make_rasters(net, out_dir, max_cells=max_cells, seed=seed)
+    if res > 10.:
+        # the upstream links are about 15 cells long at 10 m, and end points are sampled within 4 cells
+        log.warning(f'the DEM is coarsened to {res:.1f} m cells to stay within {max_cells} cells, so '
+                    'network_topology may not resolve the network; raise max_cells')
+
+    # every link is split at its bend into two segments, as in a segmented network: the topology walk looks upstream
+    # of the last segment of a chain for segments drawn against the flow, so a single segment joining two confluences
+    # would have its other tributary walked backwards. Link k is segments 2k (upstream half) and 2k + 1
+    geoms = []
+    for ux, uy, mx, my, dx, dy in zip(net['up_x'], net['up_y'], net['mid_x'], net['mid_y'], net['down_x'],
+                                      net['down_y']):
+        geoms += [LineString([(ux, uy), (mx, my)]), LineString([(mx, my), (dx, dy)])]
+    links = np.arange(len(net['parent']))
+    ds_link = np.column_stack([2 * links + 1, np.where(net['parent'] >= 0, 2 * net['parent'], -1)]).ravel()
+    network = os.path.join(out_dir, f'network.{net_format}')
+    dn = gpd.GeoDataFrame({'ds_link': ds_link}, geometry=geoms, crs=f'epsg:{EPSG}')
+    write_network(dn, network)
+
+    # the head of the longest flow path is the upstream-most feature, and the lower half of link 0 is the outlet
+    first_feature = 2 * int(np.argmax(net['dist_down'] + net['length']))
+    info = {
+        'version': VERSION, 'n_segments': n_segments, 'seed': seed, 'max_cells': max_cells, 'epsg': EPSG,
+        'resolution': res, 'network': network, 'dem': os.path.join(out_dir, 'dem.tif'),
+        'drainage_area': os.path.join(out_dir, 'drainage_area.tif'), 'precip': os.path.join(out_dir, 'precip.tif'),
+        'first_feature': first_feature, 'meas_id': 1, 'search_dist': 2 * res,
+        'seg_length': max(int(np.median(net['length']) / 4), 1)
+    }
+    with open(info_path, 'w') as f:
+        json.dump(info, f, indent=2)
+
+    return info
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('out_dir', help='Directory to write the synthetic inputs to.', type=str)
+    parser.add_argument('n_segments', help='The number of network segments.', type=int)
+    parser.add_argument('--seed', help='Random seed.', type=int, default=0)
+    parser.add_argument('--format', help='The network file format.', type=str, choices=['shp', 'parquet', 'fgb'],
+                        default='shp')
+    parser.add_argument('--max_cells', help='The maximum number of DEM cells.', type=int, default=2048**2)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    make_inputs(args.out_dir, args.n_segments, args.seed, args.format, args.max_cells)
+
+
+if __name__ == '__main__':
+    main()
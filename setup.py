@@ -3,8 +3,8 @@ import re
 
 # https://packaging.python.org/discussions/install-requires-vs-requirements/
 install_requires = [
-    'numpy>=1.23', 'GDAL>3.0', 'geopandas>=0.12', 'Shapely==1.8.5.post1', 'rasterstats==0.17.0', 'rasterio==1.3.4',
-    'pysheds==0.3.3'
+    'numpy>=1.23', 'GDAL>3.0', 'geopandas>=0.12', 'Shapely==1.8.5.post1', 'rasterio==1.3.4',
+    'pysheds==0.3.3', 'numba', 'scipy'
 ]
 
 with open("README.md", "rb") as f:
@@ -28,15 +28,21 @@ setup(
     python_requires='>3.8',
     long_description=long_descr,
     install_requires=install_requires,
+    extras_require={'parquet': ['pyarrow>=8'], 'profile': ['pyinstrument'],
+                    'dask': ['dask[dataframe]', 'dask-geopandas', 'pygeos', 'pyarrow>=8']},
     zip_safe=False,
     entry_points={
           "console_scripts": [
               'drainage_area = tools.drainage_area:main',
               'flow_scaling = tools.flow_scaling:main',
+              'gauge_scaling = tools.gauge_scaling:main',
+              'network_attributes = tools.pipeline:main',
               'network_topology = tools.network_topology:main',
+              'raster_index = tools.raster_index:main',
               'segment_network = tools.segment_network:main',
               'sinuosity = tools.sinuosity:main',
-              'slope = tools.slope:main'
+              'slope = tools.slope:main',
+              'upstream_accumulation = tools.upstream_accumulation:main'
           ]
       }
 )
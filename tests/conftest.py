@@ -0,0 +1,11 @@
+import pytest
+from benchmarks.synthetic import make_inputs
+
+
+@pytest.fixture(scope='session')
+def synthetic(tmp_path_factory):
+    """
+    Synthetic network, DEM and precipitation inputs (see benchmarks/synthetic.py), shared by the tests of a session
+    """
+
+    return make_inputs(str(tmp_path_factory.mktemp('synthetic')), 80, seed=3, max_cells=512**2)
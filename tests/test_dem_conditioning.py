@@ -0,0 +1,60 @@
+import logging
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+from pysheds.grid import Grid
+from tools.dem_conditioning import read_dem, condition_dem, condition_dem_tiled
+
+SIZE = 96
+TILE = 32
+
+
+def bowl_dem(path, radius: float):
+    """
+    Writes a tilted plane with a bowl-shaped depression of the given radius (in cells) centred on a tile corner
+    """
+
+    rng = np.random.default_rng(0)
+    rows, cols = np.mgrid[:SIZE, :SIZE]
+    elev = 100. + 0.5 * rows + 0.2 * cols + rng.uniform(0., 0.05, (SIZE, SIZE))
+    dist = np.hypot(rows - SIZE / 2, cols - SIZE / 2)
+    elev -= np.where(dist < radius, 0.75 * (radius - dist), 0.)
+    with rasterio.open(path, 'w', driver='GTiff', height=SIZE, width=SIZE, count=1, dtype='float64',
+                       crs='EPSG:32612', transform=from_origin(500000., 4500000., 10., 10.), nodata=-9999.) as dst:
+        dst.write(elev, 1)
+
+    return str(path)
+
+
+def untiled_fdir(dem):
+    raster = read_dem(dem)
+    return np.asarray(condition_dem(Grid(viewfinder=raster.viewfinder), raster))
+
+
+@pytest.mark.parametrize('radius, overlap', [(4, 16), (30, 40)])
+def test_tiled_matches_untiled_within_overlap(tmp_path, radius, overlap):
+    dem = bowl_dem(tmp_path / 'dem.tif', radius)
+
+    fdir, _ = condition_dem_tiled(dem, TILE, overlap, workers=2)
+
+    assert np.array_equal(np.asarray(fdir), untiled_fdir(dem))
+
+
+def test_narrow_depression_does_not_warn(tmp_path, caplog):
+    dem = bowl_dem(tmp_path / 'dem.tif', 4)
+
+    with caplog.at_level(logging.WARNING, logger='tools.dem_conditioning'):
+        condition_dem_tiled(dem, TILE, 16, workers=2)
+
+    assert not [r for r in caplog.records if r.levelno >= logging.WARNING]
+
+
+def test_depression_wider_than_overlap_warns(tmp_path, caplog):
+    dem = bowl_dem(tmp_path / 'dem.tif', 30)
+
+    with caplog.at_level(logging.WARNING, logger='tools.dem_conditioning'):
+        fdir, _ = condition_dem_tiled(dem, TILE, 16, workers=2)
+
+    assert not np.array_equal(np.asarray(fdir), untiled_fdir(dem))
+    assert any('tile overlap' in r.getMessage() for r in caplog.records if r.levelno == logging.WARNING)
@@ -0,0 +1,81 @@
+import numpy as np
+import rasterio
+from rasterio.features import shapes
+from rasterio.mask import mask
+from tools.flow_scaling import calc_flow_scale, contributing_grids, reach_precip, segment_midpoint
+from tools.network_io import read_network
+from tools.warping import network_bounds
+
+# summing float32 precipitation in a different order
+RTOL = 1e-6
+
+
+def polygon_mask_precip(catch, transform, precip_raster):
+    """
+    The catchment precipitation as the tool computed it before catchments were summed on the DEM grid: the catchment
+    mask is polygonised and every precipitation pixel whose centre falls inside it counts in full
+    """
+
+    arr = catch.astype(np.int16)
+    shps = [s for s, v in shapes(arr, mask=arr == 1, transform=transform)]
+    with rasterio.open(precip_raster) as src:
+        out, _ = mask(src, shps, crop=True)
+        vals = out[out != src.nodata]
+        return float((vals / (src.res[0] * src.res[1])).sum())
+
+
+def boundary_precip(catch, transform, precip_raster):
+    """
+    The precipitation / pixel area over the precipitation pixels a catchment covers only in part. On a precipitation
+    grid aligned with the DEM, pixels covered in full count the same with both methods, and a pixel covered in part
+    counts its covered fraction on the DEM grid against all or nothing with the polygon mask, so the two catchment
+    sums differ by no more than this
+    """
+
+    with rasterio.open(precip_raster) as src:
+        values = src.read(1, masked=True).filled(0.)
+        area = src.res[0] * src.res[1]
+        per_pixel = int(round(area / abs(transform.a * transform.e)))
+        rows, cols = np.nonzero(catch)
+        xs, ys = rasterio.transform.xy(transform, rows, cols)
+        prow, pcol = rasterio.transform.rowcol(src.transform, xs, ys)
+    pixels, covered = np.unique(np.stack([prow, pcol]), axis=1, return_counts=True)
+    partial = pixels[:, covered < per_pixel]
+
+    return float((values[partial[0], partial[1]] / area).sum())
+
+
+def test_catchment_precip_matches_polygon_mask(synthetic):
+    dn = read_network(synthetic['network'])
+    points = [segment_midpoint(geom) for geom in dn.geometry]
+
+    with contributing_grids(dn.crs, synthetic['dem'], False, points, network_bounds(dn.geometry)) as \
+            (dem, grid, fdir, acc, shared, snapped):
+        new = reach_precip(grid, fdir, dem, synthetic['precip'], dn.crs, False, 'catchment', snapped)
+        old, bound = np.empty(len(snapped)), np.empty(len(snapped))
+        for j, (x, y) in enumerate(snapped):
+            catch = np.asarray(grid.catchment(x=x, y=y, fdir=fdir, xytype='coordinate'), dtype=bool)
+            old[j] = polygon_mask_precip(catch, grid.affine, synthetic['precip'])
+            bound[j] = boundary_precip(catch, grid.affine, synthetic['precip'])
+
+    assert np.all(np.abs(new - old) <= bound + RTOL * old)
+
+    # the flow scale is a ratio of two catchment sums, so the old ratio lies within the bounds of both
+    meas = synthetic['meas_id']
+    out = calc_flow_scale(dn.copy(), meas, synthetic['dem'], synthetic['precip'])
+    assert np.allclose(out['flow_scale'].values, new / new[meas], rtol=RTOL)
+    low = (new - bound) / (new[meas] + bound[meas])
+    high = (new + bound) / (new[meas] - bound[meas])
+    ratio = old / old[meas]
+    assert np.all((ratio >= low * (1 - RTOL)) & (ratio <= high * (1 + RTOL)))
+
+
+def test_accumulation_matches_catchment_method(synthetic):
+    dn = read_network(synthetic['network'])
+
+    catchment = calc_flow_scale(dn.copy(), synthetic['meas_id'], synthetic['dem'], synthetic['precip'])
+    accumulation = calc_flow_scale(dn.copy(), synthetic['meas_id'], synthetic['dem'], synthetic['precip'],
+                                   method='accumulation')
+
+    # both sum the same resampled precipitation over the same cells, scaled by a constant the ratio cancels
+    assert np.allclose(accumulation['flow_scale'].values, catchment['flow_scale'].values, rtol=RTOL)
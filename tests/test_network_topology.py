@@ -0,0 +1,16 @@
+import numpy as np
+from tools.network_io import read_network
+from tools.network_topology import calc_topology
+
+
+def test_topology_matches_synthetic_network(synthetic):
+    dn = read_network(synthetic['network'])
+
+    out = calc_topology(dn, synthetic['first_feature'], synthetic['dem'])
+
+    # ds_link is the known downstream segment of every segment (-1 at the outlet)
+    rid = dict(zip(out.index, out['rid']))
+    expected = np.array([rid.get(ds, np.nan) for ds in out['ds_link']], dtype=float)
+    assert np.array_equal(out['rid_ds'].values.astype(float), expected, equal_nan=True)
+    # the synthetic segments are all drawn downstream
+    assert not out['topo_flip'].any()
@@ -0,0 +1,59 @@
+import numpy as np
+from shapely.geometry import LineString, MultiPoint, Point
+from shapely.ops import split
+from tools.network_io import read_network
+from tools.segment_network import segment_lines
+
+
+def dense_network(synthetic, spacing: float, seed: int = 0):
+    """
+    The synthetic network with vertices every spacing along its lines, moved off the line by up to a tenth of the
+    spacing, and a few repeated (zero length pairs)
+    """
+
+    rng = np.random.default_rng(seed)
+    dn = read_network(synthetic['network'])
+    geoms = []
+    for geom in dn.geometry:
+        pts = np.array([geom.interpolate(d).coords[0] for d in np.arange(0., geom.length, spacing)] + [geom.coords[-1]])
+        pts[1:-1] += rng.uniform(-0.1, 0.1, (len(pts) - 2, 2)) * spacing
+        if len(pts) > 4 and rng.random() < 0.2:
+            pts = np.insert(pts, 2, pts[2], axis=0)
+        geoms.append(LineString(pts))
+
+    return dn.set_geometry(geoms)
+
+
+def split_lines(dn, seg_length: float):
+    """
+    The segments the tool produced by splitting one line at a time with shapely.ops.split
+    """
+
+    out = []
+    for feature in dn.geometry:
+        if feature.length <= seg_length:
+            out.append(feature)
+            continue
+        xs, ys = feature.coords.xy
+        dist = 0
+        pts = []
+        for x in range(len(xs) - 1):
+            dist += LineString([(xs[x], ys[x]), (xs[x + 1], ys[x + 1])]).length
+            if dist >= seg_length:
+                pts.append([xs[x], ys[x]])
+                dist = 0
+        out += list(split(feature, MultiPoint(pts) if len(pts) > 1 else Point(pts[0])).geoms)
+
+    return out
+
+
+def test_segments_match_line_by_line_split(synthetic):
+    dn = dense_network(synthetic, synthetic['resolution'] / 3)
+
+    out = segment_lines(dn, synthetic['seg_length'])
+    expected = split_lines(dn, synthetic['seg_length'])
+
+    assert len(out) == len(expected)
+    assert all(a.equals_exact(b, 0.) for a, b in zip(out.geometry, expected))
+    assert np.array_equal(out['length'].values, [g.length for g in expected])
+    assert np.allclose(out.groupby('parent_id')['length'].sum().values, dn.geometry.length.values)
@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+from shapely.geometry import Point
+from tools.network_io import read_network
+from tools.slope import calc_slope
+
+
+def test_endpoint_slope_matches_zonal_stats(synthetic):
+    zonal_stats = pytest.importorskip('rasterstats').zonal_stats
+    dn = read_network(synthetic['network'])
+    dist = synthetic['search_dist']
+
+    out = calc_slope(dn.copy(), synthetic['dem'], dist)
+
+    # the tool sampled the minimum elevation in a buffer around each end point with rasterstats
+    expected = []
+    for geom in dn.geometry:
+        elev1 = zonal_stats(Point(geom.coords[0]).buffer(dist), synthetic['dem'], stats='min')[0]['min']
+        elev2 = zonal_stats(Point(geom.coords[-1]).buffer(dist), synthetic['dem'], stats='min')[0]['min']
+        expected.append(abs(elev1 - elev2) / geom.length)
+    assert np.array_equal(out['Slope'].values, expected)
+
+
+def test_endpoint_slope_follows_channel_gradient(synthetic):
+    dn = read_network(synthetic['network'])
+
+    out = calc_slope(dn, synthetic['dem'], synthetic['search_dist'])
+
+    # the channels are carved into the synthetic DEM at a gradient of 0.01
+    assert np.median(out['Slope'].values) == pytest.approx(0.01, rel=0.05)
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import pyproj
+from affine import Affine
+from pysheds.sview import Raster, ViewFinder
+from tools.incremental import raster_fingerprint
+
+def cache_key(raster: str, **params):
+    """
+    Builds a cache key from the fingerprint of a raster (see tools.incremental.raster_fingerprint: the names, sizes
+    and modification times of its files, including the sources of a VRT) and the parameters used to process it
+    :param raster: path to the raster
+    :param params: processing parameters that change the outputs (e.g., dirmap)
+    :return: a hex string key
+    """
+
+    h = hashlib.sha256(raster_fingerprint(raster).encode())
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+
+    return h.hexdigest()
+
+
+def save_rasters(cache_dir: str, key: str, rasters: dict):
+    """
+    Writes pysheds Rasters to the cache as .npy arrays with their grid metadata
+    :param cache_dir: the cache directory
+    :param key: the cache key
+    :param rasters: dict of name to Raster
+    :return:
+    """
+
+    entry = os.path.join(cache_dir, key)
+    tmp = entry + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    meta = {}
+    for name, raster in rasters.items():
+        np.save(os.path.join(tmp, f'{name}.npy'), np.asarray(raster))
+        meta[name] = {
+            'affine': list(raster.affine)[:6],
+            'crs': raster.crs.srs,
+            'nodata': np.asarray(raster.nodata).item()
+        }
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    if os.path.exists(entry):
+        shutil.rmtree(entry)
+    os.rename(tmp, entry)
+
+
+def load_rasters(cache_dir: str, key: str, names):
+    """
+    Loads cached Rasters as read-only memory-mapped arrays and marks the entry as recently used
+    :param cache_dir: the cache directory
+    :param key: the cache key
+    :param names: the names of the rasters to load
+    :return: dict of name to Raster, or None if the entry (or any of the rasters) is not cached
+    """
+
+    entry = os.path.join(cache_dir, key)
+    meta_path = os.path.join(entry, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if any(name not in meta for name in names):
+        return None
+
+    rasters = {}
+    for name in names:
+        data = np.load(os.path.join(entry, f'{name}.npy'), mmap_mode='r')
+        viewfinder = ViewFinder(affine=Affine(*meta[name]['affine']), shape=data.shape,
+                                nodata=np.array(meta[name]['nodata'], dtype=data.dtype)[()],
+                                crs=pyproj.Proj(meta[name]['crs'], preserve_units=True))
+        rasters[name] = Raster(data, viewfinder=viewfinder)
+    os.utime(entry, None)
+
+    return rasters
+
+
+def evict_lru(cache_dir: str, max_bytes: int):
+    """
+    Removes the least recently used cache entries until the cache is no larger than max_bytes
+    :param cache_dir: the cache directory
+    :param max_bytes: the maximum total size of cached entries
+    :return: list of removed keys
+    """
+
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if not os.path.isdir(path) or name.endswith('.tmp'):
+            continue
+        size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+        entries.append((os.path.getmtime(path), size, name))
+
+    removed = []
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(os.path.join(cache_dir, name))
+        total -= size
+        removed.append(name)
+
+    return removed
@@ -0,0 +1,199 @@
+import logging
+import os
+import numpy as np
+import pyproj
+import rasterio
+from rasterio.windows import Window
+from pysheds.grid import Grid
+from pysheds.sview import Raster, ViewFinder
+from tools.telemetry import Progress
+from tools.workers import process_pool
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+DIRMAP = (64, 128, 1, 2, 4, 8, 16, 32)
+
+log = logging.getLogger(__name__)
+
+
+def read_dem(dem: str, window: Window = None):
+    """
+    Reads a DEM (or a window of it) into a pysheds Raster
+    :param dem: path to a DEM
+    :param window: an optional rasterio Window to read
+    :return: a pysheds Raster with the affine transform, crs and nodata value of the DEM (or window)
+    """
+
+    with rasterio.open(dem) as src:
+        data = src.read(1, window=window)
+        affine = src.transform if window is None else src.window_transform(window)
+        crs = pyproj.Proj(src.crs, preserve_units=True)
+        nodata = src.nodata if src.nodata is not None else 0
+    nodata = np.array(nodata, dtype=data.dtype).item()
+    viewfinder = ViewFinder(affine=affine, shape=data.shape, nodata=nodata, crs=crs)
+
+    return Raster(data, viewfinder=viewfinder)
+
+
+def condition_dem(grid: Grid, dem: Raster, dirmap=DIRMAP):
+    """
+    Hydrologically conditions a DEM and computes D8 flow directions
+    :param grid: a pysheds Grid sharing the DEM's view
+    :param dem: the DEM Raster
+    :param dirmap: the D8 direction values (N, NE, E, SE, S, SW, W, NW)
+    :return: a flow direction Raster
+    """
+
+    pit_filled_dem = grid.fill_pits(dem)
+    flooded_dem = grid.fill_depressions(pit_filled_dem)
+    inflated_dem = grid.resolve_flats(flooded_dem)
+
+    return grid.flowdir(inflated_dem, dirmap=dirmap)
+
+
+def tile_windows(height: int, width: int, tile_size: int, overlap: int):
+    """
+    Splits a raster into square tiles with an overlapping margin
+    :param height: raster rows
+    :param width: raster columns
+    :param tile_size: number of rows and columns in the core of each tile
+    :param overlap: number of cells added to each side of a tile's core (clipped at the raster edge)
+    :return: list of (core window, padded window) pairs
+    """
+
+    tiles = []
+    for row_off in range(0, height, tile_size):
+        for col_off in range(0, width, tile_size):
+            core = Window(col_off, row_off, min(tile_size, width - col_off), min(tile_size, height - row_off))
+            r0 = max(row_off - overlap, 0)
+            c0 = max(col_off - overlap, 0)
+            r1 = min(row_off + core.height + overlap, height)
+            c1 = min(col_off + core.width + overlap, width)
+            tiles.append((core, Window(c0, r0, c1 - c0, r1 - r0)))
+
+    return tiles
+
+
+def tile_neighbours(i: int, n_tiles: int, n_cols: int):
+    """
+    :param i: the index of a tile in the list from tile_windows
+    :param n_tiles: the number of tiles
+    :param n_cols: the number of tiles across the raster
+    :return: list of the indices of the (up to 8) tiles around it
+    """
+
+    row, col = divmod(i, n_cols)
+    n_rows = n_tiles // n_cols
+
+    return [r * n_cols + c for r in range(row - 1, row + 2) for c in range(col - 1, col + 2)
+            if (r, c) != (row, col) and 0 <= r < n_rows and 0 <= c < n_cols]
+
+
+def peak_memory_mb():
+    """
+    :return: the peak resident memory of the current process in MB, or None if it cannot be determined
+    """
+
+    if resource is None:
+        return None
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def ring_window(core: Window, padded: Window, width: int):
+    """
+    :param core: a tile core window
+    :param padded: the padded tile window
+    :param width: the number of cells around the core
+    :return: the window of the core and the cells of the margin within width of it
+    """
+
+    r0, c0 = max(core.row_off - width, padded.row_off), max(core.col_off - width, padded.col_off)
+    r1 = min(core.row_off + core.height + width, padded.row_off + padded.height)
+    c1 = min(core.col_off + core.width + width, padded.col_off + padded.width)
+
+    return Window(c0, r0, c1 - c0, r1 - r0)
+
+
+def _condition_tile(dem: str, core: Window, padded: Window, dirmap, ring: int):
+    tile = read_dem(dem, padded)
+    grid = Grid(viewfinder=tile.viewfinder)
+    fdir = condition_dem(grid, tile, dirmap)
+
+    r0 = core.row_off - padded.row_off
+    c0 = core.col_off - padded.col_off
+    core_fdir = np.asarray(fdir)[r0:r0 + core.height, c0:c0 + core.width].copy()
+    # the flow directions the tile found for the inner part of its margin, to check against the neighbouring cores
+    window = ring_window(core, padded, ring)
+    r0, c0 = window.row_off - padded.row_off, window.col_off - padded.col_off
+    ring_fdir = np.asarray(fdir)[r0:r0 + window.height, c0:c0 + window.width].astype(np.int16)
+
+    return core, core_fdir, (window, ring_fdir), os.getpid(), peak_memory_mb()
+
+
+def condition_dem_tiled(dem: str, tile_size: int = 2048, overlap: int = 256, workers: int = None, dirmap=DIRMAP,
+                        out=None):
+    """
+    Computes flow directions for a DEM in overlapping tiles on a process pool. Each worker reads and conditions its
+    tile plus the overlap margin and only keeps the flow directions of the tile core, so cells along tile borders are
+    routed with their neighbours on both sides. Fills are not reconciled between tiles: depressions and flats
+    (including the whole area a depression fills to) wider than the overlap across a tile border are resolved against
+    the edge of each tile's margin, and flow directions near them can differ from those of the whole DEM. Features up
+    to the overlap wide are handled as for the whole DEM. To catch wider ones, each tile's flow directions for the
+    inner half of its margin are compared with those of the neighbouring cores, which saw more context there, and a
+    warning is logged if they differ. The check also flags features between half the overlap and the overlap wide.
+    :param dem: path to a DEM
+    :param tile_size: number of rows and columns in the core of each tile
+    :param overlap: number of cells of context added around each tile
+    :param workers: number of worker processes (defaults to the number of cpus)
+    :param dirmap: the D8 direction values (N, NE, E, SE, S, SW, W, NW)
+    :param out: an optional array with the shape of the DEM to write the flow directions into (e.g., a memory-mapped
+    file), rather than one allocated in memory
+    :return: a flow direction Raster for the whole DEM and a dict of worker pid to peak memory (MB)
+    """
+
+    with rasterio.open(dem) as src:
+        height, width = src.height, src.width
+        affine = src.transform
+        crs = pyproj.Proj(src.crs, preserve_units=True)
+
+    tiles = tile_windows(height, width, tile_size, overlap)
+    n_cols = -(-width // tile_size)
+    fdir = out
+    peak_memory = {}
+    # a tile's margin is checked once the cores around it are written; tiles finish in row order, so about a row of
+    # tiles' margins is held at a time
+    rings = {}
+    written = np.zeros(len(tiles), dtype=bool)
+    mismatched = 0
+    progress = Progress(len(tiles), 'tiles conditioned', logger=log)
+    with process_pool(workers) as executor:
+        futures = [executor.submit(_condition_tile, dem, core, padded, dirmap, overlap // 2) for core, padded in tiles]
+        for i, future in enumerate(futures):
+            core, core_fdir, rings[i], pid, peak = future.result()
+            if fdir is None:
+                fdir = np.zeros((height, width), dtype=core_fdir.dtype)
+            fdir[core.row_off:core.row_off + core.height, core.col_off:core.col_off + core.width] = core_fdir
+            written[i] = True
+            for j in [i] + tile_neighbours(i, len(tiles), n_cols):
+                if j in rings and written[tile_neighbours(j, len(tiles), n_cols)].all():
+                    window, ring_fdir = rings.pop(j)
+                    mismatched += int((fdir[window.toslices()] != ring_fdir).sum())
+            peak_memory[pid] = max(peak_memory.get(pid) or 0, peak or 0)
+            progress.update()
+    progress.close()
+
+    if mismatched > 0:
+        log.warning(f'{mismatched} cells near tile borders have different flow directions in neighbouring tiles: '
+                    f'depressions or flats are wider than the {overlap} cell tile overlap, and flow directions near '
+                    f'them can differ from conditioning the whole DEM; raise the overlap above the widest of them')
+
+    for pid, peak in peak_memory.items():
+        log.info(f'worker {pid} peak memory: {peak:.0f} MB')
+
+    viewfinder = ViewFinder(affine=affine, shape=(height, width), nodata=0, crs=crs)
+
+    return Raster(fdir, viewfinder=viewfinder), peak_memory
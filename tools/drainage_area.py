@@ -1,10 +1,13 @@
 import argparse
 import geopandas as gpd
-from shapely.geometry import Point
-from rasterstats import zonal_stats
+from tools.network_io import read_network, write_network
+from tools.raster_sampling import line_midpoints, buffered_stats
+from tools.incremental import raster_fingerprint, row_hashes, recompute
+from tools.telemetry import phase, add_arguments, instrumented
 
 
-def add_da(network: str, da: str, crs_epsg: str, search_dist: float):
+def add_da(network: str, da: str, crs_epsg: str, search_dist: float, block_cache_mb: float = 256.,
+           incremental: bool = False, workers: int = None):
     """
 
     :param network: path to segmented stream network shapefile
@@ -12,6 +15,9 @@ def add_da(network: str, da: str, crs_epsg: str, search_dist: float):
     :param crs_epsg: the epsg number for the dataset projections
     :param search_dist: a buffer distance to search for drainage area values away from network segments to
     account for positional error between the raster and drainage network
+    :param block_cache_mb: the maximum size in MB of the drainage area window held in memory at once
+    :param incremental: if True, only segments whose geometry (or the raster) changed since the last run are recomputed
+    :param workers: the number of worker processes to sample the raster with (serial if None or 1)
     :return: adds the field 'Drain_Area' to the stream network
     """
 
@@ -19,36 +25,56 @@ def add_da(network: str, da: str, crs_epsg: str, search_dist: float):
     sref = 'epsg:{}'.format(crs_epsg)
 
     # read in network and check for projection
-    flowlines = gpd.read_file(network)
-    if flowlines['geometry'].crs == sref:
-        pass
-    else:
+    with phase('read'):
+        flowlines = read_network(network)
+    reprojected = flowlines['geometry'].crs != sref
+    if reprojected:
         flowlines = flowlines.to_crs(sref)
 
-    # list to store da values
-    da_list = []
+    changed = update_da(flowlines, da, search_dist, incremental, block_cache_mb, workers)
+    if not changed.any() and not reprojected:
+        return
 
-    # iterate through each network segment, obtain da value and add to list
-    for i in flowlines.index:
-        # find and buffer segment midpoint to account for positional inaccuracy between da raster and network
-        seg_geom = flowlines.loc[i, 'geometry']
-        pos = int(len(seg_geom.coords.xy[0])/2)
-        mid_pt_x = seg_geom.coords.xy[0][pos]
-        mid_pt_y = seg_geom.coords.xy[1][pos]
+    # only the new fields need writing if the geometry is unchanged
+    with phase('write'):
+        write_network(flowlines, network, columns=None if reprojected else ['Drain_Area', 'da_hash'])
 
-        pt = Point(mid_pt_x, mid_pt_y)
-        buf = pt.buffer(search_dist)
 
-        # get max drainage area value within buffered midpoint
-        zs = zonal_stats(buf, da, stats='max')
-        da_value = zs[0].get('max')
+def calc_da(flowlines: gpd.GeoDataFrame, da: str, search_dist: float, block_cache_mb: float = 256.,
+            workers: int = None):
+    """
+    Adds the field 'Drain_Area' to a drainage network in memory
+    :param flowlines: a segmented drainage network GeoDataFrame in the drainage area raster projection
+    :param da: path to drainage area raster
+    :param search_dist: a buffer distance to search for drainage area values away from network segments
+    :param block_cache_mb: the maximum size in MB of the drainage area window held in memory at once
+    :param workers: the number of worker processes to sample the raster with (serial if None or 1)
+    :return: the network with the 'Drain_Area' field
+    """
+
+    # find the segment midpoints and get the max drainage area value within a buffer around each to account for
+    # positional inaccuracy between da raster and network
+    mid_pt_x, mid_pt_y = line_midpoints(flowlines.geometry)
+    with phase('sampling'):
+        flowlines['Drain_Area'] = buffered_stats(da, mid_pt_x, mid_pt_y, search_dist, stats=('max',),
+                                                 block_cache_mb=block_cache_mb, workers=workers)['max']
 
-        da_list.append(da_value)
+    return flowlines
+
+
+def update_da(flowlines: gpd.GeoDataFrame, da: str, search_dist: float, incremental: bool = False,
+              block_cache_mb: float = 256., workers: int = None):
+    """
+    Adds the field 'Drain_Area' to a drainage network in memory along with a 'da_hash' field identifying the geometry
+    and inputs each value was calculated from. Parameters are as for calc_da
+    :param incremental: if True, only segments whose hash changed since the last run are recomputed
+    :return: boolean array of the recomputed segments
+    """
 
-    # add da values to network attribute table
-    flowlines['Drain_Area'] = da_list
+    hashes = row_hashes(flowlines.geometry, raster_fingerprint(da), search_dist)
 
-    flowlines.to_file(network)
+    return recompute(flowlines, ['Drain_Area'], 'da_hash', hashes,
+                     lambda rows: calc_da(rows, da, search_dist, block_cache_mb, workers), incremental)
 
 
 def main():
@@ -59,9 +85,17 @@ def main():
     parser.add_argument('buffer_distance', help='A buffer distance to search away from the network segment for a max'
                                                 'drainage area value (to account for positional error between the raster'
                                                 'and the network.', type=float)
+    parser.add_argument('--block_cache', help='The maximum size in MB of the raster window held in memory at once.',
+                        type=float, default=256.)
+    parser.add_argument('--incremental', help='Only recompute segments that changed since the last run.',
+                        action='store_true')
+    parser.add_argument('--workers', help='The number of worker processes to sample the raster with.', type=int)
+    add_arguments(parser)
     args = parser.parse_args()
 
-    add_da(args.network, args.drainage_area, args.EPSG, args.buffer_distance)
+    with instrumented(args.trace, args.profile, args.log_level):
+        add_da(args.network, args.drainage_area, args.EPSG, args.buffer_distance, args.block_cache, args.incremental,
+               args.workers)
 
 
 if __name__ == '__main__':
@@ -1,26 +1,85 @@
 import argparse
+import logging
 import os
+import shutil
+import tempfile
+from contextlib import contextmanager
 import rasterio
-from rasterio.features import shapes
-from rasterio.mask import mask
-from rasterio.warp import reproject, Resampling, calculate_default_transform
+from affine import Affine
+from rasterio.transform import array_bounds
+from rasterio.warp import reproject, Resampling
 import numpy as np
 import geopandas as gpd
 from pysheds.grid import Grid
-
-
-def get_flow_scaling_factor(network: str, meas_id: int, dem: str, precip_raster: str, reproject: bool=False):
+from pysheds.sview import Raster
+from tools.dem_conditioning import DIRMAP, condition_dem, condition_dem_tiled
+from tools.conditioning_cache import cache_key, load_rasters, save_rasters, evict_lru
+from tools.out_of_core import flow_grids, d8_accumulation, edges_draining_to, scratch_array, snap_to_stream
+from tools.warping import network_bounds, raster_extent, raster_subset, open_edges, grow_bounds
+from tools.network_io import read_network, write_network
+from tools.incremental import raster_fingerprint, row_hashes, recompute
+from tools.telemetry import Progress, phase, add_arguments, instrumented
+from tools.workers import process_pool
+
+log = logging.getLogger(__name__)
+
+
+def get_flow_scaling_factor(network: str, meas_id: int, dem: str, precip_raster: str, reproject: bool=False,
+                            method: str = 'catchment', tile_size: int = None, tile_overlap: int = 256,
+                            workers: int = None, cache_dir: str = None, cache_size: float = 20.,
+                            incremental: bool = False, scratch_dir: str = None):
     """
 
     :param network: path to a segment stream network layer
     :param meas_id: the reach id (e.g. fid) where this discharge record applies
     :param dem: path to a 10m DEM. This should not be LiDAR if available
     :param precip_raster: path to a precipitation raster (e.g., PRISM)
-    :param reproject: if True, rasters are reprojected to match the drainage network crs if needed
+    :param reproject: if True, rasters are reprojected to match the drainage network crs if needed; only the part of
+    the DEM around the network is reprojected
+    :param method: 'catchment' delineates and sums precipitation over the catchment of every reach; 'accumulation'
+    computes a single precipitation-weighted flow accumulation and reads each reach's value from it
+    :param tile_size: if given, flow directions are computed in tiles of this many cells on a process pool rather than
+    for the whole DEM at once
+    :param tile_overlap: the number of cells of context around each tile
+    :param workers: the number of worker processes for tiled flow directions (defaults to the number of cpus); with the
+    catchment method, reach catchments are also delineated on a pool of this many processes if it is greater than 1
+    :param cache_dir: if given, flow direction and accumulation grids (and a reprojected DEM) are cached in this
+    directory, keyed by the DEM's file names, sizes and modification times and the processing parameters, and reused
+    by later runs on the same DEM
+    :param cache_size: the maximum size of the cache in GB; least recently used entries are removed beyond this
+    :param incremental: if True, only segments whose geometry (or the rasters or measurement reach) changed since the
+    last run are recomputed
+    :param scratch_dir: if given, the flow grids are written to memory-mapped files in a temporary directory here
+    rather than held in memory, so DEMs larger than memory can be processed (see out_of_core_flow_scale); the
+    accumulation method is then used whatever the method
     :return: adds a field 'flow_scale' to the drainage network for scaling discharge measurements across the network
     """
 
-    dn = gpd.read_file(network)
+    with phase('read'):
+        dn = read_network(network)
+    changed = update_flow_scale(dn, meas_id, dem, precip_raster, reproject, method, tile_size, tile_overlap, workers,
+                                cache_dir, cache_size, incremental, scratch_dir)
+    if not changed.any():
+        return
+
+    with phase('write'):
+        write_network(dn, network, columns=['flow_scale', 'fs_hash'])
+
+
+def calc_flow_scale(dn: gpd.GeoDataFrame, meas_id: int, dem: str, precip_raster: str, reproject: bool = False,
+                    method: str = 'catchment', tile_size: int = None, tile_overlap: int = 256, workers: int = None,
+                    cache_dir: str = None, cache_size: float = 20., scratch_dir: str = None, bounds=None):
+    """
+    Adds the field 'flow_scale' to a drainage network in memory. Parameters other than dn and bounds are as for
+    get_flow_scaling_factor
+    :param dn: a segmented drainage network GeoDataFrame with a projected crs
+    :param bounds: the (left, bottom, right, top) area a reprojected DEM is needed for (defaults to that of dn with a
+    margin; see network_bounds)
+    :return: the network with the 'flow_scale' field
+    """
+
+    if method not in ('catchment', 'accumulation'):
+        raise Exception(f'Unknown flow scaling method: {method}')
 
     # check for projection consistency
     if dn.crs.is_projected is False:
@@ -32,149 +91,451 @@ def get_flow_scaling_factor(network: str, meas_id: int, dem: str, precip_raster:
     dn.loc[meas_id, 'flow_scale'] = 1.
 
     # get the coords of the midpoint of the measurement segment
-    seg_geom = dn.loc[meas_id].geometry
-    pos = int(len(seg_geom.coords.xy[0]) / 2)
-    mid_pt_x = seg_geom.coords.xy[0][pos]
-    mid_pt_y = seg_geom.coords.xy[1][pos]
+    mid_pt_x, mid_pt_y = segment_midpoint(dn.loc[meas_id].geometry)
+
+    bounds = network_bounds(dn.geometry) if bounds is None else bounds
+    if scratch_dir:
+        if method == 'catchment':
+            log.warning('catchments are not delineated with a scratch directory; precipitation is read from the '
+                        'precipitation-weighted flow accumulation, as for the accumulation method')
+        return out_of_core_flow_scale(dn, meas_id, dem, precip_raster, reproject, tile_size or 2048, tile_overlap,
+                                      workers, cache_dir, cache_size, scratch_dir, bounds)
+
+    # every reach is snapped to the stream cells with a single index of them
+    points = [(mid_pt_x, mid_pt_y)] + [segment_midpoint(geom) for geom in dn.geometry]
+    with contributing_grids(dn.crs, dem, reproject, points, bounds, tile_size, tile_overlap, workers, cache_dir,
+                            cache_size) as (dem, grid, fdir, acc, shared, snapped):
+        precip = reach_precip(grid, fdir, dem, precip_raster, dn.crs, reproject, method, snapped, workers, shared)
+    precip_ref = precip[0]
+    log.info(f'reference precip: {precip_ref}')
+    dn['flow_scale'] = precip[1:]/precip_ref
+    for i, value in zip(dn.index, precip[1:]):
+        log.debug(f'reach {i}: precip = {value}, ratio = {value/precip_ref}')
+
+    return dn
+
+
+@contextmanager
+def matching_dem(crs, dem: str, reproject: bool = False, bounds=None, cache_dir: str = None,
+                 cache_size: float = 20., tmp_dir: str = None):
+    """
+    Clips a DEM to the cells covering an area, after checking that it has the projection of a drainage network. If it
+    doesn't and reprojection is allowed, the area is reprojected (see raster_subset), to the cache if one is given
+    :param crs: the crs of the drainage network
+    :param dem: path to a DEM
+    :param reproject: if True, the DEM is reprojected to the network crs if needed
+    :param bounds: the (left, bottom, right, top) area to clip to, in the network crs (the whole DEM if None)
+    :param cache_dir: an optional cache directory to keep the clipped DEM in
+    :param cache_size: the maximum size of the cache in GB
+    :param tmp_dir: where to write a clipped DEM that is not cached
+    :return: a context manager giving the path to a DEM in the network crs
+    """
 
-    # open and check projection of dem
     with rasterio.open(dem) as demsrc:
-        if demsrc.crs != dn.crs:
-            if reproject is False:
-                raise Exception('DEM must have same projection as drainage network')
+        dem_crs = demsrc.crs
+    if dem_crs != crs:
+        if reproject is False:
+            raise Exception('DEM must have same projection as drainage network')
+        log.info('reprojecting DEM')
+
+    bounds = raster_extent(dem, crs) if bounds is None else bounds
+    with raster_subset(dem, crs, bounds, cache_dir, cache_size, tmp_dir) as path:
+        yield path
+
+
+@contextmanager
+def contributing_grids(crs, dem: str, reproject: bool, points: list, bounds, tile_size: int = None,
+                       tile_overlap: int = 256, workers: int = None, cache_dir: str = None, cache_size: float = 20.,
+                       dirmap=DIRMAP):
+    """
+    Computes flow grids on the part of a DEM draining to a set of reaches and snaps the reaches to its stream cells.
+    The DEM is clipped to the bounds (see matching_dem); while the flow from any edge of the clipped DEM that lies
+    inside the DEM reaches one of the snapped cells, i.e. a catchment is cut off, those edges are moved out (see
+    grow_bounds) and the grids are computed again. Other parameters are as for get_flow_scaling_factor
+    :param crs: the crs of the drainage network
+    :param dem: path to a DEM
+    :param reproject: if True, the DEM is reprojected to the network crs if needed
+    :param points: list of (x, y) coordinates of the reaches
+    :param bounds: the (left, bottom, right, top) area to start with, in the network crs (see network_bounds)
+    :return: a context manager giving the path to the clipped DEM, a pysheds Grid, the flow direction and accumulation
+    Rasters, the cache entry holding them (see flow_grids_for_dem) and the snapped coordinates of the points
+    """
+
+    extent = raster_extent(dem, crs)
+    while True:
+        with matching_dem(crs, dem, reproject, bounds, cache_dir, cache_size) as clipped:
+            grid, fdir, acc, shared = flow_grids_for_dem(clipped, tile_size, tile_overlap, workers, cache_dir,
+                                                         cache_size, dirmap)
+            with phase('snapping'):
+                snapped = snap_to_streams(grid, acc, points)
+            clipped_bounds = array_bounds(*grid.shape, grid.affine)
+            edges = open_edges(clipped_bounds, extent, abs(grid.affine.a))
+            if any(edges):
+                with phase('catchment edges'):
+                    cells = [grid.nearest_cell(x, y)[::-1] for x, y in snapped]
+                    edges = edges_draining_to(fdir, cells, edges, dirmap)
+            if not any(edges):
+                yield clipped, grid, fdir, acc, shared, snapped
+                return
+        log.info('catchments reach the edge of the clipped DEM; expanding it')
+        bounds = grow_bounds(clipped_bounds, edges, extent)
+
+
+def flow_grids_for_dem(dem: str, tile_size: int = None, tile_overlap: int = 256, workers: int = None,
+                       cache_dir: str = None, cache_size: float = 20., dirmap=DIRMAP):
+    """
+    Conditions a DEM and computes its flow direction and accumulation grids, or loads them from the cache. Parameters
+    are as for get_flow_scaling_factor
+    :param dem: path to a DEM
+    :return: a pysheds Grid, the flow direction and accumulation Rasters, and the (cache_dir, key) of the cache entry
+    holding them (None if they are not cached), which workers can memory-map
+    """
+
+    log.info('performing flow analysis on DEM')
+    cached = None
+    if cache_dir:
+        key = cache_key(dem, dirmap=dirmap, tile_size=tile_size,
+                        tile_overlap=tile_overlap if tile_size else None)
+        cached = load_rasters(cache_dir, key, ('fdir', 'acc'))
+    if cached:
+        log.info('using cached flow direction and accumulation')
+        fdir = cached['fdir']
+        acc = cached['acc']
+        grid = Grid(viewfinder=fdir.viewfinder)
+    else:
+        with phase('dem conditioning'):
+            if tile_size:
+                fdir, _ = condition_dem_tiled(dem, tile_size, tile_overlap, workers, dirmap)
+                grid = Grid(viewfinder=fdir.viewfinder)
             else:
-                print('reprojecting DEM')
-                reproject_raster(dem, dn.crs, os.path.join(os.path.dirname(dem), 'DEM_reprojected.tif'))
-                demsrc = rasterio.open(os.path.join(os.path.dirname(dem), 'DEM_reprojected.tif'))
-                transform = demsrc.transform
-                dem = os.path.join(os.path.dirname(dem), 'DEM_reprojected.tif')
-        else:
-            transform = demsrc.transform
-
-    # first delineate the watershed upstream of the measurement reach
-    print('performing flow analysis on DEM')
-    grid = Grid.from_raster(dem)
-    griddem = grid.read_raster(dem)
-    pit_filled_dem = grid.fill_pits(griddem)
-    flooded_dem = grid.fill_depressions(pit_filled_dem)
-    inflated_dem = grid.resolve_flats(flooded_dem)
-
-    dirmap = (64, 128, 1, 2, 4, 8, 16, 32)
-    fdir = grid.flowdir(inflated_dem, dirmap=dirmap)
-    acc = grid.accumulation(fdir, dirmap=dirmap)
-
-    print('delineating catchment upstream of measurement reach')
-    x_snap, y_snap = grid.snap_to_mask(acc > 1000, (mid_pt_x, mid_pt_y))
-    catch = grid.catchment(x=x_snap, y=y_snap, fdir=fdir, xytype='coordinate')
-
-    catch_arr = np.where(catch, 1, np.nan).astype(np.int16)
-
-    results = (
-        {'properties': {'raster_val': v}, 'geometry': s}
-        for i, (s, v)
-        in enumerate(
-        shapes(catch_arr, mask=catch_arr == 1., transform=transform)))
-
-    geoms = list(results)
-    if len(geoms) == 0:
-        raise Exception('no geoms')
-    shps = [g['geometry'] for g in geoms]
-
-    print('finding reference precip value')
+                grid = Grid.from_raster(dem)
+                griddem = grid.read_raster(dem)
+                fdir = condition_dem(grid, griddem, dirmap)
+        with phase('flow accumulation'):
+            acc = grid.accumulation(fdir, dirmap=dirmap)
+        if cache_dir:
+            save_rasters(cache_dir, key, {'fdir': fdir, 'acc': acc})
+            evict_lru(cache_dir, int(cache_size * 1024**3))
+
+    shared = None
+    if cache_dir and os.path.exists(os.path.join(cache_dir, key, 'meta.json')):
+        shared = (cache_dir, key)
+
+    return grid, fdir, acc, shared
+
+
+def reach_precip(grid: Grid, fdir: Raster, dem: str, precip_raster: str, crs, reproject: bool, method: str,
+                 points: list, workers: int = None, shared=None, dirmap=DIRMAP):
+    """
+    The precipitation over the catchment of each of a set of stream cells
+    :param grid: a pysheds Grid on the flow direction grid
+    :param fdir: flow direction Raster
+    :param dem: path to the DEM the grids were computed from
+    :param precip_raster: path to a precipitation raster
+    :param crs: the crs of the drainage network
+    :param reproject: if False, the precipitation raster must have the network crs
+    :param method: 'catchment' delineates every catchment and sums the precipitation over it; 'accumulation' reads
+    the values from a single precipitation-weighted flow accumulation
+    :param points: list of (x, y) coordinates of stream cells (see snap_to_streams)
+    :param workers: with the catchment method, catchments are delineated on a pool of this many processes if it is
+    greater than 1
+    :param shared: an optional (cache_dir, key) of a cache entry holding fdir, for the workers to memory-map
+    :param dirmap: the D8 direction values (N, NE, E, SE, S, SW, W, NW)
+    :return: array of precipitation values (for the catchment method, precipitation / pixel area summed over the
+    precipitation pixels covered), in the order of points
+    """
+
     with rasterio.open(precip_raster) as src:
-        if src.crs != dn.crs:
-            if reproject is False:
-                raise Exception('Precip raster must have same projection as drainage network')
-            else:
-                print('reprojecting precip raster')
-                reproject_raster(precip_raster, dn.crs, os.path.join(os.path.dirname(precip_raster), 'precip_reprojected.tif'))
-                precip_raster = os.path.join(os.path.dirname(precip_raster), 'precip_reprojected.tif')
-                src = rasterio.open(precip_raster)
-                out_image, out_transform = mask(src, shps, crop=True)
+        if src.crs != crs and reproject is False:
+            raise Exception('Precip raster must have same projection as drainage network')
+        precip_area = src.res[0] * src.res[1]
+    with rasterio.open(dem) as demsrc:
+        dem_crs = demsrc.crs
+
+    if method == 'accumulation':
+        # route precipitation down the flow directions once; the value at a cell is then the total precipitation
+        # of its upstream catchment
+        log.info('accumulating precipitation over flow directions')
+        with phase('precipitation accumulation'):
+            precip_grid = resample_to_grid(precip_raster, dem_crs, grid.affine, grid.shape)
+            weights = Raster(precip_grid, viewfinder=grid.viewfinder)
+            precip_acc = grid.accumulation(fdir, weights=weights, dirmap=dirmap)
+        with phase('sampling'):
+            return np.array([sample_accumulation(grid, precip_acc, x, y) for x, y in points])
+
+    log.info('resampling precipitation to the DEM grid')
+    with phase('precipitation resampling'):
+        # each DEM cell carries its share of the precipitation pixel it falls in, so the sum over a catchment's cells
+        # is the sum of precipitation / pixel area over the precipitation pixels it covers
+        precip_grid = resample_to_grid(precip_raster, dem_crs, grid.affine, grid.shape)
+        precip_grid *= abs(grid.affine.a * grid.affine.e) / precip_area ** 2
+
+    log.info('delineating reach catchments')
+    with phase('catchments'):
+        if workers is None or workers <= 1 or len(points) < 2:
+            precip = np.empty(len(points))
+            progress = Progress(len(points), 'reaches', logger=log)
+            for j, (x, y) in enumerate(points):
+                precip[j] = catchment_precip(grid, fdir, precip_grid, x, y)
+                progress.update()
+            progress.close()
         else:
-            out_image, out_transform = mask(src, shps, crop=True)
+            precip = np.array(parallel_catchment_precip(fdir, precip_grid, points, workers, shared))
 
-    precip_ref = 0
-    for i in np.nditer(out_image):
-        if i != src.nodata:
-            precip_ref += i / (src.res[0]*src.res[1])
+    return precip
 
-    print(f'reference precip: {precip_ref}')
 
-    for i in dn.index:
-        print(f'assessing reach {i}')
-        grid = Grid.from_raster(dem)
-        geom = dn.loc[i].geometry
-        pos = int(len(geom.coords.xy[0]) / 2)
-        x = geom.coords.xy[0][pos]
-        y = geom.coords.xy[1][pos]
-        x_snap, y_snap = grid.snap_to_mask(acc > 1000, (x, y))
-        catch = grid.catchment(x=x_snap, y=y_snap, fdir=fdir, xytype='coordinate')
+def update_flow_scale(dn: gpd.GeoDataFrame, meas_id: int, dem: str, precip_raster: str, reproject: bool = False,
+                      method: str = 'catchment', tile_size: int = None, tile_overlap: int = 256, workers: int = None,
+                      cache_dir: str = None, cache_size: float = 20., incremental: bool = False,
+                      scratch_dir: str = None):
+    """
+    Adds the field 'flow_scale' to a drainage network in memory along with an 'fs_hash' field identifying the geometry
+    and inputs each value was calculated from. A change to the measurement reach changes every hash. Parameters are
+    as for get_flow_scaling_factor
+    :param dn: a segmented drainage network GeoDataFrame with a projected crs
+    :return: boolean array of the recomputed segments
+    """
 
-        catch_arr = np.where(catch, 1, np.nan).astype(np.int16)
-        results = (
-            {'properties': {'raster_val': v}, 'geometry': s}
-            for i, (s, v)
-            in enumerate(
-            shapes(catch_arr, mask=catch_arr == 1., transform=transform)))
+    # 'grid' marks catchment totals summed on the DEM grid, so values stored by the earlier polygon-based sum are
+    # recomputed; out-of-core totals come from accumulation rather than catchments, so they are hashed apart
+    hashes = row_hashes(dn.geometry, raster_fingerprint(dem), raster_fingerprint(precip_raster), meas_id,
+                        dn.loc[meas_id].geometry.wkb_hex, reproject, method, 'grid',
+                        *(('out_of_core',) if scratch_dir else ()))
 
-        geoms = list(results)
-        if len(geoms) == 0:
-            raise Exception('no geoms')
-        shps = [g['geometry'] for g in geoms]
+    return recompute(dn, ['flow_scale'], 'fs_hash', hashes,
+                     lambda rows: calc_flow_scale(rows, meas_id, dem, precip_raster, reproject, method, tile_size,
+                                                  tile_overlap, workers, cache_dir, cache_size, scratch_dir,
+                                                  network_bounds(dn.geometry)),
+                     incremental, include=[meas_id])
 
-        with rasterio.open(precip_raster) as src:
-            out_image, out_transform = mask(src, shps, crop=True)
 
-        precip = 0
-        for j in np.nditer(out_image):
-            if j != src.nodata:
-                precip += j / (src.res[0]*src.res[1])
+def out_of_core_flow_scale(dn: gpd.GeoDataFrame, meas_id: int, dem: str, precip_raster: str, reproject: bool,
+                           tile_size: int, tile_overlap: int, workers: int, cache_dir: str, cache_size: float,
+                           scratch_dir: str, bounds):
+    """
+    Adds the field 'flow_scale' to a drainage network without holding the DEM grids in memory. Flow directions are
+    computed in tiles, and they, the flow accumulation and the precipitation-weighted accumulation are written to
+    memory-mapped files in a temporary directory in scratch_dir (about 19 bytes per DEM cell), which is removed
+    afterwards. Each reach is snapped to the nearest stream cell by searching a small window of the accumulation grid,
+    and its catchment precipitation is read from the weighted accumulation there, which is the total over the cells
+    draining to it, rather than delineated, since a catchment mask is as large as the DEM. The DEM is clipped to the
+    bounds and expanded where catchments are cut off, as in contributing_grids. Parameters are as for
+    get_flow_scaling_factor
+    :param dn: a segmented drainage network GeoDataFrame with a projected crs
+    :param bounds: the (left, bottom, right, top) area to start with, in the network crs (see network_bounds)
+    :return: the network with the 'flow_scale' field
+    """
+
+    with rasterio.open(precip_raster) as src:
+        if src.crs != dn.crs and reproject is False:
+            raise Exception('Precip raster must have same projection as drainage network')
+
+    points = [segment_midpoint(geom) for geom in dn.geometry]
+    extent = raster_extent(dem, dn.crs)
+    os.makedirs(scratch_dir, exist_ok=True)
+    while True:
+        with matching_dem(dn.crs, dem, reproject, bounds, cache_dir, cache_size, scratch_dir) as clipped:
+            tmp_dir = tempfile.mkdtemp(prefix='flow_grids_', dir=scratch_dir)
+            try:
+                cached = None
+                if cache_dir:
+                    key = cache_key(clipped, dirmap=DIRMAP, tile_size=tile_size, tile_overlap=tile_overlap)
+                    cached = load_rasters(cache_dir, key, ('fdir', 'acc'))
+                if cached:
+                    log.info('using cached flow direction and accumulation')
+                    fdir, acc = cached['fdir'], cached['acc']
+                else:
+                    with phase('flow grids'):
+                        fdir, acc = flow_grids(clipped, tmp_dir, tile_size, tile_overlap, workers, DIRMAP)
+                    if cache_dir:
+                        save_rasters(cache_dir, key, {'fdir': fdir, 'acc': acc})
+                        evict_lru(cache_dir, int(cache_size * 1024**3))
+
+                with phase('snapping'):
+                    cells = []
+                    progress = Progress(len(points), 'reaches', logger=log)
+                    for x, y in points:
+                        cells.append(snap_to_stream(acc, fdir.affine, x, y))
+                        progress.update()
+                    progress.close()
+
+                clipped_bounds = array_bounds(*fdir.shape, fdir.affine)
+                edges = open_edges(clipped_bounds, extent, abs(fdir.affine.a))
+                if any(edges):
+                    with phase('catchment edges'):
+                        visited = scratch_array(tmp_dir, 'visited', (fdir.size,), np.uint8)
+                        edges = edges_draining_to(fdir, cells, edges, DIRMAP, visited=visited)
+                        del visited
+                if not any(edges):
+                    log.info('accumulating precipitation over flow directions')
+                    with phase('precipitation accumulation'):
+                        precip_acc = scratch_array(tmp_dir, 'precip_acc', fdir.shape, np.float64)
+                        resample_to_grid(precip_raster, dn.crs, fdir.affine, fdir.shape, precip_acc, block_rows=4096)
+                        d8_accumulation(fdir, precip_acc, tmp_dir, weighted=True, dirmap=DIRMAP)
+                    with phase('sampling'):
+                        precip = np.array([precip_acc[row, col] for row, col in cells])
+                    del precip_acc
+                del fdir, acc
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not any(edges):
+            break
+        log.info('catchments reach the edge of the clipped DEM; expanding it')
+        bounds = grow_bounds(clipped_bounds, edges, extent)
+
+    precip_ref = precip[dn.index.get_loc(meas_id)]
+    log.info(f'reference precip: {precip_ref}')
+    dn['flow_scale'] = precip / precip_ref
+
+    return dn
+
+
+def segment_midpoint(geom):
+    """
+    Returns the middle vertex of a line, which is used as the reach location for flow analysis
+    :param geom: a LineString
+    :return: x, y coordinates of the middle vertex
+    """
 
-        print(f'precip = {precip}')
-        print(f'ratio = {precip/precip_ref}')
-        dn.loc[i, 'flow_scale'] = precip/precip_ref
+    pos = int(len(geom.coords.xy[0]) / 2)
 
-    dn.to_file(network)
+    return geom.coords.xy[0][pos], geom.coords.xy[1][pos]
 
 
-def reproject_raster(in_raster, dst_crs, out_raster):
+def resample_to_grid(in_raster, dst_crs, dst_transform, shape, out=None, block_rows: int = None):
+    """
+    Resamples a raster onto the DEM grid
+    :param in_raster: path to the raster to resample (e.g., precipitation)
+    :param dst_crs: the crs of the DEM
+    :param dst_transform: the affine transform of the DEM
+    :param shape: the (rows, cols) shape of the DEM
+    :param out: an optional float64 array with the DEM shape to resample into (e.g., a memory-mapped file)
+    :param block_rows: if given, the raster is resampled this many rows at a time
+    :return: a float64 array with the DEM shape; nodata cells are set to 0
+    """
 
+    out = np.zeros(shape, dtype=np.float64) if out is None else out
+    block_rows = shape[0] if block_rows is None else block_rows
     with rasterio.open(in_raster) as src:
-        src_transform = src.transform
-
-        # calculate the transform matrix for the output
-        dst_transform, width, height = calculate_default_transform(
-            src.crs,
-            dst_crs,
-            src.width,
-            src.height,
-            *src.bounds,  # unpacks outer boundaries (left, bottom, right, top)
-        )
-
-        # set properties for output
-        dst_kwargs = src.meta.copy()
-        dst_kwargs.update(
-            {
-                "crs": dst_crs,
-                "transform": dst_transform,
-                "width": width,
-                "height": height,
-                "nodata": src.nodata,  # replace 0 with np.nan
-            }
-        )
-
-        with rasterio.open(out_raster, "w", **dst_kwargs) as dst:
-            for i in range(1, src.count + 1):
-                reproject(
-                    source=rasterio.band(src, i),
-                    destination=rasterio.band(dst, i),
-                    src_transform=src.transform,
-                    src_crs=src.crs,
-                    dst_transform=dst_transform,
-                    dst_crs=dst_crs,
-                    resampling=Resampling.cubic,
-                )
+        for row in range(0, shape[0], block_rows):
+            # a view of the rows, so a memory-mapped out is written in place
+            block = np.asarray(out[row:row + block_rows])
+            block[:] = 0.
+            reproject(
+                source=rasterio.band(src, 1),
+                destination=block,
+                src_transform=src.transform,
+                src_crs=src.crs,
+                src_nodata=src.nodata,
+                dst_transform=dst_transform * Affine.translation(0, row),
+                dst_crs=dst_crs,
+                dst_nodata=0.,
+                resampling=Resampling.nearest,
+            )
+
+    return out
+
+
+def snap_to_streams(grid: Grid, acc: Raster, points: list, threshold: float = 1000.):
+    """
+    Snaps locations to the nearest stream cell (accumulation above the threshold). The stream cells are indexed in a
+    KD-tree once and every location is found with a nearest-neighbour query, rather than building an index for each
+    location; the cells found are those snapping each location on its own would give
+    :param grid: a pysheds Grid
+    :param acc: flow accumulation (cell counts) used to define stream cells
+    :param points: list of (x, y) coordinates
+    :param threshold: the accumulation above which a cell is a stream cell
+    :return: list of (x, y) coordinates of the snapped stream cells
+    """
+
+    snapped = grid.snap_to_mask(acc > threshold, np.asarray(points, dtype=np.float64).reshape(-1, 2))
+
+    return [(x, y) for x, y in snapped.tolist()]
+
+
+def sample_accumulation(grid, acc_values, x, y):
+    """
+    Reads an accumulated value at a stream cell
+    :param grid: a pysheds Grid
+    :param acc_values: the accumulated grid to sample (e.g., precipitation-weighted accumulation)
+    :param x: x coordinate of a stream cell (see snap_to_streams)
+    :param y: y coordinate of a stream cell
+    :return: the value of acc_values at the cell
+    """
+
+    col, row = grid.nearest_cell(x, y)
+
+    return float(acc_values[row, col])
+
+
+def catchment_precip(grid: Grid, fdir: Raster, precip_grid, x: float, y: float):
+    """
+    Delineates the catchment upstream of a stream cell and sums the precipitation over it
+    :param grid: a pysheds Grid on the flow direction grid
+    :param fdir: flow direction Raster
+    :param precip_grid: array of precipitation on the flow direction grid
+    :param x: x coordinate of a stream cell (see snap_to_streams)
+    :param y: y coordinate of a stream cell
+    :return: the catchment precipitation
+    """
+
+    catch = grid.catchment(x=x, y=y, fdir=fdir, xytype='coordinate')
+    catch = np.asarray(catch, dtype=bool)
+    if not catch.any():
+        raise Exception('empty catchment')
+
+    return float(precip_grid[catch].sum())
+
+
+def _catchment_precip_batch(shared_dir: str, key: str, precip_file: str, points: list):
+    # the grids are memory-mapped from disk rather than sent to each worker
+    rasters = load_rasters(shared_dir, key, ('fdir',))
+    grid = Grid(viewfinder=rasters['fdir'].viewfinder)
+    precip_grid = np.load(precip_file, mmap_mode='r')
+
+    return [catchment_precip(grid, rasters['fdir'], precip_grid, x, y) for x, y in points]
+
+
+def parallel_catchment_precip(fdir: Raster, precip_grid, points: list, workers: int, shared=None):
+    """
+    Sums the precipitation over the catchment of many stream cells on a process pool. The flow direction and
+    precipitation grids are written once to .npy files that the workers memory-map, so they are not copied to each
+    worker
+    :param fdir: flow direction Raster
+    :param precip_grid: array of precipitation on the flow direction grid
+    :param points: list of (x, y) coordinates of stream cells (see snap_to_streams)
+    :param workers: the number of worker processes
+    :param shared: an optional (cache_dir, key) of a cache entry already holding fdir
+    :return: list of catchment precipitation values in the order of points
+    """
+
+    tmp_dir = tempfile.mkdtemp(prefix='flow_grids_')
+    if shared:
+        shared_dir, key = shared
+    else:
+        shared_dir, key = tmp_dir, 'grids'
+        save_rasters(shared_dir, key, {'fdir': fdir})
+    precip_file = os.path.join(tmp_dir, 'precip.npy')
+    np.save(precip_file, precip_grid)
+
+    # contiguous batches, several per worker so a batch of large catchments doesn't hold up the rest
+    n_batches = min(len(points), workers * 4)
+    batches = [list(b) for b in np.array_split(np.arange(len(points)), n_batches)]
+    precip = []
+    progress = Progress(len(points), 'reaches', logger=log)
+    try:
+        with process_pool(workers) as executor:
+            futures = [executor.submit(_catchment_precip_batch, shared_dir, key, precip_file,
+                                       [points[j] for j in batch]) for batch in batches]
+            for future in futures:
+                precip.extend(future.result())
+                progress.set(len(precip))
+            progress.close()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return precip
 
 
 def main():
@@ -184,11 +545,32 @@ def main():
                                                   'applies.', type=int)
     parser.add_argument('dem', help='Path to a 10m DEM. This should be coarse, not LiDAR.', type=str)
     parser.add_argument('precipitation', help='Path to a precipitation raster (e.g., PRISM).', type=str)
-    parser.add_argument('--reproject', help='if True, rasters are reprojected to match the drainage network crs '
-                                            'if needed', type=bool, default=False)
+    parser.add_argument('--reproject', help='Reproject the rasters to match the drainage network crs if needed.',
+                        action='store_true')
+    parser.add_argument('--method', help='catchment: delineate the catchment of every reach (slow); accumulation: '
+                                         'use a single precipitation-weighted flow accumulation (fast)',
+                        type=str, choices=['catchment', 'accumulation'], default='catchment')
+    parser.add_argument('--tile_size', help='If given, compute flow directions in tiles of this many cells on a '
+                                            'process pool.', type=int)
+    parser.add_argument('--tile_overlap', help='The number of cells of context around each tile.', type=int,
+                        default=256)
+    parser.add_argument('--workers', help='The number of worker processes (defaults to the number of cpus).',
+                        type=int)
+    parser.add_argument('--cache_dir', help='A directory to cache flow direction and accumulation grids and '
+                                            'reprojected DEMs in for reuse by later runs on the same DEM.', type=str)
+    parser.add_argument('--cache_size', help='The maximum size of the cache in GB.', type=float, default=20.)
+    parser.add_argument('--incremental', help='Only recompute segments that changed since the last run.',
+                        action='store_true')
+    parser.add_argument('--scratch_dir', help='A local directory to hold the flow grids in memory-mapped files rather '
+                                              'than in memory, for DEMs larger than memory (always uses the '
+                                              'accumulation method).', type=str)
+    add_arguments(parser)
     args = parser.parse_args()
 
-    get_flow_scaling_factor(args.network, args.measurement_reach, args.dem, args.precipitation, args.reproject)
+    with instrumented(args.trace, args.profile, args.log_level):
+        get_flow_scaling_factor(args.network, args.measurement_reach, args.dem, args.precipitation, args.reproject,
+                                args.method, args.tile_size, args.tile_overlap, args.workers, args.cache_dir,
+                                args.cache_size, args.incremental, args.scratch_dir)
 
 
 if __name__ == '__main__':
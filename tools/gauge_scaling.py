@@ -0,0 +1,213 @@
+import argparse
+import logging
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from tools.flow_scaling import contributing_grids, reach_precip, segment_midpoint
+from tools.network_io import read_network, write_network
+from tools.warping import network_bounds
+from tools.incremental import raster_fingerprint, row_hashes, recompute
+from tools.telemetry import Progress, phase, add_arguments, instrumented
+
+log = logging.getLogger(__name__)
+
+
+def get_gauge_scaling_factors(network: str, gauges: str, dem: str, precip_raster: str, reproject: bool = False,
+                              method: str = 'catchment', tile_size: int = None, tile_overlap: int = 256,
+                              workers: int = None, cache_dir: str = None, cache_size: float = 20.,
+                              incremental: bool = False, reach_field: str = 'reach_id', gauge_field: str = 'gauge_id'):
+    """
+
+    :param network: path to a segment stream network layer
+    :param gauges: path to a csv table of gauges with a column of the reach id (e.g. fid) each gauge's discharge
+    record applies to and a column of gauge ids
+    :param dem: path to a 10m DEM. This should not be LiDAR if available
+    :param precip_raster: path to a precipitation raster (e.g., PRISM)
+    :param reproject: if True, rasters are reprojected to match the drainage network crs if needed
+    :param method: 'catchment' or 'accumulation' (see get_flow_scaling_factor)
+    :param tile_size: if given, flow directions are computed in tiles of this many cells on a process pool
+    :param tile_overlap: the number of cells of context around each tile
+    :param workers: the number of worker processes (see get_flow_scaling_factor)
+    :param cache_dir: if given, flow direction and accumulation grids are cached in this directory
+    :param cache_size: the maximum size of the cache in GB
+    :param incremental: if True, only segments whose geometry (or the rasters or gauges) changed since the last run
+    are recomputed
+    :param reach_field: the column of the gauge table holding reach ids
+    :param gauge_field: the column of the gauge table holding gauge ids
+    :return: adds the fields 'flow_scale' and 'gauge_id' to the drainage network
+    """
+
+    gauge_reaches = read_gauges(gauges, reach_field, gauge_field)
+    with phase('read'):
+        dn = read_network(network)
+    changed = update_gauge_scale(dn, gauge_reaches, dem, precip_raster, reproject, method, tile_size, tile_overlap,
+                                 workers, cache_dir, cache_size, incremental)
+    if not changed.any():
+        return
+
+    with phase('write'):
+        write_network(dn, network, columns=['flow_scale', 'gauge_id', 'fs_hash'])
+
+
+def read_gauges(gauges: str, reach_field: str = 'reach_id', gauge_field: str = 'gauge_id'):
+    """
+    Reads a table of gauges
+    :param gauges: path to a csv table with a column of reach ids and a column of gauge ids
+    :param reach_field: the column holding reach ids
+    :param gauge_field: the column holding gauge ids (read as text, so ids with leading zeros are kept)
+    :return: dict of reach id to gauge id
+    """
+
+    table = pd.read_csv(gauges, dtype={gauge_field: str})
+    for field in (reach_field, gauge_field):
+        if field not in table.columns:
+            raise Exception(f'Gauge table has no column {field}')
+    if table[reach_field].duplicated().any():
+        raise Exception('Gauge table has more than one gauge on a reach')
+
+    return dict(zip(table[reach_field].astype(int), table[gauge_field]))
+
+
+def calc_gauge_scale(dn: gpd.GeoDataFrame, gauge_reaches: dict, dem: str, precip_raster: str,
+                     reproject: bool = False, method: str = 'catchment', tile_size: int = None,
+                     tile_overlap: int = 256, workers: int = None, cache_dir: str = None, cache_size: float = 20.,
+                     bounds=None):
+    """
+    Adds the fields 'flow_scale' and 'gauge_id' to a drainage network in memory: each reach is scaled relative to the
+    nearest gauge downstream of it, whose id is stored in 'gauge_id'. Reaches with no gauge downstream get no value.
+    The flow grids are computed once for all of the gauges. Parameters other than dn and gauge_reaches are as for
+    get_gauge_scaling_factors
+    :param dn: a segmented drainage network GeoDataFrame with a projected crs
+    :param gauge_reaches: dict of reach id to gauge id
+    :param bounds: the (left, bottom, right, top) area a reprojected DEM is needed for (defaults to that of dn with a
+    margin; see network_bounds)
+    :return: the network with the 'flow_scale' and 'gauge_id' fields
+    """
+
+    if method not in ('catchment', 'accumulation'):
+        raise Exception(f'Unknown flow scaling method: {method}')
+    if dn.crs.is_projected is False:
+        raise Exception('Input drainage network should have a projected CRS')
+    check_gauge_reaches(dn, gauge_reaches)
+
+    bounds = network_bounds(dn.geometry) if bounds is None else bounds
+    points = [segment_midpoint(geom) for geom in dn.geometry]
+    grids = contributing_grids(dn.crs, dem, reproject, points, bounds, tile_size, tile_overlap, workers, cache_dir,
+                               cache_size)
+    with grids as (dem, grid, fdir, acc, shared, snapped):
+        cells = np.array([grid.nearest_cell(x, y)[::-1] for x, y in snapped]).reshape(-1, 2)
+
+        with phase('gauge catchments'):
+            label = gauge_labels(grid, fdir, acc, [snapped[dn.index.get_loc(reach)] for reach in gauge_reaches])
+        governing = label[cells[:, 0], cells[:, 1]]
+
+        precip = reach_precip(grid, fdir, dem, precip_raster, dn.crs, reproject, method, snapped, workers, shared)
+    gauge_precip = precip[[dn.index.get_loc(reach) for reach in gauge_reaches]]
+    for (reach, gauge), value in zip(gauge_reaches.items(), gauge_precip):
+        log.info(f'gauge {gauge} (reach {reach}): reference precip = {value}')
+
+    gauge_ids = np.array(list(gauge_reaches.values()) + [None], dtype=object)
+    has_gauge = governing >= 0
+    dn['flow_scale'] = np.where(has_gauge, precip / gauge_precip[np.maximum(governing, 0)], np.nan)
+    dn['gauge_id'] = gauge_ids[np.where(has_gauge, governing, -1)]
+    log.info(f'{(~has_gauge).sum()} of {len(dn)} reaches have no gauge downstream')
+
+    return dn
+
+
+def check_gauge_reaches(dn: gpd.GeoDataFrame, gauge_reaches: dict):
+    """
+    Raises an exception if any gauge is on a reach that is not in the network
+    :param dn: a drainage network GeoDataFrame
+    :param gauge_reaches: dict of reach id to gauge id
+    :return:
+    """
+
+    missing = [reach for reach in gauge_reaches if reach not in dn.index]
+    if len(missing) > 0:
+        raise Exception(f'Gauge reaches not in the network: {", ".join(str(reach) for reach in missing)}')
+
+
+def gauge_labels(grid, fdir, acc, points: list):
+    """
+    Labels every cell of the grid with the nearest gauge downstream of it, by painting the gauge catchments from the
+    smallest up: catchments on a D8 grid are either nested or separate, so a cell is left with the smallest catchment
+    containing it, which belongs to the first gauge its flow reaches
+    :param grid: a pysheds Grid on the flow direction grid
+    :param fdir: flow direction Raster
+    :param acc: flow accumulation Raster, used to order the catchments by size
+    :param points: list of (x, y) coordinates of the gauges' stream cells (see snap_to_streams)
+    :return: int32 array of the position of the gauge in points for every cell, -1 where no gauge is downstream
+    """
+
+    label = np.full(grid.shape, -1, dtype=np.int32)
+    sizes = [float(acc[row, col]) for col, row in (grid.nearest_cell(x, y) for x, y in points)]
+    progress = Progress(len(points), 'gauge catchments', logger=log)
+    for g in np.argsort(sizes, kind='stable'):
+        catch = np.asarray(grid.catchment(x=points[g][0], y=points[g][1], fdir=fdir, xytype='coordinate'), dtype=bool)
+        label[catch & (label < 0)] = g
+        progress.update()
+    progress.close()
+
+    return label
+
+
+def update_gauge_scale(dn: gpd.GeoDataFrame, gauge_reaches: dict, dem: str, precip_raster: str,
+                       reproject: bool = False, method: str = 'catchment', tile_size: int = None,
+                       tile_overlap: int = 256, workers: int = None, cache_dir: str = None, cache_size: float = 20.,
+                       incremental: bool = False):
+    """
+    Adds the fields 'flow_scale' and 'gauge_id' to a drainage network in memory along with an 'fs_hash' field
+    identifying the geometry and inputs each value was calculated from. A change to any gauge changes every hash.
+    Parameters are as for calc_gauge_scale
+    :return: boolean array of the recomputed segments
+    """
+
+    check_gauge_reaches(dn, gauge_reaches)
+    gauges = sorted((int(reach), str(gauge), dn.loc[reach].geometry.wkb_hex) for reach, gauge in gauge_reaches.items())
+    hashes = row_hashes(dn.geometry, raster_fingerprint(dem), raster_fingerprint(precip_raster), str(gauges),
+                        reproject, method, 'gauges')
+
+    return recompute(dn, ['flow_scale', 'gauge_id'], 'fs_hash', hashes,
+                     lambda rows: calc_gauge_scale(rows, gauge_reaches, dem, precip_raster, reproject, method,
+                                                   tile_size, tile_overlap, workers, cache_dir, cache_size,
+                                                   network_bounds(dn.geometry)),
+                     incremental, include=list(gauge_reaches))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('network', help='Path to a segmented stream network layer.', type=str)
+    parser.add_argument('gauges', help='Path to a csv table of gauges with a column of the reach ID (e.g., fid) each '
+                                       'discharge record applies to and a column of gauge IDs.', type=str)
+    parser.add_argument('dem', help='Path to a 10m DEM. This should be coarse, not LiDAR.', type=str)
+    parser.add_argument('precipitation', help='Path to a precipitation raster (e.g., PRISM).', type=str)
+    parser.add_argument('--reach_field', help='The gauge table column of reach IDs.', type=str, default='reach_id')
+    parser.add_argument('--gauge_field', help='The gauge table column of gauge IDs.', type=str, default='gauge_id')
+    parser.add_argument('--reproject', help='Reproject the rasters to match the drainage network crs if needed.',
+                        action='store_true')
+    parser.add_argument('--method', help='catchment: delineate the catchment of every reach (slow); accumulation: '
+                                         'use a single precipitation-weighted flow accumulation (fast)',
+                        type=str, choices=['catchment', 'accumulation'], default='catchment')
+    parser.add_argument('--tile_size', help='If given, compute flow directions in tiles of this many cells on a '
+                                            'process pool.', type=int)
+    parser.add_argument('--tile_overlap', help='The number of cells of context around each tile.', type=int,
+                        default=256)
+    parser.add_argument('--workers', help='The number of worker processes (defaults to the number of cpus).',
+                        type=int)
+    parser.add_argument('--cache_dir', help='A directory to cache flow direction and accumulation grids and '
+                                            'reprojected DEMs in for reuse by later runs on the same DEM.', type=str)
+    parser.add_argument('--cache_size', help='The maximum size of the cache in GB.', type=float, default=20.)
+    parser.add_argument('--incremental', help='Only recompute segments that changed since the last run.',
+                        action='store_true')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrumented(args.trace, args.profile, args.log_level):
+        get_gauge_scaling_factors(args.network, args.gauges, args.dem, args.precipitation, args.reproject,
+                                  args.method, args.tile_size, args.tile_overlap, args.workers, args.cache_dir,
+                                  args.cache_size, args.incremental, args.reach_field, args.gauge_field)
+
+
+if __name__ == '__main__':
+    main()
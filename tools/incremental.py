@@ -0,0 +1,100 @@
+import hashlib
+import logging
+import os
+import numpy as np
+import rasterio
+
+log = logging.getLogger(__name__)
+
+
+def raster_fingerprint(raster: str):
+    """
+    A cheap fingerprint of a raster that changes when any of its files change. It is built from the names, sizes and
+    modification times of the files (including the sources of a VRT) rather than their contents, so it is fast even
+    for very large mosaics
+    :param raster: path to a raster
+    :return: a hex string
+    """
+
+    with rasterio.open(raster) as src:
+        files = src.files or [raster]
+
+    h = hashlib.blake2b(digest_size=8)
+    for f in sorted(os.path.abspath(f) for f in files):
+        stat = os.stat(f)
+        h.update(f'{f}|{stat.st_size}|{stat.st_mtime_ns}'.encode())
+
+    return h.hexdigest()
+
+
+def row_hashes(geoms, *inputs, per_row=None):
+    """
+    A hash of every segment's geometry combined with the inputs a tool used on it, so that a segment needs
+    recomputing whenever its hash differs from the one stored with the tool's output
+    :param geoms: an iterable of geometries, or None to hash only the per_row values
+    :param inputs: raster fingerprints and parameters that change the tool's output
+    :param per_row: an optional iterable of further values, one per segment, to include in each hash
+    :return: an object array of 16 character hex strings
+    """
+
+    # numbers are hashed as floats so that e.g. a search distance of 15 and 15.0 give the same hashes
+    salt = '|'.join(repr(float(i)) if isinstance(i, (int, float, np.number)) and not isinstance(i, bool) else str(i)
+                    for i in inputs).encode()
+    if per_row is None:
+        return np.array([hashlib.blake2b(geom.wkb + salt, digest_size=8).hexdigest() for geom in geoms],
+                        dtype=object)
+    if geoms is None:
+        return np.array([hashlib.blake2b(salt + str(extra).encode(), digest_size=8).hexdigest() for extra in per_row],
+                        dtype=object)
+
+    return np.array([hashlib.blake2b(geom.wkb + salt + str(extra).encode(), digest_size=8).hexdigest()
+                     for geom, extra in zip(geoms, per_row)], dtype=object)
+
+
+def changed_rows(flowlines, columns: list, hash_col: str, hashes, incremental: bool = False):
+    """
+    Finds the segments whose stored hash differs from their current one
+    :param flowlines: a drainage network GeoDataFrame
+    :param columns: the output columns of the tool
+    :param hash_col: the column the tool stores its row hashes in
+    :param hashes: array of current row hashes
+    :param incremental: if False (or the network has no stored output) every segment is treated as changed
+    :return: boolean array of changed segments
+    """
+
+    if not incremental or any(col not in flowlines.columns for col in columns + [hash_col]):
+        return np.ones(len(flowlines), dtype=bool)
+
+    return flowlines[hash_col].values != hashes
+
+
+def recompute(flowlines, columns: list, hash_col: str, hashes, calc, incremental: bool = False, include=None):
+    """
+    Runs a tool's calculation on only the segments whose stored hash differs from their current one, then stores
+    the current hashes
+    :param flowlines: a drainage network GeoDataFrame (updated in place)
+    :param columns: the output columns of the tool
+    :param hash_col: the column to store the row hashes in (10 characters or fewer for shapefiles)
+    :param hashes: array of current row hashes
+    :param calc: a function of a GeoDataFrame of segments that adds the output columns to it and returns it
+    :param incremental: if False every segment is recomputed
+    :param include: optional index labels that are always passed to calc along with the changed segments (e.g., a
+    reference reach)
+    :return: boolean array of the recomputed segments
+    """
+
+    changed = changed_rows(flowlines, columns, hash_col, hashes, incremental)
+
+    if changed.all():
+        calc(flowlines)
+    elif changed.any():
+        rows = changed | flowlines.index.isin(include if include is not None else [])
+        sub = calc(flowlines[rows].copy())
+        for col in columns:
+            flowlines.loc[sub.index, col] = sub[col]
+    flowlines[hash_col] = hashes
+
+    if incremental:
+        log.info(f'recomputed {changed.sum()} of {len(flowlines)} segments')
+
+    return changed
@@ -0,0 +1,232 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+from tools.raster_sampling import line_endpoints
+
+
+class NetworkGraph:
+    """
+    A drainage network held as arrays: each segment joins two nodes (unique end point coordinates) and has an
+    orientation flag that says whether it flows against its geometry. Segments are referred to by their position in
+    the network; ids holds the network index labels. Connected segments are found through a CSR index of the segment
+    ends at every node, so flipping a segment only changes its flag.
+    """
+
+    def __init__(self, ids, node_xy, start_node, end_node, length=None, start_elev=None, end_elev=None,
+                 flipped=None):
+        """
+
+        :param ids: the network index labels of the segments
+        :param node_xy: (m, 2) array of node coordinates
+        :param start_node: array of the node at the first vertex of each segment's geometry
+        :param end_node: array of the node at the last vertex of each segment's geometry
+        :param length: optional array of segment lengths
+        :param start_elev: optional array of elevations at the first vertex of each segment
+        :param end_elev: optional array of elevations at the last vertex of each segment
+        :param flipped: optional boolean array, True where a segment flows from its last vertex to its first
+        """
+
+        n = len(start_node)
+        self.ids = np.asarray(ids)
+        self.index = pd.Index(self.ids)
+        self.node_xy = np.asarray(node_xy, dtype=np.float64)
+        self.start_node = np.asarray(start_node, dtype=np.int64)
+        self.end_node = np.asarray(end_node, dtype=np.int64)
+        self.length = np.full(n, np.nan) if length is None else np.asarray(length, dtype=np.float64)
+        self.start_elev = np.full(n, np.nan) if start_elev is None else np.asarray(start_elev, dtype=np.float64)
+        self.end_elev = np.full(n, np.nan) if end_elev is None else np.asarray(end_elev, dtype=np.float64)
+        self.flipped = np.zeros(n, dtype=bool) if flipped is None else np.array(flipped, dtype=bool)
+
+        # the two ends of every segment, grouped by node and ordered by segment position within a node
+        seg = np.concatenate([np.arange(n), np.arange(n)])
+        end = np.concatenate([np.zeros(n, dtype=np.int8), np.ones(n, dtype=np.int8)])
+        nodes = np.concatenate([self.start_node, self.end_node])
+        order = np.lexsort((end, seg, nodes))
+        self.end_seg = seg[order]
+        self.end_is_last = end[order].astype(bool)
+        self.node_ptr = np.zeros(len(self.node_xy) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(nodes, minlength=len(self.node_xy)), out=self.node_ptr[1:])
+
+    @classmethod
+    def from_network(cls, dn, start_elev=None, end_elev=None, tolerance: float = 0.):
+        """
+        Builds the graph of a drainage network GeoDataFrame. End points with exactly the same coordinates, or within
+        the tolerance of each other, are the same node. Segment orientation is read from a 'topo_flip' field if the
+        network has one
+        :param dn: a drainage network GeoDataFrame of LineStrings
+        :param start_elev: optional array of elevations at the first vertex of each segment
+        :param end_elev: optional array of elevations at the last vertex of each segment
+        :param tolerance: the distance within which end points are merged (see merge_points)
+        :return: a NetworkGraph
+        """
+
+        sx, sy, ex, ey = line_endpoints(dn.geometry)
+        flipped = dn['topo_flip'].values == 1 if 'topo_flip' in dn.columns else None
+
+        return cls.from_endpoints(dn.index.values, sx, sy, ex, ey, dn.geometry.length.values, start_elev, end_elev,
+                                  tolerance, flipped)
+
+    @classmethod
+    def from_endpoints(cls, ids, sx, sy, ex, ey, length=None, start_elev=None, end_elev=None, tolerance: float = 0.,
+                       flipped=None):
+        """
+        Builds the graph of a drainage network from the end points of its segments, e.g. gathered from the
+        partitions of a network too large to hold whole. End points are merged into nodes as in from_network
+        :param ids: the network index labels of the segments
+        :param sx: array of the x coordinate of the first vertex of each segment
+        :param sy: array of the y coordinate of the first vertex of each segment
+        :param ex: array of the x coordinate of the last vertex of each segment
+        :param ey: array of the y coordinate of the last vertex of each segment
+        :param length: optional array of segment lengths
+        :param start_elev: optional array of elevations at the first vertex of each segment
+        :param end_elev: optional array of elevations at the last vertex of each segment
+        :param tolerance: the distance within which end points are merged (see merge_points)
+        :param flipped: optional boolean array, True where a segment flows from its last vertex to its first
+        :return: a NetworkGraph
+        """
+
+        n = len(sx)
+        xy = np.concatenate([np.column_stack([sx, sy]), np.column_stack([ex, ey])]).reshape(-1, 2)
+        node_xy, inverse = merge_points(xy, tolerance)
+
+        return cls(ids, node_xy, inverse[:n], inverse[n:], length, start_elev, end_elev, flipped)
+
+    def __len__(self):
+        return len(self.start_node)
+
+    @property
+    def us_node(self):
+        """
+        :return: array of the upstream node of every segment, given the current orientation
+        """
+
+        return np.where(self.flipped, self.end_node, self.start_node)
+
+    @property
+    def ds_node(self):
+        """
+        :return: array of the downstream node of every segment, given the current orientation
+        """
+
+        return np.where(self.flipped, self.start_node, self.end_node)
+
+    def position(self, segid):
+        """
+        :param segid: a network index label
+        :return: the position of the segment in the graph
+        """
+
+        return self.index.get_loc(segid)
+
+    def degree(self):
+        """
+        :return: array of the number of segment ends at every node
+        """
+
+        return np.diff(self.node_ptr)
+
+    def flip(self, seg: int):
+        """
+        Reverses the direction a segment flows
+        :param seg: segment position
+        :return:
+        """
+
+        self.flipped[seg] = not self.flipped[seg]
+
+    def starting_at(self, node: int):
+        """
+        :param node: a node number
+        :return: array of the positions of segments flowing out of the node, in position order
+        """
+
+        sl = slice(self.node_ptr[node], self.node_ptr[node + 1])
+        segs = self.end_seg[sl]
+
+        return segs[self.end_is_last[sl] == self.flipped[segs]]
+
+    def ending_at(self, node: int):
+        """
+        :param node: a node number
+        :return: array of the positions of segments flowing into the node, in position order
+        """
+
+        sl = slice(self.node_ptr[node], self.node_ptr[node + 1])
+        segs = self.end_seg[sl]
+
+        return segs[self.end_is_last[sl] != self.flipped[segs]]
+
+    def downstream(self, seg: int):
+        """
+        :param seg: segment position
+        :return: array of the positions of the segments that flow out of the segment's downstream node
+        """
+
+        return self.starting_at(self.end_node[seg] if not self.flipped[seg] else self.start_node[seg])
+
+    def upstream(self, seg: int):
+        """
+        :param seg: segment position
+        :return: array of the positions of the segments that flow into the segment's upstream node
+        """
+
+        return self.ending_at(self.start_node[seg] if not self.flipped[seg] else self.end_node[seg])
+
+    def downstream_csr(self):
+        """
+        The downstream adjacency of every segment given the current orientation, in compressed sparse row form: the
+        segments downstream of segment i are indices[indptr[i]:indptr[i+1]], in position order
+        :return: arrays indptr and indices
+        """
+
+        return _adjacency(self.ds_node, self.us_node, len(self.node_xy))
+
+    def upstream_csr(self):
+        """
+        The upstream adjacency of every segment given the current orientation, in compressed sparse row form: the
+        segments upstream of segment i are indices[indptr[i]:indptr[i+1]], in position order
+        :return: arrays indptr and indices
+        """
+
+        return _adjacency(self.us_node, self.ds_node, len(self.node_xy))
+
+
+def merge_points(xy, tolerance: float = 0.):
+    """
+    Groups points into nodes. Points closer together than the tolerance (found with a KD-tree) are the same node, as
+    are chains of such points, so small gaps where digitised lines should meet are closed
+    :param xy: (n, 2) array of point coordinates
+    :param tolerance: the distance within which points are merged; 0 merges only identical points
+    :return: (m, 2) array of node coordinates (the mean of their points) and the node of every point
+    """
+
+    xy = np.asarray(xy, dtype=np.float64)
+    if tolerance <= 0:
+        node_xy, inverse = np.unique(xy, axis=0, return_inverse=True)
+        return node_xy, inverse.ravel()
+
+    pairs = cKDTree(xy).query_pairs(tolerance, output_type='ndarray')
+    links = coo_matrix((np.ones(len(pairs), dtype=bool), (pairs[:, 0], pairs[:, 1])), shape=(len(xy), len(xy)))
+    n_nodes, inverse = connected_components(links, directed=False)
+    counts = np.bincount(inverse, minlength=n_nodes)
+    node_xy = np.column_stack([np.bincount(inverse, weights=xy[:, 0], minlength=n_nodes) / counts,
+                               np.bincount(inverse, weights=xy[:, 1], minlength=n_nodes) / counts])
+
+    return node_xy, inverse
+
+
+def _adjacency(from_node, to_node, n_nodes: int):
+    # segments are linked from segment i to every segment j with to_node[j] == from_node[i]
+    by_node = np.argsort(to_node, kind='stable')
+    node_ptr = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(to_node, minlength=n_nodes), out=node_ptr[1:])
+
+    counts = node_ptr[from_node + 1] - node_ptr[from_node]
+    indptr = np.zeros(len(from_node) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    offsets = np.arange(indptr[-1]) - np.repeat(indptr[:-1], counts)
+    indices = by_node[np.repeat(node_ptr[from_node], counts) + offsets]
+
+    return indptr, indices
@@ -0,0 +1,177 @@
+import os
+import pandas as pd
+import geopandas as gpd
+
+PARQUET_EXTENSIONS = ('.parquet', '.geoparquet')
+FLATGEOBUF_EXTENSIONS = ('.fgb',)
+
+
+def is_parquet(path: str):
+    return os.path.splitext(path)[1].lower() in PARQUET_EXTENSIONS
+
+
+def read_network(path: str, columns: list = None):
+    """
+    Reads a drainage network layer. The format is chosen by file extension: GeoParquet (.parquet, .geoparquet),
+    FlatGeobuf (.fgb) or anything else fiona can read (e.g., shapefiles)
+    :param path: path to the network layer
+    :param columns: optional list of attribute columns to read (GeoParquet only; the geometry is always read)
+    :return: a GeoDataFrame
+    """
+
+    if is_parquet(path):
+        if columns is not None and 'geometry' not in columns:
+            columns = list(columns) + ['geometry']
+        return gpd.read_parquet(path, columns=columns)
+    if os.path.splitext(path)[1].lower() in FLATGEOBUF_EXTENSIONS:
+        return gpd.read_file(path, driver='FlatGeobuf')
+
+    return gpd.read_file(path)
+
+
+def write_network(gdf: gpd.GeoDataFrame, path: str, columns: list = None):
+    """
+    Writes a drainage network layer, choosing the format by file extension as in read_network. When writing
+    GeoParquet with a list of columns and the file already holds the same rows, only those columns are appended or
+    replaced; the existing geometry column is copied as stored rather than re-encoded
+    :param gdf: the network GeoDataFrame
+    :param path: path to write to
+    :param columns: optional list of attribute columns that changed (the geometry must not have changed)
+    :return:
+    """
+
+    if is_parquet(path):
+        if columns is not None and os.path.exists(path):
+            if update_parquet_columns(gdf, path, columns):
+                return
+        gdf.to_parquet(path)
+    elif os.path.splitext(path)[1].lower() in FLATGEOBUF_EXTENSIONS:
+        # GDAL's packed spatial index reorders features, and feature order is the network's ids
+        gdf.to_file(path, driver='FlatGeobuf', SPATIAL_INDEX='NO')
+    else:
+        gdf.to_file(path)
+
+
+def update_parquet_columns(gdf: gpd.GeoDataFrame, path: str, columns: list):
+    """
+    Appends or replaces attribute columns of an existing GeoParquet file without decoding its geometry
+    :param gdf: a GeoDataFrame holding the same rows, in the same order, as the file
+    :param path: path to the GeoParquet file
+    :param columns: the columns of gdf to write
+    :return: True if the file was updated, False if the file has a different number of rows
+    """
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(path)
+    if table.num_rows != len(gdf):
+        return False
+
+    for col in columns:
+        values = pa.Array.from_pandas(gdf[col])
+        if col in table.column_names:
+            table = table.set_column(table.column_names.index(col), col, values)
+        else:
+            table = table.append_column(col, values)
+
+    tmp = path + '.tmp'
+    pq.write_table(table, tmp)
+    os.replace(tmp, path)
+
+    return True
+
+
+def stream_parquet_columns(path: str, func, chunk_size: int):
+    """
+    Streams a GeoParquet network through a function in chunks of rows, writing the columns it returns beside the
+    existing ones, so only one chunk of the network is held in memory at a time. The geometry column is copied as
+    stored.
+    :param path: path to the GeoParquet file (updated in place)
+    :param func: a function of a chunk's GeoSeries returning a dict of column name to array of values
+    :param chunk_size: the number of rows per chunk
+    :return:
+    """
+
+    import json
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    pf = pq.ParquetFile(path)
+    metadata = pf.schema_arrow.metadata
+    geom_col = json.loads(metadata[b'geo'])['primary_column']
+    crs = parquet_crs(path)
+
+    tmp = path + '.tmp'
+    writer = None
+    try:
+        for batch in pf.iter_batches(batch_size=chunk_size):
+            geoms = gpd.GeoSeries.from_wkb(batch.column(geom_col).to_numpy(zero_copy_only=False), crs=crs)
+            table = pa.Table.from_batches([batch])
+            for col, values in func(geoms).items():
+                values = pa.array(values)
+                if col in table.column_names:
+                    table = table.set_column(table.column_names.index(col), col, values)
+                else:
+                    table = table.append_column(col, values)
+            if writer is None:
+                writer = pq.ParquetWriter(tmp, table.schema.with_metadata(metadata))
+            writer.write_table(table.replace_schema_metadata(metadata))
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if writer is not None:
+        os.replace(tmp, path)
+
+
+def read_row_groups(path: str, row_groups: list, first_row: int = 0):
+    """
+    Reads some of the row groups of a GeoParquet file, keeping the network's ids: an index stored as a column is read
+    with the rows, and a range index (which is only stored as its start and step) is numbered from the position of
+    the first row read
+    :param path: path to the GeoParquet file
+    :param row_groups: the row groups to read, in order (empty to read only the schema)
+    :param first_row: the position in the file of the first row of the first row group read
+    :return: a GeoDataFrame
+    """
+
+    import json
+    import pyarrow.parquet as pq
+
+    pf = pq.ParquetFile(path)
+    metadata = pf.schema_arrow.metadata
+    geom_col = json.loads(metadata[b'geo'])['primary_column']
+    table = pf.read_row_groups(row_groups, use_pandas_metadata=True) if row_groups else \
+        pf.schema_arrow.empty_table()
+
+    df = table.drop([geom_col]).to_pandas()
+    index = json.loads(metadata[b'pandas'])['index_columns'] if b'pandas' in metadata else []
+    if len(index) == 1 and isinstance(index[0], dict) and index[0]['kind'] == 'range':
+        start, step = index[0]['start'], index[0]['step']
+        df.index = pd.RangeIndex(start + step * first_row, start + step * (first_row + len(df)), step,
+                                 name=index[0]['name'])
+    geoms = gpd.GeoSeries.from_wkb(table.column(geom_col).to_numpy(zero_copy_only=False), index=df.index,
+                                   crs=parquet_crs(path))
+    df[geom_col] = geoms
+
+    return gpd.GeoDataFrame(df[[c for c in table.column_names if c in df.columns]], geometry=geom_col)
+
+
+def parquet_crs(path: str):
+    """
+    Reads the crs of a GeoParquet network's geometry column without reading the data
+    :param path: path to the GeoParquet file
+    :return: a pyproj CRS, or None
+    """
+
+    import json
+    import pyarrow.parquet as pq
+    from pyproj import CRS
+
+    geo = json.loads(pq.read_schema(path).metadata[b'geo'])
+    crs = geo['columns'][geo['primary_column']].get('crs')
+    if crs is None:
+        return None
+
+    return CRS.from_json_dict(crs) if isinstance(crs, dict) else CRS.from_user_input(crs)
@@ -1,255 +1,400 @@
 import argparse
+import logging
 import math
+from collections import deque
+import numpy as np
 import rasterio
 import geopandas as gpd
-from shapely.geometry import Point
-from rasterstats import zonal_stats
+from tools.raster_sampling import line_endpoints, endpoint_elevations
+from tools.network_io import read_network, write_network
+from tools.incremental import raster_fingerprint, row_hashes, changed_rows
+from tools.network_graph import NetworkGraph, merge_points
+from tools.telemetry import Progress, phase, add_arguments, instrumented
 
+log = logging.getLogger(__name__)
 
-def network_topology(in_network: str, first_feature: int, dem:str):
+TOPOLOGY_FIELDS = ('rid', 'rid_ds', 'rid_us', 'rid_us2')
+
+
+def network_topology(in_network: str, first_feature: int, dem:str, incremental: bool = False, tolerance: float = 0.):
     """
 
     :param in_network: path to a segmented drainage network layer
     :param first_feature: the feature ID (e.g., fid) to start with (upstream-most feature)
     :param dem: path to a dem
+    :param incremental: if True, only the chains containing segments that changed since the last run, and the chains
+    that meet them, are relabelled
+    :param tolerance: the distance within which segment end points are treated as meeting (0 requires identical
+    coordinates)
     :return:
     """
 
-    features = {}
-    topochains = {}
+    with phase('read'):
+        dn = read_network(in_network)
+    changed = update_topology(dn, first_feature, dem, incremental, tolerance=tolerance)
+    if not changed.any():
+        return
+
+    with phase('write'):
+        write_network(dn, in_network, columns=list(TOPOLOGY_FIELDS) + ['topo_flip', 'topo_hash'])
+
+
+def calc_topology(dn: gpd.GeoDataFrame, first_feature: int, dem: str, samples: dict = None, tolerance: float = 0.):
+    """
+    Adds the fields 'rid', 'rid_ds', 'rid_us' and 'rid_us2' to a drainage network in memory
+    :param dn: a segmented drainage network GeoDataFrame
+    :param first_feature: the feature ID (e.g., fid) to start with (upstream-most feature)
+    :param dem: path to a dem
+    :param samples: an optional dict for reusing elevations sampled by other tools on the same network
+    :param tolerance: the distance within which segment end points are treated as meeting (0 requires identical
+    coordinates)
+    :return: the network with the topology fields
+    """
+
+    # sample the minimum elevation around every segment end point in a single pass over the dem
+    with phase('sampling'):
+        start_elevs, end_elevs = endpoint_elevations(dn.geometry, dem, topology_radius(dem), samples)
+
+    # segments start out flowing the way they are drawn, whatever direction an earlier run found
+    graph = NetworkGraph.from_network(dn, start_elevs, end_elevs, tolerance)
+    graph.flipped[:] = False
+    for field, values in zip(TOPOLOGY_FIELDS, label_topology(graph, first_feature)):
+        dn[field] = values
+    # the direction each segment was found to flow relative to its geometry, so the topology can be updated later
+    dn['topo_flip'] = graph.flipped.astype(int)
+
+    return dn
+
+
+def topology_radius(dem: str):
+    """
+    :param dem: path to a dem
+    :return: the distance around segment end points searched for their elevation (four dem cells)
+    """
 
     with rasterio.open(dem) as src:
         if not src.crs.is_projected:
             raise Exception('DEM does not have a projected coordinate system')
         resolution = abs(src.transform[0])
 
-    dn = gpd.read_file(in_network)
-    count = 1
-    for i in dn.index:
-        print(f'Adding feature {count} of {len(dn)} to dictionary')
-        geom = dn.loc[i].geometry
-        s_coords = [geom.coords.xy[0][0], geom.coords.xy[1][0]]
-        e_coords = [geom.coords.xy[0][-1], geom.coords.xy[1][-1]]
-        spt = Point(s_coords[0], s_coords[1]).buffer(resolution*4)
-        ept = Point(e_coords[0], e_coords[1]).buffer(resolution*4)
-        s_elev = zonal_stats(spt, dem)[0].get('min')
-        e_elev = zonal_stats(ept, dem)[0].get('min')
-
-        features[i] = {
-            'start_coords': s_coords,
-            'end_coords': e_coords,
-            'start_elev': s_elev,
-            'end_elev': e_elev,
-            'length': geom.length
-        }
-        count += 1
+    return resolution*4
+
+
+def label_topology(graph: NetworkGraph, first_feature: int):
+    """
+    Walks a drainage network's graph from the first feature, chain by chain, orienting the segments in the direction
+    of flow (graph.flipped is updated in place) and numbering them
+    :param graph: a NetworkGraph with end point elevations
+    :param first_feature: the feature ID (e.g., fid) to start with (upstream-most feature)
+    :return: arrays of rid, rid_ds, rid_us and rid_us2 in graph position order
+    """
+
+    ids = graph.ids
 
     # get a list of all network chain start segments
-    startcoords = [attrs['start_coords'] for seg, attrs in features.items()]
-    endcoords = [attrs['end_coords'] for seg, attrs in features.items()]
-    allcoords = startcoords + endcoords
-    ff_coords = [x for x in allcoords if allcoords.count(x) == 1]
-    s_ff_segs = [seg for seg, attrs in features.items() if attrs['start_coords'] in ff_coords]
-    e_ff_segs = [seg for seg, attrs in features.items() if attrs['end_coords'] in ff_coords]
-    minel = 1000000
-    minseg = None
-    for seg in e_ff_segs:
-        if features[seg]['end_elev'] < minel:
-            minel = features[seg]['end_elev']
-            minseg = seg
-    sminel = 1000000
-    sminseg = None
-    for seg in s_ff_segs:
-        if features[seg]['start_elev'] < sminel:
-            sminel = features[seg]['start_elev']
-            sminseg = seg
-    if features[minseg]['end_elev'] < features[sminseg]['start_elev']:
-        e_ff_segs.remove(minseg)
+    degree = graph.degree()
+    s_ff_segs = np.flatnonzero(degree[graph.start_node] == 1)
+    e_ff_segs = np.flatnonzero(degree[graph.end_node] == 1)
+    minseg = lowest(graph.end_elev, e_ff_segs)
+    sminseg = lowest(graph.start_elev, s_ff_segs)
+    if minseg is None or sminseg is None:
+        raise KeyError('the network has no dangling segments to start from')
+    if graph.end_elev[minseg] < graph.start_elev[sminseg]:
+        e_ff_segs = e_ff_segs[e_ff_segs != minseg]
     else:
-        s_ff_segs.remove(sminseg)
-    starting_segs = s_ff_segs+e_ff_segs
-    starting_segs.remove(first_feature)
+        s_ff_segs = s_ff_segs[s_ff_segs != sminseg]
+    starting_segs = list(s_ff_segs) + list(e_ff_segs)
+    ff = graph.position(first_feature)
+    if ff not in starting_segs:
+        raise ValueError(f'feature {first_feature} is not at the upstream end of a chain')
+    starting_segs.remove(ff)
+    starting_segs = deque(starting_segs)
 
-    ff = first_feature
-    tot_links = [ff]
+    visited = np.zeros(len(graph), dtype=bool)
+    visited[ff] = True
+    topochains = []
+    heads = [ff]
 
     # find links in each chain
-    chain = 1
-    while chain:
-        chain_len = features[ff]['length']
-        links = [ff]
-        seg = features[ff]
-        while seg:
-            dsseg = None
-            candidates = []
-            for segid, attrs in features.items():
-                if attrs['start_coords'] == seg['end_coords']:
-                    # put list of possible segs then preferentially choose the one that end elev < start elev.
-                    if segid not in tot_links:
-                        candidates.append([segid, 0])
-
-                if attrs['end_coords'] == seg['end_coords']:
-                    # if attrs['end_elev']+(.01*dn.loc[segid].geometry.length) > attrs['start_elev']:  # janky fix to flatter reaches
-                    if segid not in tot_links:
-                        candidates.append([segid, 1])
-
-            if len(candidates) == 1:  # if there's only one option for downstream segments
-                if candidates[0][0] not in tot_links:
-                    links.append(candidates[0][0])
-                    chain_len += features[candidates[0][0]]['length']
-                    tot_links.append(candidates[0][0])
-                    print(f'Adding segment {candidates[0][0]} to chain')
-                    if candidates[0][1] == 1:
-                        tmp_st = features[candidates[0][0]]['end_coords']
-                        tmp_end = features[candidates[0][0]]['start_coords']
-                        features[candidates[0][0]]['start_coords'] = tmp_st
-                        features[candidates[0][0]]['end_coords'] = tmp_end
-                    seg = features[candidates[0][0]]
-                    dsseg = seg
-            if len(candidates) > 1:  # if there's more than one option for downstream segments
-                minel = 100000
-                candid = None
-                for id, status in candidates:
-                    if min(features[id]['start_elev'], features[id]['end_elev']) < minel:
-                        minel = min(features[id]['start_elev'], features[id]['end_elev'])
-                        candid = id
-                        stat = status
-                if candid:
-                    if stat == 1:
-                        tmp_st = features[candid]['end_coords']
-                        tmp_end = features[candid]['start_coords']
-                        features[candid]['start_coords'] = tmp_st
-                        features[candid]['end_coords'] = tmp_end
+    progress = Progress(len(graph), 'segments walked', logger=log)
+    progress.update()
+    with phase('topology walk'):
+        chain = True
+        while chain:
+            chain_len = float(graph.length[ff])
+            links = [ff]
+            seg = ff
+            while seg is not None:
+                dsseg = None
+                # put list of possible segs then preferentially choose the one that end elev < start elev.
+                node = graph.end_node[seg] if not graph.flipped[seg] else graph.start_node[seg]
+                candidates = sorted([(s, 0) for s in graph.starting_at(node) if not visited[s]] +
+                                    [(s, 1) for s in graph.ending_at(node) if not visited[s]])
+
+                if len(candidates) == 1:  # if there's only one option for downstream segments
+                    candid, stat = candidates[0]
                     links.append(candid)
-                    tot_links.append(candid)
-                    seg = features[candid]
-                    dsseg = seg
-
-            if dsseg is None:
-                # check that the end point isn't actually the start
-                for segid, attrs in features.items():
-                    if attrs['end_coords'] == seg['start_coords']:
-                        if segid not in tot_links:
-                            links.append(segid)
-                            chain_len += attrs['length']
-                            tot_links.append(segid)
-                            print(f'Adding segment {segid} to chain')
-                            tmp_st = attrs['end_coords']
-                            tmp_end = attrs['start_coords']
-                            features[segid]['start_coords'] = tmp_st
-                            features[segid]['end_coords'] = tmp_end
-                            seg = features[segid]
-                            dsseg = seg
-            if dsseg is None:
-                seg = None
-                topochains[chain] = {'segids': links, 'length': chain_len}
-                if len(starting_segs) > 0:
-                    chain += 1
-                    ff = starting_segs[0]
-                    starting_segs.remove(ff)
-                    tot_links.append(ff)
-                else:
-                    chain = None
-
-    # get the attributes for each network segment
-    maxlen = 0
-    chain_sel = None
-    chain_lab = 1
-    for chainid, att in topochains.items():
-        if att['length'] > maxlen:
-            maxlen = att['length']
-            chain_sel = chainid
-    while chain_sel:
-        denom = 10**(magnitude_order(len(topochains[chain_sel]['segids']))+1)
-        if len(topochains[chain_sel]['segids']) == 1:
-            for i, id in enumerate(topochains[chain_sel]['segids']):
-                features[id].update({
-                    'rid': chain_lab + (1/denom),
-                    'rid_ds': None,
-                    'rid_us': None,
-                    'rid_us2': None
-                })
-        elif len(topochains[chain_sel]['segids']) == 2:
-            for i, id in enumerate(topochains[chain_sel]['segids']):
-                if i == 0:
-                    features[id].update({
-                        'rid': chain_lab + (1 / denom),
-                        'rid_ds': chain_lab + (2 / denom),
-                        'rid_us': None,
-                        'rid_us2': None
-                    })
-                else:
-                    features[id].update({
-                        'rid': chain_lab + (2 / denom),
-                        'rid_ds': None,
-                        'rid_us': chain_lab + (1 / denom),
-                        'rid_us2': None
-                    })
-        else:
-            for i, id in enumerate(topochains[chain_sel]['segids']):
-                if i == 0:  # if it's the first link in the chain
-                    features[id].update({
-                        'rid': chain_lab + (1/denom),
-                        'rid_ds': chain_lab + (2/denom),
-                        'rid_us': None,
-                        'rid_us2': None
-                    })
-                elif i == len(topochains[chain_sel]['segids'])-1:  # if it's the last link in the chain
-                    features[id].update({
-                        'rid': chain_lab + ((i + 1) / denom),
-                        'rid_ds': None,
-                        'rid_us': chain_lab + (i / denom),
-                        'rid_us2': None
-                    })
-                else:  # if its any in between
-                    features[id].update({
-                        'rid': chain_lab + ((i+1)/denom),
-                        'rid_ds': chain_lab + ((i+2)/denom),
-                        'rid_us': chain_lab + (i/denom),
-                        'rid_us2': None
-                    })
-        del topochains[chain_sel]
-        if len(topochains) > 0:
-            maxlen = 0
-            chain_sel = None
-            for chainid, att in topochains.items():
-                if att['length'] > maxlen:
-                    maxlen = att['length']
-                    chain_sel = chainid
-            chain_lab += 1
+                    chain_len += float(graph.length[candid])
+                    visited[candid] = True
+                    progress.update()
+                    if stat == 1:
+                        graph.flip(candid)
+                    seg = dsseg = candid
+                if len(candidates) > 1:  # if there's more than one option for downstream segments
+                    minel = 100000
+                    candid = None
+                    for s, status in candidates:
+                        if min(graph.start_elev[s], graph.end_elev[s]) < minel:
+                            minel = min(graph.start_elev[s], graph.end_elev[s])
+                            candid = s
+                            stat = status
+                    if candid is not None:
+                        if stat == 1:
+                            graph.flip(candid)
+                        links.append(candid)
+                        visited[candid] = True
+                        progress.update()
+                        seg = dsseg = candid
+
+                if dsseg is None:
+                    # check that the end point isn't actually the start; flipping keeps the start node the same, so
+                    # every unvisited segment ending there is added in position order
+                    node = graph.start_node[seg] if not graph.flipped[seg] else graph.end_node[seg]
+                    for s in graph.ending_at(node):
+                        if not visited[s]:
+                            links.append(s)
+                            chain_len += float(graph.length[s])
+                            visited[s] = True
+                            progress.update()
+                            graph.flip(s)
+                            seg = dsseg = s
+                if dsseg is None:
+                    seg = None
+                    topochains.append((links, chain_len))
+                    if len(starting_segs) > 0:
+                        ff = starting_segs.popleft()
+                        # a chain can start at a segment an earlier chain already walked, which isn't counted again
+                        if not visited[ff]:
+                            visited[ff] = True
+                            heads.append(ff)
+                            progress.update()
+                    else:
+                        chain = False
+    progress.close()
+
+    # the walk leaves the first segment of each chain as it is drawn, so it is turned where the chain goes on from
+    # its upstream end, or where a chain of one segment flows towards a dangling end
+    heads = set(heads)
+    for links, _ in topochains:
+        seg = links[0]
+        if seg not in heads:
+            continue
+        ds_node, us_node = graph.end_node[seg], graph.start_node[seg]
+        if graph.flipped[seg]:
+            ds_node, us_node = us_node, ds_node
+        if len(links) > 1:
+            turn = ds_node not in (graph.start_node[links[1]], graph.end_node[links[1]])
         else:
-            chain_sel = None
+            turn = degree[ds_node] == 1 and degree[us_node] > 1
+        if turn:
+            graph.flip(seg)
+
+    # number the chains from longest to shortest; a segment's id is its chain number plus its position in the chain
+    # divided by the power of ten above the chain length
+    rid = np.full(len(graph), np.nan)
+    rid_ds = np.full(len(graph), np.nan)
+    rid_us = np.full(len(graph), np.nan)
+    for chain_lab, c in enumerate(sorted(range(len(topochains)), key=lambda c: -topochains[c][1]), start=1):
+        links = np.array(topochains[c][0])
+        denom = 10**(magnitude_order(len(links))+1)
+        pos = np.arange(1, len(links) + 1)
+        rid[links] = chain_lab + (pos/denom)
+        rid_ds[links] = np.where(pos < len(links), chain_lab + ((pos+1)/denom), np.nan)
+        rid_us[links] = np.where(pos > 1, chain_lab + ((pos-1)/denom), np.nan)
+    if np.isnan(rid).any():
+        raise KeyError(f'segment {ids[np.flatnonzero(np.isnan(rid))[0]]} was not reached from the first feature')
+    rid_us2 = np.full(len(graph), np.nan)
 
     # now deal with confluences
-    for segid, atts in features.items():
-        if atts['rid_ds'] is None:
-            ds_segs = []
-            for s, a in features.items():
-                if atts['end_coords'] == a['start_coords']:
-                    ds_segs.append(s)
-            if len(ds_segs) > 1:
-                print(f'warning: there are two reaches downstream of segment {segid}')
-            if len(ds_segs) != 0:  # if it's not the last segment
-                features[segid]['rid_ds'] = features[ds_segs[0]]['rid']
-        us_segs = []
-        for s, a in features.items():
-            if atts['start_coords'] == a['end_coords']:
-                us_segs.append(s)
-        if len(us_segs) > 2:
-            print(f'warning: there are more than two reaches upstream of segment {segid}')
-        if len(us_segs) == 2:
-            if features[segid]['rid_us'] == features[us_segs[0]]['rid']:
-                features[segid]['rid_us2'] = features[us_segs[1]]['rid']
-            else:
-                features[segid]['rid_us2'] = features[us_segs[0]]['rid']
-
-    for i in dn.index:
-        dn.loc[i, 'rid'] = features[i]['rid']
-        dn.loc[i, 'rid_ds'] = features[i]['rid_ds']
-        dn.loc[i, 'rid_us'] = features[i]['rid_us']
-        dn.loc[i, 'rid_us2'] = features[i]['rid_us2']
-
-    dn.to_file(in_network)
+    link_confluences(graph, rid, rid_ds, rid_us, rid_us2)
+
+    return rid, rid_ds, rid_us, rid_us2
+
+
+def lowest(elevs, segs):
+    """
+    The first of a set of segments with the lowest elevation (ignoring missing values and those of 1,000,000 or more)
+    :param elevs: array of elevations of every segment
+    :param segs: array of segment positions
+    :return: a segment position, or None
+    """
+
+    vals = elevs[segs]
+    valid = vals < 1000000
+    if not valid.any():
+        return None
+
+    return segs[valid][np.argmin(vals[valid])]
+
+
+def update_topology(dn: gpd.GeoDataFrame, first_feature: int, dem: str, incremental: bool = False,
+                    samples: dict = None, tolerance: float = 0.):
+    """
+    Adds the topology fields to a drainage network in memory along with a 'topo_hash' field identifying the end nodes
+    and inputs each segment was labelled from. In incremental mode, the chains containing changed segments and the
+    chains that meet them are walked again as a separate network and given back their old chain numbers (new chains
+    are numbered after the existing ones); the rest of the network keeps its labels. Parameters are as for
+    calc_topology
+    :param incremental: if True, only the chains affected by segments whose hash changed are relabelled
+    :return: boolean array of the relabelled segments
+    """
+
+    sx, sy, ex, ey = line_endpoints(dn.geometry)
+    n = len(sx)
+    node_xy, node = merge_points(np.column_stack([np.concatenate([sx, ex]), np.concatenate([sy, ey])]), tolerance)
+    hashes = topology_hashes(node_xy, node[:n], node[n:], dem, dn.geometry[first_feature], tolerance)
+    changed = changed_rows(dn, list(TOPOLOGY_FIELDS) + ['topo_flip'], 'topo_hash', hashes, incremental)
+
+    if changed.all():
+        calc_topology(dn, first_feature, dem, samples, tolerance)
+        dn['topo_hash'] = hashes
+        return changed
+    if not changed.any():
+        dn['topo_hash'] = hashes
+        log.info(f'relabelled 0 of {len(dn)} segments')
+        return changed
+
+    chain = np.floor(dn['rid'].values.astype(float))
+    refs = np.floor(dn[['rid_ds', 'rid_us2']].values.astype(float))
+    graph = NetworkGraph.from_network(dn, tolerance=tolerance)
+
+    # the chains of changed segments and of the segments touching them...
+    nodes = np.concatenate([graph.start_node[changed], graph.end_node[changed]])
+    touching = np.isin(graph.start_node, nodes) | np.isin(graph.end_node, nodes)
+    core = set(chain[touching & ~np.isnan(chain)])
+    # ...and the chains that flow into or receive them at confluences
+    in_core = np.isin(chain, list(core))
+    affected = core | set(chain[np.isin(refs, list(core)).any(axis=1) & ~np.isnan(chain)]) | \
+        set(refs[in_core][~np.isnan(refs[in_core])])
+    sub_rows = changed | np.isin(chain, list(affected))
+
+    # walk the affected part of the network from the upstream end of its largest unchanged chain
+    sub = dn[sub_rows].copy()
+    sub_graph = NetworkGraph.from_network(sub, tolerance=tolerance)
+    sub_degree = sub_graph.degree()
+    dangles = list(sub.index[(sub_degree[sub_graph.start_node] == 1) | (sub_degree[sub_graph.end_node] == 1)])
+    if first_feature in dangles:
+        ff = first_feature
+    else:
+        was_changed = dict(zip(dn.index, changed))
+        heads = [segid for segid in dangles if not was_changed[segid] and not np.isnan(dn.loc[segid, 'rid'])]
+        if len(heads) > 0:
+            ff = min(heads, key=lambda segid: dn.loc[segid, 'rid'])
+        else:
+            ff = dangles[0] if len(dangles) > 0 else sub.index[0]
+    try:
+        calc_topology(sub, ff, dem, tolerance=tolerance)
+    except (KeyError, ValueError):
+        # the walk can fail on a part of a network that it would label as a whole
+        log.warning('could not relabel the affected chains on their own, relabelling the whole network')
+        calc_topology(dn, first_feature, dem, samples, tolerance)
+        dn['topo_hash'] = hashes
+        return np.ones(len(dn), dtype=bool)
+
+    # give the walked chains the numbers of the chains they replace
+    old_labels = sorted(int(c) for c in affected)
+    next_label = int(np.nanmax(chain)) + 1 if not np.isnan(chain).all() else 1
+    mapping = {}
+    for n, label in enumerate(sorted(set(np.floor(sub['rid'].values.astype(float))))):
+        if n < len(old_labels):
+            mapping[label] = old_labels[n]
+        else:
+            mapping[label] = next_label
+            next_label += 1
+
+    def relabel(rid):
+        if rid is None or np.isnan(rid):
+            return None
+        return mapping[math.floor(rid)] + round(rid - math.floor(rid), 10)
+
+    for field in TOPOLOGY_FIELDS:
+        dn.loc[sub.index, field] = np.array([relabel(rid) for rid in sub[field].values.astype(float)], dtype=float)
+    dn.loc[sub.index, 'topo_flip'] = sub['topo_flip']
+
+    # refresh the confluence links of the walked segments and of the segments they meet
+    graph = NetworkGraph.from_network(dn, tolerance=tolerance)
+    nodes = np.concatenate([graph.start_node[sub_rows], graph.end_node[sub_rows]])
+    boundary = sub_rows | np.isin(graph.start_node, nodes) | np.isin(graph.end_node, nodes)
+    rid, rid_ds, rid_us, rid_us2 = (dn[field].values.astype(float) for field in TOPOLOGY_FIELDS)
+    # keep links within a chain; links across confluences are found again
+    rid_ds[boundary & (np.floor(rid_ds) != np.floor(rid))] = np.nan
+    rid_us2[boundary] = np.nan
+    link_confluences(graph, rid, rid_ds, rid_us, rid_us2, boundary)
+    dn.loc[boundary, 'rid_ds'] = rid_ds[boundary]
+    dn.loc[boundary, 'rid_us2'] = rid_us2[boundary]
+
+    dn['topo_hash'] = hashes
+    log.info(f'relabelled {sub_rows.sum()} of {len(dn)} segments')
+
+    return sub_rows
+
+
+def topology_hashes(node_xy, start_node, end_node, dem: str, first_geom, tolerance: float = 0.):
+    """
+    A hash of every segment's end nodes and the inputs it was labelled from. Topology only depends on the end nodes
+    of each segment; the number of segments meeting at each node is part of the hash so that adding or removing a
+    segment also changes the hashes of the segments it meets
+    :param node_xy: (m, 2) array of node coordinates
+    :param start_node: array of the node at the first vertex of each segment
+    :param end_node: array of the node at the last vertex of each segment
+    :param dem: path to the dem
+    :param first_geom: the geometry of the first feature
+    :param tolerance: the distance within which end points were merged into nodes
+    :return: an object array of hashes
+    """
+
+    nodes = list(map(tuple, node_xy.tolist()))
+    degree = np.bincount(np.concatenate([start_node, end_node]), minlength=len(nodes)).tolist()
+
+    return row_hashes(None, raster_fingerprint(dem), first_geom.wkb_hex, *((tolerance,) if tolerance > 0 else ()),
+                      per_row=[(nodes[start], nodes[end], degree[start], degree[end])
+                               for start, end in zip(start_node.tolist(), end_node.tolist())])
+
+
+def link_confluences(graph: NetworkGraph, rid, rid_ds, rid_us, rid_us2, rows=None):
+    """
+    Sets the downstream id of segments at the bottom of their chain and the second upstream id of segments below a
+    confluence
+    :param graph: the NetworkGraph of the network, oriented in the direction of flow
+    :param rid: array of segment ids
+    :param rid_ds: array of downstream ids (NaN where not yet known; updated in place)
+    :param rid_us: array of upstream ids
+    :param rid_us2: array of second upstream ids (updated in place)
+    :param rows: optional boolean array of the segments to update (defaults to all of them)
+    :return:
+    """
+
+    rows = np.ones(len(graph), dtype=bool) if rows is None else np.asarray(rows, dtype=bool)
+    ds_ptr, ds_segs = graph.downstream_csr()
+    us_ptr, us_segs = graph.upstream_csr()
+    n_ds = np.diff(ds_ptr)
+    n_us = np.diff(us_ptr)
+
+    for segid in graph.ids[rows & np.isnan(rid_ds) & (n_ds > 1)]:
+        log.warning(f'there are two reaches downstream of segment {segid}')
+    for segid in graph.ids[rows & (n_us > 2)]:
+        log.warning(f'there are more than two reaches upstream of segment {segid}')
+
+    # the first segment (in network order) below the bottom of a chain
+    bottom = rows & np.isnan(rid_ds) & (n_ds > 0)
+    rid_ds[bottom] = rid[ds_segs[ds_ptr[:-1][bottom]]]
+
+    # below a confluence, the upstream segment that isn't rid_us
+    conf = rows & (n_us == 2)
+    us1 = rid[us_segs[us_ptr[:-1][conf]]]
+    us2 = rid[us_segs[us_ptr[:-1][conf] + 1]]
+    same = (rid_us[conf] == us1) | (np.isnan(rid_us[conf]) & np.isnan(us1))
+    rid_us2[conf] = np.where(same, us2, us1)
 
 
 def magnitude_order(num):
@@ -268,9 +413,15 @@ def main():
     parser.add_argument('network', help='Path to a segmented stream network layer.', type=str)
     parser.add_argument('first_feature', help='The feature ID of the reach topology should start with.', type=int)
     parser.add_argument('dem', help='Path to a DEM.', type=str)
+    parser.add_argument('--incremental', help='Only relabel the chains affected by segments that changed since the '
+                                              'last run.', action='store_true')
+    parser.add_argument('--tolerance', help='The distance within which segment end points are treated as meeting.',
+                        type=float, default=0.)
+    add_arguments(parser)
     args = parser.parse_args()
 
-    network_topology(args.network, args.first_feature, args.dem)
+    with instrumented(args.trace, args.profile, args.log_level):
+        network_topology(args.network, args.first_feature, args.dem, args.incremental, args.tolerance)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,229 @@
+import logging
+import os
+import numpy as np
+import pyproj
+import rasterio
+from numba import njit
+from pysheds.sview import Raster, ViewFinder
+from tools.dem_conditioning import DIRMAP, condition_dem_tiled
+
+log = logging.getLogger(__name__)
+
+
+def scratch_array(scratch_dir: str, name: str, shape, dtype):
+    """
+    Creates an array in a memory-mapped .npy file on scratch disk, so it does not need to fit in memory
+    :param scratch_dir: the scratch directory
+    :param name: the file name (without extension)
+    :param shape: the array shape
+    :param dtype: the array dtype
+    :return: a writeable numpy memmap
+    """
+
+    return np.lib.format.open_memmap(os.path.join(scratch_dir, f'{name}.npy'), mode='w+', dtype=dtype, shape=shape)
+
+
+def flow_grids(dem: str, scratch_dir: str, tile_size: int = 2048, overlap: int = 256, workers: int = None,
+               dirmap=DIRMAP):
+    """
+    Computes flow directions and flow accumulation for a DEM without holding either grid in memory: the DEM is
+    conditioned in tiles (see condition_dem_tiled) and both grids are written to memory-mapped files in scratch_dir
+    :param dem: path to a DEM
+    :param scratch_dir: a directory on local disk with room for about 11 bytes per DEM cell
+    :param tile_size: number of rows and columns in the core of each tile
+    :param overlap: number of cells of context added around each tile
+    :param workers: number of worker processes for conditioning (defaults to the number of cpus)
+    :param dirmap: the D8 direction values (N, NE, E, SE, S, SW, W, NW)
+    :return: flow direction and flow accumulation Rasters backed by the memory-mapped files
+    """
+
+    with rasterio.open(dem) as src:
+        shape = (src.height, src.width)
+        affine = src.transform
+        crs = pyproj.Proj(src.crs, preserve_units=True)
+    log.info(f'writing flow grids for {shape[0] * shape[1]} cells to {scratch_dir}')
+
+    # flow directions (including the flat and pit codes, -1 and -2) fit in 16 bits
+    fdir = scratch_array(scratch_dir, 'fdir', shape, np.int16)
+    condition_dem_tiled(dem, tile_size, overlap, workers, dirmap, out=fdir)
+    fdir.flush()
+
+    acc = scratch_array(scratch_dir, 'acc', shape, np.float64)
+    d8_accumulation(fdir, acc, scratch_dir, dirmap=dirmap)
+
+    viewfinder = ViewFinder(affine=affine, shape=shape, nodata=0, crs=crs)
+
+    return Raster(fdir, viewfinder=viewfinder), Raster(acc, viewfinder=ViewFinder(affine=affine, shape=shape,
+                                                                                  nodata=0., crs=crs))
+
+
+def d8_accumulation(fdir, acc, scratch_dir: str, weighted: bool = False, dirmap=DIRMAP, nodata: int = 0,
+                    block_rows: int = 4096):
+    """
+    D8 flow accumulation computed in place, so fdir and acc may be memory-mapped files larger than memory. The result
+    is the same as pysheds' Grid.accumulation; cells are visited in the same order, so sums match to the last bit
+    :param fdir: 2D array of flow directions
+    :param acc: 2D float64 array of the same shape to accumulate into; if weighted, it holds the weights on input
+    :param scratch_dir: a directory for the in-degree grid (one byte per cell, removed afterwards)
+    :param weighted: if True, acc holds the weight of every cell; otherwise every valid cell has a weight of one
+    :param dirmap: the D8 direction values (N, NE, E, SE, S, SW, W, NW)
+    :param nodata: the flow direction nodata value
+    :param block_rows: number of rows initialised at a time
+    :return: acc
+    """
+
+    if not weighted:
+        for r0 in range(0, fdir.shape[0], block_rows):
+            acc[r0:r0 + block_rows] = fdir[r0:r0 + block_rows] != nodata
+
+    indegree_file = os.path.join(scratch_dir, 'indegree.npy')
+    indegree = scratch_array(scratch_dir, 'indegree', (fdir.size,), np.uint8)
+    try:
+        dirmap = np.array(dirmap, dtype=np.int64)
+        flat_fdir = np.asarray(fdir).reshape(-1)
+        flat_acc = np.asarray(acc).reshape(-1)
+        _d8_indegree(flat_fdir, fdir.shape[1], dirmap, nodata, indegree)
+        _d8_accumulate(flat_fdir, fdir.shape[1], dirmap, nodata, indegree, flat_acc)
+    finally:
+        del indegree
+        os.remove(indegree_file)
+
+    return acc
+
+
+@njit(cache=True)
+def _d8_endnode(fdir, k, ncols, dirmap, nodata):
+    # the cell k drains to, following pysheds' handling of the grid edges: a direction off the grid drains to the
+    # cell itself, and at a corner the bottom (then top, right, left) edge rule applies
+    d = fdir[k]
+    if d == nodata:
+        return k
+    i = -1
+    for j in range(8):
+        if d == dirmap[j]:
+            i = j
+    if i < 0:
+        return k
+
+    n = fdir.size
+    if k > n - ncols - 1:
+        if i == 3 or i == 4 or i == 5:
+            return k
+    elif k < ncols:
+        if i == 7 or i == 0 or i == 1:
+            return k
+    elif (k + 1) % ncols == 0:
+        if i == 1 or i == 2 or i == 3:
+            return k
+    elif k % ncols == 0:
+        if i == 5 or i == 6 or i == 7:
+            return k
+    offsets = (-ncols, 1 - ncols, 1, 1 + ncols, ncols, ncols - 1, -1, -1 - ncols)
+
+    return k + offsets[i]
+
+
+@njit(cache=True)
+def _d8_indegree(fdir, ncols, dirmap, nodata, indegree):
+    for k in range(fdir.size):
+        indegree[_d8_endnode(fdir, k, ncols, dirmap, nodata)] += 1
+
+
+@njit(cache=True)
+def _d8_accumulate(fdir, ncols, dirmap, nodata, indegree, acc):
+    # cells with nothing draining into them start a walk downstream that continues while every cell draining into the
+    # next cell has been counted; cells are marked 255 once walked so a later pass over them doesn't count them twice
+    for k in range(fdir.size):
+        if indegree[k] != 0:
+            continue
+        start = k
+        while indegree[start] == 0:
+            end = _d8_endnode(fdir, start, ncols, dirmap, nodata)
+            indegree[start] = 255
+            if end == start:
+                break
+            acc[end] += acc[start]
+            indegree[end] -= 1
+            start = end
+
+
+def edges_draining_to(fdir, cells, edges, dirmap=DIRMAP, nodata: int = 0, visited=None):
+    """
+    Finds which edges of a flow direction grid have cells whose flow reaches any of a set of cells, i.e. which edges
+    the catchments of those cells touch. Flow is traced down from every cell on the given edges; paths are marked as
+    they are walked, so no cell is walked twice from the same edge
+    :param fdir: 2D array of flow directions
+    :param cells: list of (row, col) cells
+    :param edges: (left, bottom, right, top) booleans of the edges to trace from
+    :param dirmap: the D8 direction values (N, NE, E, SE, S, SW, W, NW)
+    :param nodata: the flow direction nodata value
+    :param visited: an optional uint8 array of fdir.size zeros to mark paths in (e.g., a memory-mapped file)
+    :return: (left, bottom, right, top) booleans, True for an edge that drains to any of the cells
+    """
+
+    height, width = fdir.shape
+    rows, cols = np.arange(height), np.arange(width)
+    # pysheds leaves the outermost cells without a direction, so the cells inside them are traced from as well
+    sides = (([rows * width, rows * width + 1], 1), ([(height - 1) * width + cols, (height - 2) * width + cols], 2),
+             ([rows * width + width - 1, rows * width + width - 2], 4), ([cols, width + cols], 8))
+    starts = [np.zeros(0, dtype=np.int64)]
+    bits = [np.zeros(0, dtype=np.uint8)]
+    for (lines, bit), edge in zip(sides, edges):
+        if edge:
+            starts.extend(np.clip(k, 0, fdir.size - 1) for k in lines)
+            bits.extend(np.full(len(k), bit, dtype=np.uint8) for k in lines)
+    starts, bits = np.concatenate(starts), np.concatenate(bits)
+    visited = np.zeros(fdir.size, dtype=np.uint8) if visited is None else visited
+    _d8_trace(np.asarray(fdir).reshape(-1), width, np.array(dirmap, dtype=np.int64), nodata, starts, bits, visited)
+
+    reached = np.bitwise_or.reduce(np.asarray([visited[row * width + col] for row, col in cells], dtype=np.uint8))
+
+    return tuple(bool(reached & bit) for _, bit in sides)
+
+
+@njit(cache=True)
+def _d8_trace(fdir, ncols, dirmap, nodata, starts, bits, visited):
+    # walks down from each start cell, marking cells with the start's edge bit, until a cell already marked from the
+    # same edge or a cell that drains nowhere
+    for i in range(len(starts)):
+        k = starts[i]
+        while visited[k] & bits[i] == 0:
+            visited[k] |= bits[i]
+            end = _d8_endnode(fdir, k, ncols, dirmap, nodata)
+            if end == k:
+                break
+            k = end
+
+
+def snap_to_stream(acc, affine, x: float, y: float, threshold: float = 1000., radius: int = 64):
+    """
+    Finds the stream cell (accumulation above a threshold) nearest to a point by searching a window around it that
+    grows until the nearest cell found is closer than any cell outside the window, so only a small part of a
+    memory-mapped grid is read. The cell is the one pysheds' snap_to_mask and nearest_cell would give, except that
+    where several cells are equally near (e.g., a point at a cell centre) the first in row order is taken
+    :param acc: 2D flow accumulation array
+    :param affine: the affine transform of the grid (north up)
+    :param x: x coordinate
+    :param y: y coordinate
+    :param threshold: the accumulation above which a cell is a stream cell
+    :param radius: the initial half-width of the search window in cells
+    :return: row, col of the stream cell
+    """
+
+    height, width = acc.shape
+    fcol, frow = ~affine * (x, y)
+    cell = min(abs(affine.a), abs(affine.e))
+    while True:
+        r0, r1 = max(int(frow) - radius, 0), min(int(frow) + radius + 1, height)
+        c0, c1 = max(int(fcol) - radius, 0), min(int(fcol) + radius + 1, width)
+        rows, cols = np.nonzero(np.asarray(acc[r0:r1, c0:c1]) > threshold)
+        whole = r0 == 0 and c0 == 0 and r1 == height and c1 == width
+        if len(rows) > 0:
+            # distances to the cells' top-left corners, as pysheds measures them
+            dist = np.hypot((cols + c0 - fcol) * affine.a, (rows + r0 - frow) * affine.e)
+            nearest = np.argmin(dist)
+            if dist[nearest] <= (radius - 1) * cell or whole:
+                return int(rows[nearest] + r0), int(cols[nearest] + c0)
+        elif whole:
+            raise Exception('There are no stream cells to snap to')
+        radius *= 2
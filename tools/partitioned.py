@@ -0,0 +1,398 @@
+import json
+import logging
+import math
+import os
+import shutil
+import time
+import numpy as np
+import pandas as pd
+from tools.network_io import is_parquet, read_network, write_network, read_row_groups, update_parquet_columns
+from tools.segment_network import segment_lines
+from tools.sinuosity import update_sinuosity
+from tools.slope import update_slope
+from tools.drainage_area import update_da
+from tools.raster_sampling import line_endpoints, endpoint_elevations
+from tools.network_graph import NetworkGraph
+from tools.network_topology import TOPOLOGY_FIELDS, topology_radius, label_topology, topology_hashes
+from tools.upstream_accumulation import upstream_values
+from tools.telemetry import Progress, phase
+
+log = logging.getLogger(__name__)
+
+# stages run on each partition on its own, and stages run over the whole network from values gathered from the
+# partitions
+PARTITION_STAGES = ('segment_network', 'sinuosity', 'slope', 'drainage_area')
+NETWORK_STAGES = ('network_topology', 'upstream_accumulation')
+
+
+def import_dask():
+    """
+    :return: the dask and dask_geopandas modules, which are only needed for partitioned runs (the dask extra)
+    """
+
+    try:
+        import dask
+        import dask_geopandas
+    except ImportError:
+        raise Exception('Partitioned runs need dask-geopandas; install network-attributes with the dask extra')
+
+    return dask, dask_geopandas
+
+
+def run_partitioned(network: str, out_dir: str, stages: list, params: dict, partition_size: int = 100000):
+    """
+    Runs several tools on a drainage network too large to hold in memory, in partitions of neighbouring segments.
+    The network is sorted along a Hilbert curve with dask-geopandas and split into partitions of about partition_size
+    segments, so each partition covers a compact area and reads a compact set of raster windows. Segmentation,
+    sinuosity, slope and drainage area run on each partition on its own, on a pool of worker processes, and each
+    partition is written to its own GeoParquet file in out_dir. Topology and upstream accumulation gather the end
+    points (or topology fields) of every partition into arrays, join the partitions where their end points meet, and
+    write their fields back to each file
+    :param network: path to a drainage network layer; GeoParquet files are read a few row groups at a time, other
+    formats are read whole before being partitioned
+    :param out_dir: the directory to write the attributed network to, as a GeoParquet dataset of one file per
+    partition (read_network reads it whole if its name ends in .parquet)
+    :param stages: names of the tools to run, in order (see PARTITION_STAGES and NETWORK_STAGES)
+    :param params: dict of tool parameters as for run_pipeline; workers is the number of processes partitions are run
+    on (the tools run serially within a partition) and scratch_dir is where the sort spills to disk
+    :param partition_size: the approximate number of segments in a partition
+    :return: dict of stage name to elapsed seconds, with 'read' (sorting and partitioning) and 'partitions' (the
+    passes over the partitions)
+    """
+
+    dask, dask_geopandas = import_dask()
+    for stage in stages:
+        if stage not in PARTITION_STAGES + NETWORK_STAGES:
+            raise Exception(f'Stage {stage} can not be run on partitions')
+    if os.path.abspath(out_dir) == os.path.abspath(network):
+        raise Exception('Partitioned runs can not write over their input network')
+
+    timings = {}
+    tmp = out_dir + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    config = {'scheduler': 'processes', 'num_workers': params.get('workers')}
+    if params.get('scratch_dir'):
+        config['temporary_directory'] = params['scratch_dir']
+    with dask.config.set(config):
+        start = time.perf_counter()
+        with phase('read'):
+            parts, id_col, index_name = sorted_partitions(network, partition_size, dask, dask_geopandas)
+        timings['read'] = time.perf_counter() - start
+
+        # runs of stages that work on partitions are done in one pass over them, the first of which writes them
+        files = None
+        passes = []
+        for stage in stages:
+            if stage in PARTITION_STAGES and len(passes) > 0 and passes[-1][0] in PARTITION_STAGES:
+                passes[-1].append(stage)
+            else:
+                passes.append([stage])
+        if len(passes) == 0 or passes[0][0] in NETWORK_STAGES:
+            passes.insert(0, [])
+
+        for run in passes:
+            if run and run[0] in NETWORK_STAGES:
+                stage = run[0]
+                log.info(f'running {stage} over {len(files)} partitions')
+                start = time.perf_counter()
+                with phase(stage):
+                    if stage == 'network_topology':
+                        network_topology(files, params, dask)
+                    else:
+                        upstream_accumulation(files, params, dask)
+                timings[stage] = time.perf_counter() - start
+                continue
+
+            log.info(f'running {", ".join(run) or "partitioning"} on {len(files or parts)} partitions')
+            start = time.perf_counter()
+            with phase('partitions'):
+                if files is None:
+                    tasks = [dask.delayed(partition_stages)(part, os.path.join(tmp, f'part.{i:05d}.parquet'), run,
+                                                            params, id_col, index_name)
+                             for i, part in enumerate(parts)]
+                else:
+                    tasks = [dask.delayed(partition_stages)(None, f, run, params) for f in files]
+                counts = compute(tasks, dask, 'partitions')
+                files = [os.path.join(tmp, f'part.{i:05d}.parquet') for i, n in enumerate(counts) if n > 0]
+                counts = [n for n in counts if n > 0]
+                if 'segment_network' in run:
+                    # segments are numbered across the partitions in partition order
+                    starts = np.r_[0, np.cumsum(counts)[:-1]].tolist()
+                    compute([dask.delayed(renumber)(f, start) for f, start in zip(files, starts)], dask, 'partitions')
+            timings['partitions'] = timings.get('partitions', 0.) + time.perf_counter() - start
+
+    if os.path.isdir(out_dir):
+        shutil.rmtree(out_dir)
+    elif os.path.exists(out_dir):
+        os.remove(out_dir)
+    os.rename(tmp, out_dir)
+
+    for stage, elapsed in timings.items():
+        log.info(f'{stage}: {elapsed:.2f} s')
+
+    return timings
+
+
+def compute(tasks: list, dask, label: str):
+    """
+    Computes dask tasks on the configured scheduler, reporting progress through the tasks of the whole graph
+    :param tasks: list of dask delayed objects
+    :param dask: the dask module
+    :param label: a description of the work (e.g., 'partitions')
+    :return: list of results
+    """
+
+    from dask.callbacks import Callback
+
+    class Report(Callback):
+        def _start_state(self, dsk, state):
+            self.progress = Progress(len(dsk), f'{label} tasks', logger=log)
+
+        def _posttask(self, key, result, dsk, state, worker_id):
+            self.progress.update()
+
+        def _finish(self, dsk, state, errored):
+            self.progress.close()
+
+    with Report():
+        return list(dask.compute(*tasks))
+
+
+def sorted_partitions(network: str, partition_size: int, dask, dask_geopandas):
+    """
+    Reads a drainage network into dask-geopandas partitions sorted along a Hilbert curve
+    :param network: path to a drainage network layer
+    :param partition_size: the approximate number of segments in a partition
+    :param dask: the dask module
+    :param dask_geopandas: the dask_geopandas module
+    :return: list of the delayed partitions, the column holding the network's ids, and the name of its index
+    """
+
+    if is_parquet(network):
+        tasks, rows = parquet_tasks(network, partition_size)
+        meta = read_row_groups(tasks[0][0], [])
+        ddf = dask_geopandas.from_dask_dataframe(
+            dask.dataframe.from_delayed([dask.delayed(read_row_groups)(*task) for task in tasks], meta=meta))
+    else:
+        # other formats can't be read a part at a time, so the network is read whole and then partitioned
+        dn = read_network(network)
+        rows = len(dn)
+        ddf = dask_geopandas.from_geopandas(dn, chunksize=partition_size)
+
+    # sorting replaces the index with the position along the curve, so the ids are kept in a column
+    index_name = ddf.index.name
+    ddf = ddf.reset_index()
+    id_col = index_name or 'index'
+    npartitions = max(math.ceil(rows / partition_size), 1)
+    ddf = ddf.spatial_shuffle('hilbert', npartitions=npartitions, calculate_partitions=False, shuffle='disk')
+
+    return ddf.to_delayed(), id_col, index_name
+
+
+def parquet_tasks(network: str, partition_size: int):
+    """
+    Groups the row groups of a GeoParquet network (a file, or a directory of files) into reads of about
+    partition_size rows
+    :param network: path to a GeoParquet file or dataset directory
+    :param partition_size: the approximate number of rows in a read
+    :return: list of (file, row groups, first row) reads (see read_row_groups) and the total number of rows
+    """
+
+    import pyarrow.parquet as pq
+
+    files = sorted(os.path.join(network, f) for f in os.listdir(network) if f.endswith('.parquet')) \
+        if os.path.isdir(network) else [network]
+    tasks = []
+    rows = 0
+    for f in files:
+        meta = pq.ParquetFile(f).metadata
+        groups, first, size = [], 0, 0
+        for g in range(meta.num_row_groups):
+            if size >= partition_size:
+                tasks.append((f, groups, first))
+                groups, first, size = [], first + size, 0
+            groups.append(g)
+            size += meta.row_group(g).num_rows
+        if groups:
+            tasks.append((f, groups, first))
+        rows += meta.num_rows
+    if len(tasks) == 0:
+        raise Exception(f'{network} holds no GeoParquet files')
+
+    return tasks, rows
+
+
+def partition_stages(part, out_file: str, stages: list, params: dict, id_col: str = None, index_name: str = None):
+    """
+    Runs stages that work on each partition on its own and writes the partition to a GeoParquet file
+    :param part: a GeoDataFrame partition, or None to read the partition from out_file
+    :param out_file: path to the partition's GeoParquet file
+    :param stages: names of the tools to run (see PARTITION_STAGES)
+    :param params: dict of tool parameters (see run_partitioned)
+    :param id_col: the column of part holding the network's ids, which is made its index again
+    :param index_name: the name of the network's index
+    :return: the number of segments in the partition (the file isn't written if there are none)
+    """
+
+    if part is None:
+        part = read_network(out_file)
+    elif id_col is not None:
+        part = part.set_index(id_col)
+        part.index.name = index_name
+    if len(part) == 0:
+        return 0
+    if params.get('epsg') is not None and part.crs != f"epsg:{params['epsg']}":
+        part = part.to_crs(epsg=params['epsg'])
+
+    samples = {}
+    incremental = params.get('incremental', False) and 'segment_network' not in stages
+    for stage in stages:
+        if stage == 'segment_network':
+            part = segment_lines(part, params['seg_length'])
+            samples = {}
+        elif stage == 'sinuosity':
+            update_sinuosity(part, incremental)
+        elif stage == 'slope':
+            update_slope(part, params['dem'], params['search_dist'], incremental, samples,
+                         params.get('block_cache', 256.), None, params.get('slope_method') or 'endpoints',
+                         params.get('spacing'))
+        elif stage == 'drainage_area':
+            update_da(part, params['drainage_area'], params['da_search_dist'], incremental,
+                      params.get('block_cache', 256.))
+    write_network(part, out_file)
+
+    return len(part)
+
+
+def renumber(path: str, start: int):
+    """
+    Numbers the segments of a partition written with a range index from start, by rewriting the index's stored start
+    rather than the rows
+    :param path: path to the partition's GeoParquet file
+    :param start: the id of its first segment
+    :return:
+    """
+
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(path)
+    metadata = dict(table.schema.metadata)
+    pandas_meta = json.loads(metadata[b'pandas'])
+    index = pandas_meta['index_columns'][0]
+    index['stop'] = start + index['stop'] - index['start']
+    index['start'] = start
+    metadata[b'pandas'] = json.dumps(pandas_meta).encode()
+
+    tmp = path + '.tmp'
+    pq.write_table(table.replace_schema_metadata(metadata), tmp)
+    os.replace(tmp, path)
+
+
+def _topology_inputs(path: str, dem: str, radius: float):
+    # the end points, length and end point elevations of every segment of a partition
+    part = read_network(path, columns=[])
+    sx, sy, ex, ey = line_endpoints(part.geometry)
+    start_elev, end_elev = endpoint_elevations(part.geometry, dem, radius)
+
+    return pd.DataFrame({'sx': sx, 'sy': sy, 'ex': ex, 'ey': ey, 'length': part.geometry.length.values,
+                         'start_elev': start_elev, 'end_elev': end_elev}, index=part.index)
+
+
+def network_topology(files: list, params: dict, dask):
+    """
+    Adds the topology fields to a partitioned drainage network. The end points and end point elevations of the
+    segments are gathered from every partition, end points are merged into the nodes of one graph of the whole
+    network (joining the partitions where they meet), and the network is walked as in calc_topology. The fields and
+    a 'topo_hash' are written back to each partition's file without re-encoding its geometry. Only the gathering and
+    writing run on the partitions: the walk (label_topology) is a single Python loop over every segment of the whole
+    network in this process, as each step depends on the segments already walked, so its time and the memory of the
+    graph grow with the whole network
+    :param files: paths to the partitions' GeoParquet files
+    :param params: dict of tool parameters (dem, first_feature and tolerance)
+    :param dask: the dask module
+    :return:
+    """
+
+    dem = params['dem']
+    tolerance = params.get('tolerance') or 0.
+    with phase('sampling'):
+        ends = compute([dask.delayed(_topology_inputs)(f, dem, topology_radius(dem)) for f in files], dask,
+                       'end point')
+    sizes = [len(e) for e in ends]
+    ends = pd.concat(ends)
+    if not ends.index.is_unique:
+        raise Exception('The network ids are not unique across partitions')
+
+    graph = NetworkGraph.from_endpoints(ends.index.values, ends['sx'].values, ends['sy'].values, ends['ex'].values,
+                                        ends['ey'].values, ends['length'].values, ends['start_elev'].values,
+                                        ends['end_elev'].values, tolerance)
+    fields = pd.DataFrame(dict(zip(TOPOLOGY_FIELDS, label_topology(graph, params['first_feature']))),
+                          index=ends.index)
+    fields['topo_flip'] = graph.flipped.astype(int)
+
+    first = graph.position(params['first_feature'])
+    part = int(np.searchsorted(np.cumsum(sizes), first, side='right'))
+    first_geom = read_network(files[part], columns=[]).geometry.loc[params['first_feature']]
+    fields['topo_hash'] = topology_hashes(graph.node_xy, graph.start_node, graph.end_node, dem, first_geom,
+                                          tolerance)
+
+    write_fields(files, sizes, fields, dask)
+
+
+def _upstream_inputs(path: str, columns: list):
+    # the end points, direction, length and accumulated fields of every segment of a partition
+    part = read_network(path, columns=['topo_flip'] + columns)
+    if 'topo_flip' not in part.columns:
+        raise Exception('The network has no topology fields; run network_topology first')
+    for field in columns:
+        if field not in part.columns:
+            raise Exception(f'The network has no field {field}')
+    sx, sy, ex, ey = line_endpoints(part.geometry)
+
+    return pd.DataFrame(part[['topo_flip'] + columns]).assign(sx=sx, sy=sy, ex=ex, ey=ey,
+                                                              length=part.geometry.length.values)
+
+
+def upstream_accumulation(files: list, params: dict, dask):
+    """
+    Adds the upstream accumulation fields to a partitioned drainage network that network_topology has labelled. The
+    end points, directions, lengths and accumulated fields are gathered from every partition, end points are merged
+    into the nodes of one graph of the whole network, and the fields are accumulated over it as in calc_upstream.
+    The results are written back to each partition's file
+    :param files: paths to the partitions' GeoParquet files
+    :param params: dict of tool parameters (sum_fields, max_fields and tolerance)
+    :param dask: the dask module
+    :return:
+    """
+
+    sum_fields = params.get('sum_fields') or []
+    max_fields = params.get('max_fields') or []
+    columns = list(dict.fromkeys(sum_fields + max_fields))
+    values = compute([dask.delayed(_upstream_inputs)(f, columns) for f in files], dask, 'gather')
+    sizes = [len(v) for v in values]
+    values = pd.concat(values)
+
+    graph = NetworkGraph.from_endpoints(values.index.values, values['sx'].values, values['sy'].values,
+                                        values['ex'].values, values['ey'].values, values['length'].values,
+                                        tolerance=params.get('tolerance') or 0.,
+                                        flipped=values['topo_flip'].values == 1)
+    fields = upstream_values(graph, {field: values[field].values for field in sum_fields},
+                             {field: values[field].values for field in max_fields})
+    write_fields(files, sizes, pd.DataFrame(fields, index=values.index), dask)
+
+
+def write_fields(files: list, sizes: list, fields: pd.DataFrame, dask):
+    """
+    Writes fields computed over a whole partitioned network back to each partition's file
+    :param files: paths to the partitions' GeoParquet files
+    :param sizes: the number of segments in each partition
+    :param fields: a DataFrame of the fields of every segment, in partition and file order
+    :param dask: the dask module
+    :return:
+    """
+
+    ends = np.cumsum(sizes)
+    compute([dask.delayed(update_parquet_columns)(fields.iloc[end - size:end], f, list(fields.columns))
+             for f, size, end in zip(files, sizes, ends)], dask, 'write')
@@ -0,0 +1,210 @@
+import argparse
+import logging
+import os
+import time
+from tools.network_io import read_network, write_network
+from tools.segment_network import segment_lines
+from tools.sinuosity import update_sinuosity
+from tools.slope import update_slope
+from tools.drainage_area import update_da
+from tools.network_topology import update_topology, topology_radius
+from tools.flow_scaling import update_flow_scale
+from tools.gauge_scaling import read_gauges, update_gauge_scale
+from tools.upstream_accumulation import calc_upstream
+from tools.partitioned import run_partitioned
+from tools.raster_sampling import share_endpoint_radii
+from tools.telemetry import phase, add_arguments, instrumented
+
+log = logging.getLogger(__name__)
+
+# parameters each stage needs, in the order stages are normally run
+STAGE_PARAMS = {
+    'segment_network': ('seg_length',),
+    'sinuosity': (),
+    'slope': ('dem', 'search_dist'),
+    'drainage_area': ('drainage_area', 'da_search_dist'),
+    'network_topology': ('dem', 'first_feature'),
+    'flow_scaling': ('dem', 'measurement_reach', 'precipitation'),
+    'gauge_scaling': ('dem', 'gauges', 'precipitation'),
+    'upstream_accumulation': (),
+}
+
+
+def run_pipeline(network: str, out_file: str, stages: list, params: dict):
+    """
+    Runs several tools on a drainage network while holding it in memory, so the network is read and written once
+    :param network: path to a drainage network layer
+    :param out_file: path to save the attributed network (may be the same as network)
+    :param stages: names of the tools to run, in order (see STAGE_PARAMS)
+    :param params: dict of tool parameters: epsg, seg_length, dem, search_dist, slope_method, spacing (slope),
+    drainage_area, da_search_dist, first_feature, tolerance (network_topology, upstream_accumulation),
+    measurement_reach, precipitation, gauges, reach_field, gauge_field (gauge_scaling), block_cache (slope,
+    drainage_area), workers (slope, drainage_area, flow_scaling, gauge_scaling), the optional flow_scaling and
+    gauge_scaling settings (reproject, method, tile_size, tile_overlap, cache_dir, cache_size; scratch_dir for
+    flow_scaling only), the optional upstream_accumulation fields (sum_fields, max_fields), incremental (only recompute
+    segments that changed since the last run), and partition_size (run on partitions of about this many segments with
+    run_partitioned, writing out_file as a GeoParquet dataset directory)
+    :return: dict of stage name to elapsed seconds, including 'read' and 'write'
+    """
+
+    for stage in stages:
+        if stage not in STAGE_PARAMS:
+            raise Exception(f'Unknown stage: {stage}')
+        missing = [p for p in STAGE_PARAMS[stage] if params.get(p) is None]
+        if len(missing) > 0:
+            raise Exception(f'Stage {stage} requires parameters: {", ".join(missing)}')
+
+    if params.get('partition_size'):
+        return run_partitioned(network, out_file, stages, params, params['partition_size'])
+
+    timings = {}
+
+    start = time.perf_counter()
+    with phase('read'):
+        dn = read_network(network)
+        geometry_changed = 'segment_network' in stages
+        if params.get('epsg') is not None and dn.crs != f"epsg:{params['epsg']}":
+            dn = dn.to_crs(epsg=params['epsg'])
+            geometry_changed = True
+    timings['read'] = time.perf_counter() - start
+
+    # values sampled from rasters at the segment end points, shared by the tools that need them: end point slope and
+    # topology search the same dem at different distances, so the first of them samples both in one pass
+    shared_radii = ()
+    endpoint_slope = 'slope' in stages and (params.get('slope_method') or 'endpoints') == 'endpoints'
+    if endpoint_slope and 'network_topology' in stages:
+        shared_radii = (params['search_dist'], topology_radius(params['dem']))
+    samples = new_samples(params.get('dem'), shared_radii)
+    # segmenting replaces every segment, so nothing from an earlier run can be reused
+    incremental = params.get('incremental', False) and 'segment_network' not in stages
+
+    for stage in stages:
+        log.info(f'running {stage}')
+        start = time.perf_counter()
+        with phase(stage):
+            if stage == 'segment_network':
+                dn = segment_lines(dn, params['seg_length'])
+                samples = new_samples(params.get('dem'), shared_radii)
+            elif stage == 'sinuosity':
+                update_sinuosity(dn, incremental)
+            elif stage == 'slope':
+                update_slope(dn, params['dem'], params['search_dist'], incremental, samples,
+                             params.get('block_cache', 256.), params.get('workers'),
+                             params.get('slope_method') or 'endpoints', params.get('spacing'))
+            elif stage == 'drainage_area':
+                update_da(dn, params['drainage_area'], params['da_search_dist'], incremental,
+                          params.get('block_cache', 256.), params.get('workers'))
+            elif stage == 'network_topology':
+                update_topology(dn, params['first_feature'], params['dem'], incremental, samples,
+                                params.get('tolerance') or 0.)
+            elif stage == 'flow_scaling':
+                update_flow_scale(dn, params['measurement_reach'], params['dem'], params['precipitation'],
+                                  params.get('reproject', False), params.get('method', 'catchment'),
+                                  params.get('tile_size'), params.get('tile_overlap', 256), params.get('workers'),
+                                  params.get('cache_dir'), params.get('cache_size', 20.), incremental,
+                                  params.get('scratch_dir'))
+            elif stage == 'gauge_scaling':
+                gauge_reaches = read_gauges(params['gauges'], params.get('reach_field') or 'reach_id',
+                                            params.get('gauge_field') or 'gauge_id')
+                update_gauge_scale(dn, gauge_reaches, params['dem'], params['precipitation'],
+                                   params.get('reproject', False), params.get('method', 'catchment'),
+                                   params.get('tile_size'), params.get('tile_overlap', 256), params.get('workers'),
+                                   params.get('cache_dir'), params.get('cache_size', 20.), incremental)
+            elif stage == 'upstream_accumulation':
+                calc_upstream(dn, params.get('sum_fields'), params.get('max_fields'), params.get('tolerance') or 0.)
+        timings[stage] = time.perf_counter() - start
+
+    # when updating a GeoParquet network in place, only the attribute columns are rewritten
+    columns = None
+    if not geometry_changed and os.path.abspath(out_file) == os.path.abspath(network):
+        columns = [c for c in dn.columns if c != dn.geometry.name]
+
+    start = time.perf_counter()
+    with phase('write'):
+        write_network(dn, out_file, columns)
+    timings['write'] = time.perf_counter() - start
+
+    for stage, elapsed in timings.items():
+        log.info(f'{stage}: {elapsed:.2f} s')
+
+    return timings
+
+
+def new_samples(dem: str, radii):
+    """
+    :param dem: path to the dem the tools sample
+    :param radii: buffer distances the tools sample the dem around segment end points at (see share_endpoint_radii)
+    :return: an empty dict of samples shared by the tools
+    """
+
+    samples = {}
+    if len(radii) > 0:
+        share_endpoint_radii(samples, dem, radii)
+
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run = subparsers.add_parser('run', help='Run several tools on a drainage network, reading and writing it once.')
+    run.add_argument('network', help='Path to a drainage network layer.', type=str)
+    run.add_argument('out_network', help='Path to save the attributed network.', type=str)
+    run.add_argument('--stages', help='The tools to run, in order.', nargs='+', choices=list(STAGE_PARAMS),
+                     required=True)
+    run.add_argument('--epsg', help='An EPSG number to project the network into before running the tools.', type=int)
+    run.add_argument('--seg_length', help='segment_network: the approximate segment length.', type=float)
+    run.add_argument('--dem', help='slope, network_topology, flow_scaling, gauge_scaling: path to a DEM.', type=str)
+    run.add_argument('--search_dist', help='slope: a buffer distance to search for elevation values.', type=float)
+    run.add_argument('--slope_method', help='slope: endpoints or profile.', type=str, choices=['endpoints', 'profile'],
+                     default='endpoints')
+    run.add_argument('--spacing', help='slope: the distance between elevation samples for the profile method.',
+                     type=float)
+    run.add_argument('--drainage_area', help='drainage_area: path to a drainage area raster.', type=str)
+    run.add_argument('--da_search_dist', help='drainage_area: a buffer distance to search for drainage area values.',
+                     type=float)
+    run.add_argument('--block_cache', help='slope, drainage_area: the maximum size in MB of the raster window held in '
+                                          'memory at once.', type=float, default=256.)
+    run.add_argument('--first_feature', help='network_topology: the feature ID to start with.', type=int)
+    run.add_argument('--tolerance', help='network_topology, upstream_accumulation: the distance within which '
+                                         'segment end points are treated as meeting.', type=float, default=0.)
+    run.add_argument('--measurement_reach', help='flow_scaling: the reach ID of the discharge record.', type=int)
+    run.add_argument('--precipitation', help='flow_scaling, gauge_scaling: path to a precipitation raster.', type=str)
+    run.add_argument('--gauges', help='gauge_scaling: path to a csv table of gauge reach IDs and gauge IDs.', type=str)
+    run.add_argument('--reach_field', help='gauge_scaling: the gauge table column of reach IDs.', type=str,
+                     default='reach_id')
+    run.add_argument('--gauge_field', help='gauge_scaling: the gauge table column of gauge IDs.', type=str,
+                     default='gauge_id')
+    run.add_argument('--method', help='flow_scaling, gauge_scaling: catchment or accumulation.', type=str,
+                     choices=['catchment', 'accumulation'], default='catchment')
+    run.add_argument('--tile_size', help='flow_scaling: compute flow directions in tiles of this many cells.',
+                     type=int)
+    run.add_argument('--tile_overlap', help='flow_scaling: the number of cells of context around each tile.',
+                     type=int, default=256)
+    run.add_argument('--incremental', help='Only recompute segments that changed since the last run.',
+                     action='store_true')
+    run.add_argument('--workers', help='slope, drainage_area, flow_scaling: the number of worker processes (with '
+                                       '--partition_size, the number of processes partitions are run on).', type=int)
+    run.add_argument('--partition_size', help='Run on partitions of about this many neighbouring segments, for '
+                                              'networks too large for memory; out_network is written as a GeoParquet '
+                                              'dataset directory.', type=int)
+    run.add_argument('--cache_dir', help='flow_scaling: a directory to cache flow grids in.', type=str)
+    run.add_argument('--cache_size', help='flow_scaling: the maximum size of the cache in GB.', type=float,
+                     default=20.)
+    run.add_argument('--scratch_dir', help='flow_scaling: a local directory to hold the flow grids in memory-mapped '
+                                           'files rather than in memory (with --partition_size, to spill the sort '
+                                           'to).', type=str)
+    run.add_argument('--sum_fields', help='upstream_accumulation: fields to sum over each segment\'s upstream network.',
+                     nargs='+')
+    run.add_argument('--max_fields', help='upstream_accumulation: fields to take the maximum of over each segment\'s '
+                                          'upstream network.', nargs='+')
+    add_arguments(run)
+    args = parser.parse_args()
+
+    params = vars(args)
+    with instrumented(params.pop('trace'), params.pop('profile'), params.pop('log_level')):
+        run_pipeline(params.pop('network'), params.pop('out_network'), params.pop('stages'), params)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from tools.incremental import raster_fingerprint
+from tools.telemetry import Progress, phase, add_arguments, instrumented
+
+log = logging.getLogger(__name__)
+
+INDEX_SUFFIX = '.index'
+INDEX_VERSION = 1
+INDEX_ARRAYS = ('min', 'max')
+
+
+def index_path(raster: str):
+    """
+    :param raster: path to a raster
+    :return: the path of the directory holding the raster's index, beside the raster
+    """
+
+    return raster + INDEX_SUFFIX
+
+
+def build_index(raster: str, band: int = 1, max_width: int = 64, block_rows: int = 1024):
+    """
+    Builds an index of a raster band and saves it beside the raster (see index_path), so that extremes over windows
+    of the raster can be answered without reading its cells: min and max sparse tables over each row, where level j
+    holds the extreme of the 2**j cells starting at each cell, so the extreme over any run of up to 2**(levels) cells
+    of a row takes two lookups. Nodata cells are left out. The raster is read a block of rows at a time, and the
+    tables are written to memory-mapped .npy files
+    :param raster: path to the raster
+    :param band: the band to index
+    :param max_width: the widest run of a row answered with two lookups (wider runs take more); this sets the number
+    of sparse table levels, each of which takes as much space as the raster in float32 (float64 for 32 bit integer
+    and float64 rasters)
+    :param block_rows: the number of rows read at a time
+    :return: the path to the index
+    """
+
+    path = index_path(raster)
+    tmp = path + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    with rasterio.open(raster) as src, phase('indexing'):
+        height, width = src.height, src.width
+        dtype = np.result_type(src.dtypes[band - 1], np.float32)
+        levels = int(np.log2(max(min(max_width, width), 1))) + 1
+        log.info(f'indexing {height} x {width} cells of {os.path.basename(raster)} with {levels} sparse table levels')
+
+        def table(name, dt, shape):
+            return np.lib.format.open_memmap(os.path.join(tmp, f'{name}.npy'), mode='w+', dtype=dt, shape=shape)
+
+        mins = table('min', dtype, (levels, height, width))
+        maxs = table('max', dtype, (levels, height, width))
+
+        progress = Progress(height, 'rows', logger=log)
+        for row in range(0, height, block_rows):
+            n = min(block_rows, height - row)
+            vals = src.read(band, window=Window(0, row, width, n), masked=True).astype(dtype).filled(np.nan)
+
+            for tables, fn in ((mins, np.fmin), (maxs, np.fmax)):
+                level = vals
+                tables[0, row:row + n] = level
+                for j in range(1, levels):
+                    # runs that would pass the end of the row are cut at the end of the row
+                    half = 2 ** (j - 1)
+                    level = level.copy()
+                    level[:, :width - half] = fn(level[:, :width - half], level[:, half:])
+                    tables[j, row:row + n] = level
+            progress.update(n)
+        progress.close()
+
+        for arr in (mins, maxs):
+            arr.flush()
+        del mins, maxs
+
+    meta = {'version': INDEX_VERSION, 'fingerprint': raster_fingerprint(raster), 'band': band,
+            'shape': [height, width], 'levels': levels}
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp, path)
+
+    return path
+
+
+def open_index(raster: str, band: int = 1):
+    """
+    Opens the index of a raster band built by build_index, if there is one and the raster hasn't changed since
+    :param raster: path to the raster
+    :param band: the raster band
+    :return: dict of the memory-mapped 'min' and 'max' tables and the number of 'levels', or None
+    """
+
+    path = index_path(raster)
+    meta_file = os.path.join(path, 'meta.json')
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file) as f:
+        meta = json.load(f)
+    if meta.get('version') != INDEX_VERSION or meta.get('band') != band:
+        return None
+    if meta.get('fingerprint') != raster_fingerprint(raster):
+        log.warning(f'ignoring the index of {os.path.basename(raster)}, which is older than the raster; rebuild it '
+                    f'with raster_index')
+        return None
+
+    index = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in INDEX_ARRAYS}
+    index['levels'] = meta['levels']
+
+    return index
+
+
+def run_stats(index: dict, rows, col_min, col_max, stats=('min',)):
+    """
+    Statistics over runs of cells along rows of an indexed raster
+    :param index: an index from open_index
+    :param rows: array of the row of each run
+    :param col_min: array of the first column of each run
+    :param col_max: array of the column after the last of each run (runs must hold at least one cell)
+    :param stats: statistics to compute, 'min' and/or 'max'
+    :return: dict of stat name to array of values; NaN for runs with no valid cells
+    """
+
+    rows, col_min, col_max = (np.asarray(a, dtype=np.int64) for a in (rows, col_min, col_max))
+    out = {}
+    for stat in stats:
+        if stat in ('min', 'max'):
+            table, fn = (index['min'], np.fmin) if stat == 'min' else (index['max'], np.fmax)
+            # the widest level that fits in each run; runs wider than twice the widest level take more lookups
+            width = col_max - col_min
+            level = np.minimum(np.floor(np.log2(width)).astype(np.int64), index['levels'] - 1)
+            step = 2 ** level
+            res = table[level, rows, col_min].astype(np.float64)
+            for t in range(1, int(np.ceil((width / step).max())) if len(width) else 0):
+                res = fn(res, table[level, rows, np.minimum(col_min + t * step, col_max - step)])
+            out[stat] = res
+        else:
+            raise Exception(f'Unsupported statistic: {stat}')
+
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('raster', help='Path to a raster (e.g., a DEM, drainage area or precipitation raster) to index '
+                                       'for the tools that sample it.', type=str)
+    parser.add_argument('--band', help='The band to index.', type=int, default=1)
+    parser.add_argument('--max_width', help='The widest run of cells along a row whose min and max take two lookups.',
+                        type=int, default=64)
+    parser.add_argument('--block_rows', help='The number of rows read at a time.', type=int, default=1024)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrumented(args.trace, args.profile, args.log_level):
+        build_index(args.raster, args.band, args.max_width, args.block_rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,579 @@
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from shapely.geos import WKBWriter, lgeos
+from tools.raster_index import open_index, run_stats
+from tools.workers import process_pool
+
+
+def line_coords(geoms):
+    """
+    Extracts the vertices of a sequence of line geometries into a single array. Shapely 1.8 has no array access to the
+    coordinates of many geometries, so every line is written as 2D WKB by one reused GEOS writer and the vertices are
+    then cut out of the joined WKB as a whole, rather than converting each line's coordinates to an array
+    :param geoms: an iterable of LineStrings (e.g., a GeoSeries)
+    :return: an (n, 2) array of all vertex coordinates and an array of offsets where offsets[i]:offsets[i+1] are the
+    rows of coords belonging to line i
+    """
+
+    writer = WKBWriter(lgeos, output_dimension=2, big_endian=False)
+    parts = [writer.write(geom) for geom in geoms]
+    sizes = np.fromiter(map(len, parts), dtype=np.int64, count=len(parts))
+    offsets = np.zeros(len(parts) + 1, dtype=np.int64)
+    if len(parts) == 0:
+        return np.empty((0, 2)), offsets
+
+    # each line is a 9 byte header (byte order, geometry type, number of vertices) followed by its x, y doubles; an
+    # empty geometry is a header alone
+    wkb = np.frombuffer(b''.join(parts), dtype=np.uint8)
+    starts = np.cumsum(sizes) - sizes
+    header = starts[:, None] + np.arange(9)
+    if ((wkb[header[:, 1]] != 2) & (sizes > 9)).any():
+        raise Exception('Only LineString geometries are supported')
+    np.cumsum((sizes - 9) // 16, out=offsets[1:])
+    keep = np.ones(len(wkb), dtype=bool)
+    keep[header.ravel()] = False
+
+    return wkb[keep].view('<f8').reshape(-1, 2), offsets
+
+
+def line_endpoints(geoms):
+    """
+    Returns the start and end vertices of every line
+    :param geoms: an iterable of LineStrings
+    :return: arrays start_x, start_y, end_x, end_y
+    """
+
+    coords, offsets = line_coords(geoms)
+    start = coords[offsets[:-1]]
+    end = coords[offsets[1:] - 1]
+
+    return start[:, 0], start[:, 1], end[:, 0], end[:, 1]
+
+
+def line_midpoints(geoms):
+    """
+    Returns the middle vertex of every line (the vertex at index int(n_vertices / 2))
+    :param geoms: an iterable of LineStrings
+    :return: arrays mid_x, mid_y
+    """
+
+    coords, offsets = line_coords(geoms)
+    mid = coords[offsets[:-1] + np.diff(offsets) // 2]
+
+    return mid[:, 0], mid[:, 1]
+
+
+def line_stations(geoms, spacing: float):
+    """
+    Places stations at a regular spacing along every line, starting at its first vertex and always including its last
+    vertex, for all lines at once
+    :param geoms: an iterable of LineStrings
+    :param spacing: the distance between stations along a line
+    :return: arrays of station x, y and distance along its line, and an array of offsets where offsets[i]:offsets[i+1]
+    are the stations of line i
+    """
+
+    coords, offsets = line_coords(geoms)
+    n_lines = len(offsets) - 1
+    step = np.hypot(*np.diff(coords, axis=0).T) if len(coords) > 1 else np.zeros(0)
+    # steps between the last vertex of one line and the first of the next don't count
+    step[offsets[1:-1] - 1] = 0.
+    cum = np.zeros(len(coords))
+    np.cumsum(step, out=cum[1:])
+    start = cum[offsets[:-1]] if n_lines > 0 else np.zeros(0)
+    length = cum[offsets[1:] - 1] - start if n_lines > 0 else np.zeros(0)
+
+    counts = np.ceil(length / spacing).astype(np.int64) + 1
+    station_offsets = np.zeros(n_lines + 1, dtype=np.int64)
+    np.cumsum(counts, out=station_offsets[1:])
+    line = np.repeat(np.arange(n_lines), counts)
+    dist = np.minimum((np.arange(station_offsets[-1]) - station_offsets[line]) * spacing, length[line])
+
+    # the vertex each station follows, kept within its own line
+    seg = np.searchsorted(cum, start[line] + dist, side='right') - 1
+    seg = np.clip(seg, offsets[line], np.maximum(offsets[line + 1] - 2, offsets[line]))
+    nxt = np.minimum(seg + 1, offsets[line + 1] - 1)
+    seg_len = cum[nxt] - cum[seg]
+    t = np.divide(start[line] + dist - cum[seg], seg_len, out=np.zeros(len(dist)), where=seg_len > 0)
+    xy = coords[seg] + (coords[nxt] - coords[seg]) * t[:, None]
+
+    return xy[:, 0], xy[:, 1], dist, station_offsets
+
+
+def disk_offsets(radius: float, transform):
+    """
+    Row and column offsets of every pixel that could have its center within radius of a point in the center pixel
+    :param radius: search radius in raster crs units
+    :param transform: the raster affine transform
+    :return: arrays of row offsets and column offsets
+    """
+
+    res = min(abs(transform.a), abs(transform.e))
+    k = int(np.ceil(radius / res)) + 1
+    drow, dcol = np.mgrid[-k:k + 1, -k:k + 1]
+
+    return drow.ravel(), dcol.ravel()
+
+
+def block_tiles(block_shape, halo: int, max_bytes: float, itemsize: int = 8):
+    """
+    Chooses the size of the windows used to read a raster as a whole number of its internal blocks, so that a window
+    and the halo around it fit within a memory budget
+    :param block_shape: the raster's internal (rows, cols) block shape
+    :param halo: the number of extra cells read on each side of a window
+    :param max_bytes: the memory budget for one window
+    :param itemsize: bytes per cell once read
+    :return: window height and width in cells
+    """
+
+    bh, bw = block_shape
+    n = max(int(np.sqrt(max_bytes / itemsize / (bh * bw))), 1)
+    while n > 1 and (n * bh + 2 * halo) * (n * bw + 2 * halo) * itemsize > max_bytes:
+        n -= 1
+
+    return n * bh, n * bw
+
+
+def buffer_half_width(dy, radius: float):
+    """
+    Half the width of a buffered point at a distance from the point across the rows of a raster. Points are buffered
+    the way shapely buffers them, as a polygon of 64 vertices on the circle (16 per quarter, starting due east) rather
+    than as a true circle
+    :param dy: array of distances from the point along the raster's columns (e.g., pixel center y - point y)
+    :param radius: buffer distance in raster crs units
+    :return: array of half widths; NaN where the buffer doesn't reach
+    """
+
+    angles = np.linspace(0., np.pi / 2, 17)
+    vx, vy = np.cos(angles), np.sin(angles)
+    # the buffer is a single point wide at its northern and southern vertices, where GDAL fills no pixels
+    vx[-1] = 0.
+    ady = np.abs(np.asarray(dy, dtype=np.float64)) / radius
+    k = np.clip(np.searchsorted(vy, ady, side='right') - 1, 0, 15)
+    t = (ady - vy[k]) / (vy[k + 1] - vy[k])
+    half = radius * (vx[k] + t * (vx[k + 1] - vx[k]))
+
+    return np.where(ady <= 1., half, np.nan)
+
+
+def in_buffer(transform, xs, ys, rows, cols, drow, dcol, radius: float):
+    """
+    Which of the pixels around points are part of their buffers, as with zonal statistics of a buffered point: GDAL
+    fills the pixels whose centers lie inside the buffer polygon (see buffer_half_width), counting centers on its
+    edge at the eastern end of each row but not the western end. The pixel containing a point is always included
+    :param transform: the raster affine transform
+    :param xs: array of point x coordinates
+    :param ys: array of point y coordinates
+    :param rows: (points, offsets) array of pixel rows around each point
+    :param cols: (points, offsets) array of pixel columns around each point
+    :param drow: the row offsets from disk_offsets
+    :param dcol: the column offsets from disk_offsets
+    :param radius: buffer distance in raster crs units
+    :return: (points, offsets) boolean array
+    """
+
+    cx, cy = transform * (cols + 0.5, rows + 0.5)
+    dx = cx - xs[:, None]
+    half = buffer_half_width(cy - ys[:, None], radius)
+    inside = (dx > -half) & (dx <= half)
+    inside |= (drow == 0) & (dcol == 0)
+
+    return inside
+
+
+def _index_stats(index: dict, transform, height: int, width: int, xs, ys, radius: float, stats):
+    """
+    Computes buffered minima and maxima for points from a raster index rather than the raster: each row of a buffer
+    is a run of cells whose extremes are read from the index
+    :param index: an index from tools.raster_index.open_index
+    :param transform: the raster affine transform
+    :param height: raster rows
+    :param width: raster columns
+    :param xs: array of point x coordinates
+    :param ys: array of point y coordinates
+    :param radius: buffer distance in raster crs units
+    :param stats: statistics to compute, 'min' and/or 'max'
+    :return: dict of stat name to array of values for the points
+    """
+
+    out = {stat: np.full(len(xs), np.nan) for stat in stats}
+    cols_f, rows_f = ~transform * (xs, ys)
+    rows0 = np.floor(rows_f).astype(np.int64)
+    cols0 = np.floor(cols_f).astype(np.int64)
+    k = int(disk_offsets(radius, transform)[0].max())
+    drow = np.arange(-k, k + 1)
+
+    # the cells of a buffer in each row are a single run; its ends are found from the buffer polygon and then checked
+    # (and moved by a cell where rounding put them on the wrong side of the edge) with the test used to read pixels
+    rows = rows0[:, None] + drow[None, :]
+    dy = (transform * (np.zeros(rows.shape), rows + 0.5))[1] - ys[:, None]
+    half = np.nan_to_num(buffer_half_width(dy, radius), nan=0.)
+    lo = np.ceil((xs[:, None] - half - transform.c) / transform.a - 0.5).astype(np.int64)
+    hi = np.floor((xs[:, None] + half - transform.c) / transform.a - 0.5).astype(np.int64)
+
+    def inside(cols):
+        return in_buffer(transform, xs, ys, rows, cols, drow[None, :], cols - cols0[:, None], radius)
+
+    lo = np.where(inside(lo - 1), lo - 1, np.where(inside(lo), lo, lo + 1))
+    hi = np.where(inside(hi + 1), hi + 1, np.where(inside(hi), hi, hi - 1))
+    lo[:, k] = np.minimum(lo[:, k], cols0)
+    hi[:, k] = np.maximum(hi[:, k], cols0)
+    lo = np.maximum(lo, 0)
+    hi = np.minimum(hi, width - 1)
+    point, offset = np.nonzero((lo <= hi) & (rows >= 0) & (rows < height))
+    if len(point) == 0:
+        return out
+
+    runs = run_stats(index, rows[point, offset], lo[point, offset], hi[point, offset] + 1, stats)
+    # runs are ordered by point, so each point's runs are a contiguous slice
+    starts = np.flatnonzero(np.r_[True, np.diff(point) > 0])
+    has = point[starts]
+    for stat in stats:
+        fn = np.fmin if stat == 'min' else np.fmax
+        out[stat][has] = fn.reduceat(runs[stat], starts)
+
+    return out
+
+
+def _tile_stats(raster: str, band: int, xs, ys, tiles: list, radii, stats, chunk_size: int):
+    """
+    Computes buffered statistics for points that are grouped by the raster window they are read from, for one or more
+    buffer distances. This is the unit of work of buffered_stats; each call opens the raster itself so windows are
+    read straight from the file rather than passed between processes
+    :param raster: path to a raster
+    :param band: the raster band to sample
+    :param xs: array of point x coordinates, ordered by window
+    :param ys: array of point y coordinates, ordered by window
+    :param tiles: list of (row_min, row_max, col_min, col_max, n) windows, each covering the next n points
+    :param radii: buffer distances in raster crs units
+    :param stats: statistics to compute
+    :param chunk_size: number of points processed at once
+    :return: dict of radius to dict of stat name to array of values for the points
+    """
+
+    out = {radius: {stat: np.full(len(xs), np.nan) for stat in stats} for radius in radii}
+    with rasterio.open(raster) as src:
+        transform = src.transform
+        cols_f, rows_f = ~transform * (xs, ys)
+        rows0 = np.floor(rows_f).astype(np.int64)
+        cols0 = np.floor(cols_f).astype(np.int64)
+        drow, dcol = disk_offsets(max(radii), transform)
+
+        first = 0
+        for row_min, row_max, col_min, col_max, n in tiles:
+            group = np.arange(first, first + n)
+            first += n
+            window = Window(col_min, row_min, col_max - col_min, row_max - row_min)
+            arr = src.read(band, window=window, masked=True).astype(np.float64).filled(np.nan)
+
+            for start in range(0, len(group), chunk_size):
+                idx = group[start:start + chunk_size]
+                rows = rows0[idx, None] + drow[None, :]
+                cols = cols0[idx, None] + dcol[None, :]
+                in_window = (rows >= row_min) & (rows < row_max) & (cols >= col_min) & (cols < col_max)
+                window_vals = np.full(rows.shape, np.nan)
+                window_vals[in_window] = arr[rows[in_window] - row_min, cols[in_window] - col_min]
+
+                for radius in radii:
+                    inside = in_buffer(transform, xs[idx], ys[idx], rows, cols, drow, dcol, radius)
+                    vals = np.where(inside, window_vals, np.nan)
+                    valid = ~np.isnan(vals).all(axis=1)
+                    for stat in stats:
+                        if stat == 'min':
+                            res = np.nanmin(vals[valid], axis=1)
+                        elif stat == 'max':
+                            res = np.nanmax(vals[valid], axis=1)
+                        else:
+                            res = np.nanmean(vals[valid], axis=1)
+                        out[radius][stat][idx[valid]] = res
+
+    return out
+
+
+def buffered_stats(raster: str, xs, ys, radius: float, stats=('min',), band: int = 1, chunk_size: int = 50000,
+                   block_cache_mb: float = 256., workers: int = None, use_index: bool = True):
+    """
+    Computes statistics of raster values within a radius of many points in a single batched pass. A pixel is part of
+    a point's buffer if its center is inside the polygon shapely buffers the point with (as with zonal statistics of
+    a buffered point, see in_buffer); the pixel containing the point is always included. Points are grouped into
+    windows aligned to the raster's internal blocks and each window is read once, so memory use depends on
+    block_cache_mb rather than on the size of the raster.
+    :param raster: path to a raster
+    :param xs: array of point x coordinates (raster crs)
+    :param ys: array of point y coordinates (raster crs)
+    :param radius: buffer distance in raster crs units
+    :param stats: statistics to compute, any of 'min', 'max', 'mean'
+    :param band: the raster band to sample
+    :param chunk_size: number of points processed at once (bounds memory use)
+    :param block_cache_mb: the maximum size in MB of the raster window held in memory at once (per worker)
+    :param workers: if greater than 1, the windows are shared out between this many worker processes, each reading
+    its own windows from the raster
+    :param use_index: if True and the raster (north-up) has an index (see tools.raster_index), minima and maxima are
+    read from the index rather than the raster, with two lookups per row of a buffer; means are always read from the
+    raster
+    :return: dict of stat name to array of values; NaN where the buffer contains no valid pixels
+    """
+
+    return buffered_stats_radii(raster, xs, ys, (radius,), stats, band, chunk_size, block_cache_mb, workers,
+                                use_index)[radius]
+
+
+def buffered_stats_radii(raster: str, xs, ys, radii, stats=('min',), band: int = 1, chunk_size: int = 50000,
+                         block_cache_mb: float = 256., workers: int = None, use_index: bool = True):
+    """
+    Computes buffered_stats around the same points for several buffer distances in one pass: windows are read once,
+    with room for the largest buffer, and the statistics of every buffer are taken from them. Results are the same as
+    calling buffered_stats for each distance. Parameters are as for buffered_stats
+    :param radii: buffer distances in raster crs units
+    :return: dict of radius to dict of stat name to array of values
+    """
+
+    for stat in stats:
+        if stat not in ('min', 'max', 'mean'):
+            raise Exception(f'Unsupported statistic: {stat}')
+
+    radii = tuple(dict.fromkeys(radii))
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    out = {radius: {stat: np.full(len(xs), np.nan) for stat in stats} for radius in radii}
+    if len(xs) == 0:
+        return out
+
+    with rasterio.open(raster) as src:
+        transform = src.transform
+        height, width = src.height, src.width
+        block_shape = src.block_shapes[band - 1]
+    # the index is read along rows, so it is only used for north-up rasters
+    north_up = transform.b == 0 and transform.d == 0 and transform.a > 0
+    index = open_index(raster, band) if use_index and north_up and 'mean' not in stats else None
+    if index is not None:
+        for radius in radii:
+            for start in range(0, len(xs), chunk_size):
+                res = _index_stats(index, transform, height, width, xs[start:start + chunk_size],
+                                   ys[start:start + chunk_size], radius, stats)
+                for stat in stats:
+                    out[radius][stat][start:start + chunk_size] = res[stat]
+        return out
+
+    cols_f, rows_f = ~transform * (xs, ys)
+    rows0 = np.floor(rows_f).astype(np.int64)
+    cols0 = np.floor(cols_f).astype(np.int64)
+    k = int(disk_offsets(max(radii), transform)[0].max())
+
+    tiles, order = point_windows(rows0, cols0, k, block_shape, block_cache_mb * 2**20, height, width)
+    if len(tiles) == 0:
+        return out
+
+    if workers is None or workers <= 1 or len(tiles) == 1:
+        shards = [(order, tiles)]
+        results = [_tile_stats(raster, band, xs[order], ys[order], tiles, radii, stats, chunk_size)]
+    else:
+        with process_pool(workers) as executor:
+            shards = tile_shards(tiles, order, workers)
+            futures = [executor.submit(_tile_stats, raster, band, xs[sel], ys[sel], shard, radii, stats, chunk_size)
+                       for sel, shard in shards]
+            results = [future.result() for future in futures]
+
+    for (sel, _), res in zip(shards, results):
+        for radius in radii:
+            for stat in stats:
+                out[radius][stat][sel] = res[radius][stat]
+
+    return out
+
+
+def point_windows(rows0, cols0, halo: int, block_shape, max_bytes: float, height: int, width: int):
+    """
+    Groups points by the block-aligned raster window they fall in, so each window is read once
+    :param rows0: array of the row of the cell each point is in
+    :param cols0: array of the column of the cell each point is in
+    :param halo: the number of extra cells read on each side of a window
+    :param block_shape: the raster's internal (rows, cols) block shape
+    :param max_bytes: the memory budget for one window (see block_tiles)
+    :param height: raster rows
+    :param width: raster columns
+    :return: list of (row_min, row_max, col_min, col_max, n) windows and an array ordering the points by window, so
+    window i covers the next n points of the order; points in no window are left out
+    """
+
+    tile_h, tile_w = block_tiles(block_shape, halo, max_bytes)
+    tile_r = rows0 // tile_h
+    tile_c = cols0 // tile_w
+    order = np.lexsort((tile_c, tile_r))
+    bounds = np.flatnonzero(np.diff(tile_r[order]) | np.diff(tile_c[order])) + 1
+    tiles = []
+    keep = []
+    for group in np.split(order, bounds):
+        tr, tc = tile_r[group[0]], tile_c[group[0]]
+        row_min = max(int(tr * tile_h) - halo, 0)
+        row_max = min(int((tr + 1) * tile_h) + halo, height)
+        col_min = max(int(tc * tile_w) - halo, 0)
+        col_max = min(int((tc + 1) * tile_w) + halo, width)
+        if row_min >= row_max or col_min >= col_max:
+            continue
+        tiles.append((row_min, row_max, col_min, col_max, len(group)))
+        keep.append(group)
+    if len(tiles) == 0:
+        return tiles, np.zeros(0, dtype=np.int64)
+
+    return tiles, np.concatenate(keep)
+
+
+def tile_shards(tiles: list, order, workers: int):
+    """
+    Splits windows into contiguous runs with about the same number of points, one for each worker; results put back
+    in point order are identical to a serial run
+    :param tiles: list of windows from point_windows
+    :param order: the point order from point_windows
+    :param workers: the number of workers
+    :return: list of (points, windows) pairs: an array of the points of a run and its list of windows
+    """
+
+    counts = np.array([t[4] for t in tiles])
+    ends = np.cumsum(counts)
+    cuts = np.searchsorted(ends, ends[-1] * np.arange(1, workers) / workers, side='right')
+    shards = []
+    for a, b in zip(np.r_[0, cuts], np.r_[cuts, len(tiles)]):
+        if b > a:
+            p0 = ends[a - 1] if a > 0 else 0
+            shards.append((order[p0:ends[b - 1]], tiles[a:b]))
+
+    return shards
+
+
+def _tile_bilinear(raster: str, band: int, xs, ys, tiles: list):
+    """
+    Bilinearly interpolates raster values at points that are grouped by the raster window they are read from; the
+    unit of work of bilinear_sample
+    :param raster: path to a raster
+    :param band: the raster band to sample
+    :param xs: array of point x coordinates, ordered by window
+    :param ys: array of point y coordinates, ordered by window
+    :param tiles: list of (row_min, row_max, col_min, col_max, n) windows, each covering the next n points
+    :return: array of values for the points
+    """
+
+    out = np.full(len(xs), np.nan)
+    with rasterio.open(raster) as src:
+        cols_f, rows_f = ~src.transform * (xs, ys)
+        # positions relative to the centres of the four surrounding cells
+        r, c = rows_f - 0.5, cols_f - 0.5
+        r0, c0 = np.floor(r).astype(np.int64), np.floor(c).astype(np.int64)
+        fr, fc = r - r0, c - c0
+
+        first = 0
+        for row_min, row_max, col_min, col_max, n in tiles:
+            idx = np.arange(first, first + n)
+            first += n
+            window = Window(col_min, row_min, col_max - col_min, row_max - row_min)
+            arr = src.read(band, window=window, masked=True).astype(np.float64).filled(np.nan)
+
+            total = np.zeros(n)
+            weight = np.zeros(n)
+            for dr, dc in ((0, 0), (0, 1), (1, 0), (1, 1)):
+                # cells off the window (at the edge of the raster) take the value of the nearest cell on it
+                rows = np.clip(r0[idx] + dr, row_min, row_max - 1) - row_min
+                cols = np.clip(c0[idx] + dc, col_min, col_max - 1) - col_min
+                w = (fr[idx] if dr else 1 - fr[idx]) * (fc[idx] if dc else 1 - fc[idx])
+                vals = arr[rows, cols]
+                valid = ~np.isnan(vals)
+                total[valid] += w[valid] * vals[valid]
+                weight[valid] += w[valid]
+            # nodata cells are left out and the weights of the others scaled up
+            has = weight > 0
+            out[idx[has]] = total[has] / weight[has]
+
+    return out
+
+
+def bilinear_sample(raster: str, xs, ys, band: int = 1, block_cache_mb: float = 256., workers: int = None):
+    """
+    Bilinearly interpolates raster values at many points in a single batched pass. Points are grouped into windows
+    aligned to the raster's internal blocks and each window is read once, as in buffered_stats
+    :param raster: path to a raster
+    :param xs: array of point x coordinates (raster crs)
+    :param ys: array of point y coordinates (raster crs)
+    :param band: the raster band to sample
+    :param block_cache_mb: the maximum size in MB of the raster window held in memory at once (per worker)
+    :param workers: if greater than 1, the windows are shared out between this many worker processes
+    :return: array of values; NaN off the raster or where all four surrounding cells are nodata
+    """
+
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    out = np.full(len(xs), np.nan)
+    if len(xs) == 0:
+        return out
+
+    with rasterio.open(raster) as src:
+        transform = src.transform
+        height, width = src.height, src.width
+        block_shape = src.block_shapes[band - 1]
+    cols_f, rows_f = ~transform * (xs, ys)
+    rows0 = np.floor(rows_f).astype(np.int64)
+    cols0 = np.floor(cols_f).astype(np.int64)
+    on = (rows0 >= 0) & (rows0 < height) & (cols0 >= 0) & (cols0 < width)
+    points = np.flatnonzero(on)
+
+    tiles, order = point_windows(rows0[on], cols0[on], 1, block_shape, block_cache_mb * 2**20, height, width)
+    if len(tiles) == 0:
+        return out
+    order = points[order]
+
+    if workers is None or workers <= 1 or len(tiles) == 1:
+        out[order] = _tile_bilinear(raster, band, xs[order], ys[order], tiles)
+        return out
+
+    with process_pool(workers) as executor:
+        futures = [(sel, executor.submit(_tile_bilinear, raster, band, xs[sel], ys[sel], shard))
+                   for sel, shard in tile_shards(tiles, order, workers)]
+        for sel, future in futures:
+            out[sel] = future.result()
+
+    return out
+
+
+def endpoint_elevations(geoms, dem: str, radius: float, samples: dict = None, block_cache_mb: float = 256.,
+                        workers: int = None):
+    """
+    Minimum dem value within a radius of the start and end point of every line, sampled in one pass
+    :param geoms: an iterable of LineStrings
+    :param dem: path to a dem
+    :param radius: buffer distance in dem crs units
+    :param samples: an optional dict used to reuse values sampled earlier for the same lines, dem and radius; if other
+    radii are shared for the dem (see share_endpoint_radii), they are sampled in the same pass and kept in it too
+    :param block_cache_mb: the maximum size in MB of the dem window held in memory at once
+    :param workers: the number of worker processes to sample with (serial if None or 1)
+    :return: arrays of start elevations and end elevations
+    """
+
+    key = ('endpoint_min', dem, radius)
+    if samples is not None and key in samples:
+        return samples[key]
+
+    radii = (radius,) + tuple(samples.get(('endpoint_radii', dem), ()) if samples is not None else ())
+    sx, sy, ex, ey = line_endpoints(geoms)
+    res = buffered_stats_radii(dem, np.concatenate([sx, ex]), np.concatenate([sy, ey]), radii, stats=('min',),
+                               block_cache_mb=block_cache_mb, workers=workers)
+    for r in res:
+        elevs = res[r]['min']
+        if samples is not None:
+            samples[('endpoint_min', dem, r)] = elevs[:len(sx)], elevs[len(sx):]
+
+    elevs = res[radius]['min']
+
+    return elevs[:len(sx)], elevs[len(sx):]
+
+
+def share_endpoint_radii(samples: dict, dem: str, radii):
+    """
+    Records buffer distances that several tools will sample the end points of the same lines at, so that the first
+    call to endpoint_elevations on the dem samples them all in one pass over the dem
+    :param samples: the dict of samples shared by the tools
+    :param dem: path to a dem
+    :param radii: buffer distances in dem crs units
+    :return:
+    """
+
+    samples[('endpoint_radii', dem)] = tuple(radii)
@@ -1,7 +1,14 @@
 import argparse
+import logging
 import geopandas as gpd
-from shapely.geometry import Point, LineString, MultiPoint
-from shapely.ops import split
+import numpy as np
+from geopandas.array import GeometryArray
+from shapely.geometry import LineString
+from tools.raster_sampling import line_coords
+from tools.network_io import read_network, write_network
+from tools.telemetry import phase, add_arguments, instrumented
+
+log = logging.getLogger(__name__)
 
 
 def split_network(network: str, seg_length: int, out_file: str, epsg_out: int = None): # , out_file, retain_atts):
@@ -14,50 +21,238 @@ def split_network(network: str, seg_length: int, out_file: str, epsg_out: int =
     :return:
     """
 
-    dn = gpd.read_file(network)
+    with phase('read'):
+        dn = read_network(network)
 
     # check for projected crs
     if not dn.crs.is_projected:
-        dn.to_crs(epsg=epsg_out)
+        if epsg_out is None:
+            raise Exception('Drainage network has a geographic crs: provide a projected epsg to segment it in')
+        dn = dn.to_crs(epsg=epsg_out)
+
+    with phase('segmenting'):
+        out_dn = segment_lines(dn, seg_length)
+    with phase('write'):
+        write_network(out_dn, out_file)
+
+
+def segment_lines(dn: gpd.GeoDataFrame, seg_length: float):
+    """
+    Splits the lines of a drainage network in memory. Split vertices are found for all lines at once, and the pieces
+    are those shapely.ops.split makes when splitting each line at its split vertices, down to the split vertex it
+    repeats in a piece when its running distance along the line rounds past the split point
+    :param dn: a drainage network GeoDataFrame with a projected crs
+    :param seg_length: the desired approximate segment length (in the network projection units)
+    :return: a new GeoDataFrame of segments with 'length' and 'parent_id' fields
+    """
+
+    # distance between consecutive vertices over the whole network (pairs spanning two features are never used)
+    coords, offsets = line_coords(dn.geometry)
+    dx = np.diff(coords[:, 0])
+    dy = np.diff(coords[:, 1])
+    step = np.sqrt(dx*dx + dy*dy)
+    lengths = dn.geometry.length.values
 
     # check that vertex density is reasonable for splitting to the segment length
-    tot_len = 0
-    verts = 0
-    for i in dn.index:
-        tot_len += dn.loc[i].geometry.length
-        verts += len(dn.loc[i].geometry.coords.xy[0])
+    tot_len = lengths.sum()
+    verts = len(coords)
     if tot_len - verts < 0.2 * seg_length:
         raise Exception('Few line vertices relative to the input segmentation length: densify network vertices')
 
-    out_features = []
-
-    for i in dn.index:
-        print(f'segmenting feature {i+1} of {len(dn.index)}')
-        if dn.loc[i].geometry.length <= seg_length:
-            out_features.append(dn.loc[i].geometry)
-        else:
-            feature = dn.loc[i].geometry
-            vertices = feature.coords
-            dist = 0
-            pts = []
-            for x in range(len(vertices.xy[0])-1):
-                l = LineString([(vertices.xy[0][x], vertices.xy[1][x]), (vertices.xy[0][x+1], vertices.xy[1][x+1])])
-                dist += l.length
-                if dist >= seg_length:
-                    pts.append([vertices.xy[0][x], vertices.xy[1][x]])
-                    dist = 0
-            if len(pts) > 1:
-                pt = MultiPoint(pts)
-            else:
-                pt = Point(pts[0])
-            ls = split(feature, pt)
-            for f in ls:
-                out_features.append(f)
-            print(f'split feature into {len(ls)} features')
-
-    d = {'length': [ftr.length for ftr in out_features], 'geometry': out_features}
+    starts, ends = offsets[:-1], offsets[1:] - 1
+    long = np.flatnonzero(lengths > seg_length)
+    line, cut = split_vertices(step, starts[long], ends[long], seg_length)
+    line = long[line]
+
+    # a split vertex repeating the first vertex of the piece being split, or the last vertex of the line, is not in the
+    # piece's interior and shapely leaves the piece whole, so the next split vertex splits a longer piece
+    keep = np.ones(len(cut), dtype=bool)
+    while True:
+        first = previous_cut(line[keep], cut[keep], starts)
+        split_at = coords[cut[keep]]
+        skip = (split_at == coords[first]).all(axis=1) | (split_at == coords[ends[line[keep]]]).all(axis=1)
+        if not skip.any():
+            break
+        keep[np.flatnonzero(keep)[skip]] = False
+    line, cut = line[keep], cut[keep]
+    first = previous_cut(line, cut, starts)
+
+    # shapely finds the split vertex in the piece being split by comparing its distance along the piece (summed by
+    # GEOS) with a running sum of vertex pair lengths (summed in Python with ** powers, which float_power reproduces):
+    # the first pair where the running sum reaches that distance is split at its end vertex if the two are equal,
+    # otherwise the split vertex is inserted after the start vertex of the pair
+    py_step = np.float_power(np.float_power(dx, 2.) + np.float_power(dy, 2.), .5)
+    along = run_totals(step, first, cut - 1)
+    pair = first_reaching(py_step, first, np.minimum(cut + 1, ends[line] - 1), along)
+    missed = np.flatnonzero(pair < 0)
+    pair[missed] = first_reaching(py_step, first[missed], ends[line[missed]] - 1, along[missed])
+    exact = run_totals(py_step, first, pair) == along
+
+    # each piece runs from the vertex after a split pair (or the start of its line) to the end of the next split pair
+    # (or the end of its line), with the split vertex repeated on both sides of an inexact split
+    n_pieces = np.bincount(line, minlength=len(dn)) + 1
+    piece_line = np.repeat(np.arange(len(dn)), n_pieces)
+    before = np.searchsorted(piece_line, line) + np.arange(len(cut)) - np.searchsorted(line, line)
+    lo, hi = starts[piece_line], ends[piece_line]
+    lo[before + 1] = pair + 1
+    hi[before] = np.where(exact, pair + 1, pair)
+    lead = np.full(len(piece_line), -1, dtype=np.int64)
+    trail = np.full(len(piece_line), -1, dtype=np.int64)
+    lead[before + 1] = np.where(exact, -1, cut)
+    trail[before] = np.where(exact, -1, cut)
+
+    counts = hi - lo + 1 + (lead >= 0) + (trail >= 0)
+    piece_end = np.cumsum(counts)
+    index = np.repeat(lo - (lead >= 0) - piece_end + counts, counts) + np.arange(piece_end[-1] if len(counts) else 0)
+    index[(piece_end - counts)[lead >= 0]] = lead[lead >= 0]
+    index[(piece_end - 1)[trail >= 0]] = trail[trail >= 0]
+    piece_coords = coords[index]
+
+    # piece lengths are the pair lengths from split vertex to split vertex added up in order, as GEOS does
+    from_vertex, to_vertex = starts[piece_line], ends[piece_line]
+    from_vertex[before + 1] = cut
+    to_vertex[before] = cut
+    piece_lengths = run_totals(step, from_vertex, to_vertex - 1)
+
+    # lines left whole keep their geometry; Shapely 1.8 has no array constructor, so pieces are built one at a time
+    whole = np.flatnonzero(n_pieces == 1)
+    geoms = np.empty(len(piece_line), dtype=object)
+    whole_piece = np.searchsorted(piece_line, whole)
+    geoms[whole_piece] = dn.geometry.values[whole]
+    piece_lengths[whole_piece] = lengths[whole]
+    for p in np.flatnonzero(n_pieces[piece_line] > 1):
+        geoms[p] = LineString(piece_coords[piece_end[p] - counts[p]:piece_end[p]])
+
+    log.info(f'segmented {len(dn.index)} features into {len(geoms)} features')
+
+    # the pieces are known to be lines, so they are wrapped as they are rather than re-validated one at a time
+    d = {'length': piece_lengths, 'parent_id': dn.index.values[piece_line], 'geometry': GeometryArray(geoms)}
     out_dn = gpd.GeoDataFrame(d, crs=dn.crs)
-    out_dn.to_file(out_file)
+
+    return out_dn
+
+
+def split_vertices(step, starts, ends, seg_length: float):
+    """
+    Finds the vertices to split lines at: the first vertex of each vertex pair at which the distance travelled since
+    the previous split reaches the segment length. Every line gets its next split at once: the cumulative length over
+    all vertices locates it, then the distance from the previous split is added up pair by pair up to there, so that
+    lines with evenly spaced vertices split at the same vertices as adding up the vertex pair lengths one at a time
+    :param step: array of distances between consecutive vertices (step[x] is the distance from vertex x to x+1)
+    :param starts: array of the first vertex of each line
+    :param ends: array of the last vertex of each line
+    :param seg_length: the desired segment length
+    :return: arrays of the line (position in starts) and the vertex of every split, ordered by line then vertex and
+    excluding the first vertex of each line
+    """
+
+    total = np.zeros(len(step) + 1)
+    np.cumsum(step, out=total[1:])
+    lines, splits = [], []
+    line = np.flatnonzero(ends > starts)
+    pos, last = starts[line], ends[line] - 1
+    while len(line):
+        guess = np.searchsorted(total, total[pos] + seg_length, side='left') - 1
+        hit = first_reaching(step, pos, np.clip(guess + 2, pos, last), seg_length)
+        # the running sum can fall a few pairs short of the cumulative length (rounding, zero length pairs)
+        short = np.flatnonzero((hit < 0) & (guess + 2 < last))
+        hit[short] = first_reaching(step, pos[short], last[short], seg_length)
+        found = hit >= 0
+        line, hit, last = line[found], hit[found], last[found]
+        lines.append(line)
+        splits.append(hit)
+        pos = hit + 1
+        more = pos <= last
+        line, pos, last = line[more], pos[more], last[more]
+
+    line = np.concatenate(lines) if lines else np.empty(0, dtype=np.int64)
+    split = np.concatenate(splits) if splits else np.empty(0, dtype=np.int64)
+    order = np.lexsort((split, line))
+    line, split = line[order], split[order]
+    inner = split > starts[line]
+
+    return line[inner], split[inner]
+
+
+def previous_cut(line, cut, starts):
+    """
+    Returns the split vertex before every split vertex of a line, or the first vertex of the line for its first split
+    :param line: array of the line of every split, ordered by line then vertex
+    :param cut: array of split vertices
+    :param starts: array of the first vertex of each line
+    :return: array of vertex indices
+    """
+
+    prev = np.empty_like(cut)
+    prev[1:] = cut[:-1]
+    first = np.ones(len(cut), dtype=bool)
+    first[1:] = line[1:] != line[:-1]
+    prev[first] = starts[line[first]]
+
+    return prev
+
+
+def running_sums(values, starts, stops):
+    """
+    Adds up runs of an array in order, one value at a time, as a Python loop would (unlike np.sum, which adds pairwise).
+    Runs of similar length are stacked into 2D arrays and accumulated along their rows
+    :param values: array of values
+    :param starts: array of the first position of each run
+    :param stops: array of the last position of each run (a run is empty if stop < start)
+    :return: generator of (runs, sums, valid) with the positions of the runs in starts, the running sums of those runs
+    padded to the longest of them, and a mask of the sums that lie within their run
+    """
+
+    widths = np.maximum(stops - starts + 1, 0)
+    group = np.ceil(np.log2(np.maximum(widths, 1))).astype(np.int64)
+    for g in np.unique(group):
+        runs = np.flatnonzero(group == g)
+        cols = np.arange(max(widths[runs].max(), 1))
+        valid = cols < widths[runs, None]
+        idx = np.minimum(starts[runs, None] + cols, len(values) - 1)
+        yield runs, np.cumsum(np.where(valid, values[idx], 0.), axis=1), valid
+
+
+def run_totals(values, starts, stops):
+    """
+    Returns the sum of every run of an array, added up in order one value at a time
+    :param values: array of values
+    :param starts: array of the first position of each run
+    :param stops: array of the last position of each run
+    :return: array of run sums (0 for empty runs)
+    """
+
+    totals = np.zeros(len(starts))
+    if len(values) == 0:
+        return totals
+    for runs, sums, valid in running_sums(values, starts, stops):
+        totals[runs] = sums[:, -1]
+
+    return totals
+
+
+def first_reaching(values, starts, stops, target):
+    """
+    Returns, for every run of an array, the first position at which its running sum (added up in order) reaches a
+    target
+    :param values: array of values
+    :param starts: array of the first position of each run
+    :param stops: array of the last position of each run
+    :param target: the sum to reach, for all runs or per run
+    :return: array of positions in values, -1 where a run never reaches the target
+    """
+
+    hits = np.full(len(starts), -1, dtype=np.int64)
+    if len(values) == 0:
+        return hits
+    target = np.broadcast_to(target, starts.shape)
+    for runs, sums, valid in running_sums(values, starts, stops):
+        reached = (sums >= target[runs, None]) & valid
+        col = reached.argmax(axis=1)
+        ok = reached[np.arange(len(runs)), col]
+        hits[runs[ok]] = starts[runs[ok]] + col[ok]
+
+    return hits
 
 
 def main():
@@ -67,10 +262,12 @@ def main():
                                            'drainage network', type=int)
     parser.add_argument('out_network', help='Path to save the segmented output drainage network.', type=str)
     parser.add_argument('--epsg', help='An EPSG crs number if projecting the output to a new crs.', type=int)
+    add_arguments(parser)
 
     args = parser.parse_args()
 
-    split_network(args.network, args.seg_length, args.out_network, args.epsg)
+    with instrumented(args.trace, args.profile, args.log_level):
+        split_network(args.network, args.seg_length, args.out_network, args.epsg)
 
 
 if __name__ == '__main__':
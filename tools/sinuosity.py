@@ -1,55 +1,106 @@
 import argparse
 import geopandas as gpd
+import numpy as np
+from tools.network_io import read_network, write_network, is_parquet, parquet_crs, stream_parquet_columns
+from tools.raster_sampling import line_endpoints
+from tools.incremental import row_hashes, recompute
+from tools.telemetry import phase, add_arguments, instrumented
 
 
-def add_sinuosity(network: str, crs_epsg: int):
+def add_sinuosity(network: str, crs_epsg: int, chunk_size: int = None, incremental: bool = False):
     """
 
     :param network: path to a segmented drainage network layer
     :param crs_epsg: the epsg number of the network projection, or one to reproject the network to
+    :param chunk_size: if given and the network is GeoParquet, the network is streamed through in chunks of this many
+    segments rather than read into memory at once (it must already be in the crs_epsg projection)
+    :param incremental: if True, only segments whose geometry changed since the last run are recomputed
     :return:
     """
 
     # convert epsg number into crs dict
     sref = 'epsg:{}'.format(crs_epsg)
 
+    if chunk_size is not None and is_parquet(network):
+        if parquet_crs(network) != sref:
+            raise Exception(f'Network must be in projection {sref} to be processed in chunks')
+        with phase('streaming'):
+            stream_parquet_columns(network,
+                                   lambda geoms: {'Sinuosity': sinuosity(geoms), 'sin_hash': row_hashes(geoms)},
+                                   chunk_size)
+        return
+
     # read in network and check for projection
-    flowlines = gpd.read_file(network)
-    if flowlines['geometry'].crs == sref:
-        pass
-    else:
+    with phase('read'):
+        flowlines = read_network(network)
+    reprojected = flowlines['geometry'].crs != sref
+    if reprojected:
         flowlines = flowlines.to_crs(sref)
 
-    # create a list to store sinuosity values
-    sin = []
+    changed = update_sinuosity(flowlines, incremental)
+    if not changed.any() and not reprojected:
+        return
+
+    # only the new fields need writing if the geometry is unchanged
+    with phase('write'):
+        write_network(flowlines, network, columns=None if reprojected else ['Sinuosity', 'sin_hash'])
+
+
+def calc_sinuosity(flowlines: gpd.GeoDataFrame):
+    """
+    Adds the field 'Sinuosity' to a drainage network in memory
+    :param flowlines: a segmented drainage network GeoDataFrame with a projected crs
+    :return: the network with the 'Sinuosity' field
+    """
+
+    flowlines['Sinuosity'] = sinuosity(flowlines.geometry)
+
+    return flowlines
 
-    # iterate through each network segment, calculate slope and add to list
-    for i in flowlines.index:
-        # obtain the coordinates of the end points of each line segment
-        seg_geom = flowlines.loc[i].geometry
-        length = seg_geom.length
 
-        x_coord1 = seg_geom.coords.xy[0][0]
-        y_coord1 = seg_geom.coords.xy[1][0]
-        x_coord2 = seg_geom.coords.xy[0][-1]
-        y_coord2 = seg_geom.coords.xy[1][-1]
+def update_sinuosity(flowlines: gpd.GeoDataFrame, incremental: bool = False):
+    """
+    Adds the field 'Sinuosity' to a drainage network in memory along with a 'sin_hash' field identifying the geometry
+    each value was calculated from
+    :param flowlines: a segmented drainage network GeoDataFrame with a projected crs
+    :param incremental: if True, only segments whose geometry changed since the last run are recomputed
+    :return: boolean array of the recomputed segments
+    """
+
+    return recompute(flowlines, ['Sinuosity'], 'sin_hash', row_hashes(flowlines.geometry), calc_sinuosity,
+                     incremental)
+
+
+def sinuosity(geoms: gpd.GeoSeries):
+    """
+    The ratio of each line's length to the straight-line distance between its end points
+    :param geoms: a GeoSeries of LineStrings with a projected crs
+    :return: array of sinuosity values; NaN for lines whose end points coincide (e.g., closed loops)
+    """
+
+    length = geoms.length.values
+    x_coord1, y_coord1, x_coord2, y_coord2 = line_endpoints(geoms)
+    dist = np.sqrt((x_coord1-x_coord2)**2 + (y_coord1-y_coord2)**2)
 
-        dist = ((x_coord1-x_coord2)**2+(y_coord1-y_coord2)**2)**0.5
-        sin_val = length/dist
-        sin.append(sin_val)
+    sin = np.full(len(length), np.nan)
+    np.divide(length, dist, out=sin, where=dist > 0)
 
-    # add sinuosity values to network attribute table
-    flowlines['Sinuosity'] = sin
-    flowlines.to_file(network)
+    return sin
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('network', help='path to a segmented drainage network layer', type=str)
     parser.add_argument('epsg', help='the epsg number of the network projection, or one to reproject the network to', type=int)
+    parser.add_argument('--chunk_size', help='stream a GeoParquet network through in chunks of this many segments',
+                        type=int)
+    parser.add_argument('--incremental', help='only recompute segments that changed since the last run',
+                        action='store_true')
+    add_arguments(parser)
     args = parser.parse_args()
 
-    add_sinuosity(args.network, args.epsg)
+    with instrumented(args.trace, args.profile, args.log_level):
+        add_sinuosity(args.network, args.epsg, args.chunk_size, args.incremental)
 
 
 if __name__ == '__main__':
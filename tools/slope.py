@@ -1,10 +1,17 @@
 import argparse
 import geopandas as gpd
-from shapely.geometry import Point
-from rasterstats import zonal_stats
+import numpy as np
+import rasterio
+from tools.network_io import read_network, write_network
+from tools.raster_sampling import endpoint_elevations, line_stations, bilinear_sample
+from tools.incremental import raster_fingerprint, row_hashes, recompute
+from tools.telemetry import phase, add_arguments, instrumented
 
+PROFILE_FIELDS = ('Elev_Min', 'Elev_Max', 'Elev_Mean')
 
-def add_slope(network: str, dem: str, crs_epsg: int, search_dist: float):
+
+def add_slope(network: str, dem: str, crs_epsg: int, search_dist: float, block_cache_mb: float = 256.,
+              incremental: bool = False, workers: int = None, method: str = 'endpoints', spacing: float = None):
     """
 
     :param network: path to a segmented drainage network layer
@@ -12,6 +19,14 @@ def add_slope(network: str, dem: str, crs_epsg: int, search_dist: float):
     :param crs_epsg: epsg of the input datasets or one to project them into
     :param search_dist: a buffer distance in stream network input units to search for elevation values (accounts for
     positional error between the network and the dem
+    :param block_cache_mb: the maximum size in MB of the dem window held in memory at once
+    :param incremental: if True, only segments whose geometry (or the dem) changed since the last run are recomputed
+    :param workers: the number of worker processes to sample the dem with (serial if None or 1)
+    :param method: 'endpoints' takes the difference of the minimum elevations around the two end points of each
+    segment over its length; 'profile' fits a line to elevations sampled along the segment, and also adds its
+    minimum, maximum and mean elevation (see calc_profile_slope)
+    :param spacing: the distance between elevation samples along a segment for the profile method (defaults to the dem
+    cell size)
     :return:
     """
 
@@ -19,49 +34,157 @@ def add_slope(network: str, dem: str, crs_epsg: int, search_dist: float):
     sref = 'epsg:{}'.format(crs_epsg)
 
     # read in network and check for projection
-    flowlines = gpd.read_file(network)
-    if flowlines['geometry'].crs == sref:
-        pass
-    else:
+    with phase('read'):
+        flowlines = read_network(network)
+    reprojected = flowlines['geometry'].crs != sref
+    if reprojected:
         flowlines = flowlines.to_crs(sref)
 
-    # create a list to store slope values
-    slope = []
+    changed = update_slope(flowlines, dem, search_dist, incremental, block_cache_mb=block_cache_mb, workers=workers,
+                           method=method, spacing=spacing)
+    if not changed.any() and not reprojected:
+        return
+
+    # only the new fields need writing if the geometry is unchanged
+    with phase('write'):
+        write_network(flowlines, network, columns=None if reprojected else slope_fields(method) + ['slope_hash'])
+
+
+def calc_slope(flowlines: gpd.GeoDataFrame, dem: str, search_dist: float, samples: dict = None,
+               block_cache_mb: float = 256., workers: int = None):
+    """
+    Adds the field 'Slope' to a drainage network in memory
+    :param flowlines: a segmented drainage network GeoDataFrame in the dem projection
+    :param dem: path to a dem
+    :param search_dist: a buffer distance to search for elevation values
+    :param samples: an optional dict for reusing elevations sampled by other tools on the same network
+    :param block_cache_mb: the maximum size in MB of the dem window held in memory at once
+    :param workers: the number of worker processes to sample the dem with (serial if None or 1)
+    :return: the network with the 'Slope' field
+    """
+
+    length = flowlines.geometry.length.values
+
+    # obtain the minimum elevation within a buffer around each end point (the buffer accounts for positional
+    # discrepancy between DEM and network); both end points are sampled in one pass over the dem, reading it in
+    # block-aligned windows
+    with phase('sampling'):
+        elev1, elev2 = endpoint_elevations(flowlines.geometry, dem, search_dist, samples, block_cache_mb, workers)
+
+    # calculate the slope of each reach and add it to the network attribute table
+    flowlines['Slope'] = np.abs(elev1-elev2)/length
+
+    return flowlines
 
-    # iterate through each network segment, calculate slope and add to list
-    for i in flowlines.index:
-        # obtain the coordinates of the end points of each line segment
-        seg_geom = flowlines.loc[i].geometry
-        length = seg_geom.length
 
-        x_coord1 = seg_geom.coords.xy[0][0]
-        y_coord1 = seg_geom.coords.xy[1][0]
-        x_coord2 = seg_geom.coords.xy[0][-1]
-        y_coord2 = seg_geom.coords.xy[1][-1]
+def calc_profile_slope(flowlines: gpd.GeoDataFrame, dem: str, spacing: float = None, block_cache_mb: float = 256.,
+                       workers: int = None):
+    """
+    Adds the fields 'Slope', 'Elev_Min', 'Elev_Max' and 'Elev_Mean' to a drainage network in memory from elevations
+    sampled along each segment: stations are placed every spacing along every segment (including both end points) and
+    the dem is bilinearly interpolated at all of them in one batched pass. The slope is the magnitude of the
+    least-squares fit of elevation against distance along the segment, which is less sensitive to a single noisy cell
+    than the end point difference
+    :param flowlines: a segmented drainage network GeoDataFrame in the dem projection
+    :param dem: path to a dem
+    :param spacing: the distance between stations (defaults to the dem cell size)
+    :param block_cache_mb: the maximum size in MB of the dem window held in memory at once
+    :param workers: the number of worker processes to sample the dem with (serial if None or 1)
+    :return: the network with the new fields
+    """
 
-        # create points at the line end points
-        pt1 = Point(x_coord1, y_coord1)
-        pt2 = Point(x_coord2, y_coord2)
+    if spacing is None:
+        with rasterio.open(dem) as src:
+            spacing = min(src.res)
+    if spacing <= 0:
+        raise Exception('Station spacing must be greater than 0')
 
-        # buffer the points to account for positional discrepancy between DEM and network
-        buf1 = pt1.buffer(search_dist)
-        buf2 = pt2.buffer(search_dist)
+    with phase('stations'):
+        xs, ys, dist, offsets = line_stations(flowlines.geometry, spacing)
+    with phase('sampling'):
+        elev = bilinear_sample(dem, xs, ys, block_cache_mb=block_cache_mb, workers=workers)
+    with phase('fitting'):
+        slope, elev_min, elev_max, elev_mean = profile_fit(dist, elev, offsets)
 
-        # obtain elevation values within the buffers
-        zs1 = zonal_stats(buf1, dem, stats='min')
-        zs2 = zonal_stats(buf2, dem, stats='min')
-        elev1 = zs1[0].get('min')
-        elev2 = zs2[0].get('min')
+    flowlines['Slope'] = np.abs(slope)
+    for field, values in zip(PROFILE_FIELDS, (elev_min, elev_max, elev_mean)):
+        flowlines[field] = values
 
-        # calculate the slope of each reach and append it to the list
-        slope_value = abs(elev1-elev2)/length
+    return flowlines
+
+
+def profile_fit(dist, elev, offsets):
+    """
+    Fits a line to the elevation profile of every segment at once, leaving out missing elevations
+    :param dist: array of station distances along their segment
+    :param elev: array of station elevations (NaN where missing)
+    :param offsets: array where offsets[i]:offsets[i+1] are the stations of segment i
+    :return: arrays of the least-squares slope (elevation change per unit distance; NaN with fewer than two stations)
+    and the minimum, maximum and mean elevation (NaN with no stations) of every segment
+    """
+
+    n = len(offsets) - 1
+    line = np.repeat(np.arange(n), np.diff(offsets))
+    valid = ~np.isnan(elev)
+    line, dist, elev = line[valid], dist[valid], elev[valid]
+
+    count = np.bincount(line, minlength=n)
+    has = count > 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # distances are centred on each segment's mean, so the sums don't lose precision on long segments
+        mean_dist = np.bincount(line, weights=dist, minlength=n) / count
+        centred = dist - mean_dist[line]
+        slope = np.bincount(line, weights=centred * elev, minlength=n) / np.bincount(line, weights=centred ** 2,
+                                                                                     minlength=n)
+        elev_mean = np.bincount(line, weights=elev, minlength=n) / count
+    slope[count < 2] = np.nan
+
+    # the valid stations of each segment are contiguous, so minima and maxima are reductions over runs
+    starts = np.searchsorted(line, np.flatnonzero(has))
+    elev_min = np.full(n, np.nan)
+    elev_max = np.full(n, np.nan)
+    if len(starts) > 0:
+        elev_min[has] = np.minimum.reduceat(elev, starts)
+        elev_max[has] = np.maximum.reduceat(elev, starts)
+
+    return slope, elev_min, elev_max, elev_mean
+
+
+def slope_fields(method: str = 'endpoints'):
+    """
+    :param method: 'endpoints' or 'profile'
+    :return: the fields the slope method adds
+    """
+
+    if method not in ('endpoints', 'profile'):
+        raise Exception(f'Unknown slope method: {method}')
+
+    return ['Slope'] + (list(PROFILE_FIELDS) if method == 'profile' else [])
+
+
+def update_slope(flowlines: gpd.GeoDataFrame, dem: str, search_dist: float, incremental: bool = False,
+                 samples: dict = None, block_cache_mb: float = 256., workers: int = None, method: str = 'endpoints',
+                 spacing: float = None):
+    """
+    Adds the field 'Slope' (and for the profile method, the elevation fields) to a drainage network in memory along
+    with a 'slope_hash' field identifying the geometry and inputs each value was calculated from. Parameters are as
+    for calc_slope and calc_profile_slope
+    :param incremental: if True, only segments whose hash changed since the last run are recomputed
+    :param method: 'endpoints' (see calc_slope) or 'profile' (see calc_profile_slope)
+    :return: boolean array of the recomputed segments
+    """
 
-        slope.append(slope_value)
+    columns = slope_fields(method)
+    if method == 'profile':
+        hashes = row_hashes(flowlines.geometry, raster_fingerprint(dem), method, spacing)
+        return recompute(flowlines, columns, 'slope_hash', hashes,
+                         lambda rows: calc_profile_slope(rows, dem, spacing, block_cache_mb, workers), incremental)
 
-    # add slope values to network attribute table
-    flowlines['Slope'] = slope
+    hashes = row_hashes(flowlines.geometry, raster_fingerprint(dem), search_dist)
 
-    flowlines.to_file(network)
+    return recompute(flowlines, columns, 'slope_hash', hashes,
+                     lambda rows: calc_slope(rows, dem, search_dist, samples if rows is flowlines else None,
+                                             block_cache_mb, workers), incremental)
 
 
 def main():
@@ -72,9 +195,23 @@ def main():
                                      'the datasets into', type=int)
     parser.add_argument('search_dist', help='A buffer distance from the network to search for elevation values (to'
                                             'account for positional error between the network and the dem.', type=float)
+    parser.add_argument('--block_cache', help='The maximum size in MB of the DEM window held in memory at once.',
+                        type=float, default=256.)
+    parser.add_argument('--incremental', help='Only recompute segments that changed since the last run.',
+                        action='store_true')
+    parser.add_argument('--workers', help='The number of worker processes to sample the DEM with.', type=int)
+    parser.add_argument('--method', help='endpoints: the difference of the minimum elevations around the end points; '
+                                         'profile: a least-squares fit to elevations sampled along each segment, '
+                                         'which also adds Elev_Min, Elev_Max and Elev_Mean.', type=str,
+                        choices=['endpoints', 'profile'], default='endpoints')
+    parser.add_argument('--spacing', help='profile: the distance between elevation samples along a segment '
+                                          '(defaults to the DEM cell size).', type=float)
+    add_arguments(parser)
     args = parser.parse_args()
 
-    add_slope(args.network, args.dem, args.epsg, args.search_dist)
+    with instrumented(args.trace, args.profile, args.log_level):
+        add_slope(args.network, args.dem, args.epsg, args.search_dist, args.block_cache, args.incremental,
+                  args.workers, args.method, args.spacing)
 
 
 if __name__ == '__main__':
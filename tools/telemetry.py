@@ -0,0 +1,247 @@
+import contextlib
+import json
+import logging
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+LOGGER_NAME = 'tools'
+PROFILERS = ('cprofile', 'pyinstrument')
+
+log = logging.getLogger(__name__)
+
+# phases and counters recorded since the last call to reset_metrics
+_phases = []
+_counters = {}
+_stack = []
+
+
+class Progress:
+    """
+    Reports progress through a known number of items at most once every interval seconds, with the rate and an
+    estimate of the time remaining, in place of a line per item
+    """
+
+    def __init__(self, total: int, label: str, interval: float = 5., logger: logging.Logger = log):
+        """
+
+        :param total: the number of items
+        :param label: a description of the items (e.g., 'reaches')
+        :param interval: the minimum number of seconds between reports
+        :param logger: the logger to report to
+        """
+
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.logger = logger
+        self.done = 0
+        self.start = time.perf_counter()
+        self.last = self.start
+
+    def update(self, n: int = 1):
+        """
+        Marks items as done, reporting if the interval has passed
+        :param n: the number of items done since the last update
+        :return:
+        """
+
+        self.set(self.done + n)
+
+    def set(self, done: int):
+        """
+        Sets the number of items done, reporting if the interval has passed
+        :param done: the total number of items done so far
+        :return:
+        """
+
+        self.done = done
+        now = time.perf_counter()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.report(now)
+
+    def report(self, now: float = None):
+        now = time.perf_counter() if now is None else now
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.
+        msg = f'{self.label}: {self.done} of {self.total}'
+        if self.total:
+            msg += f' ({100 * self.done / self.total:.0f}%)'
+        msg += f', {rate:.1f}/s'
+        if 0 < rate and self.done < self.total:
+            msg += f', ETA {format_seconds((self.total - self.done) / rate)}'
+        self.logger.info(msg)
+
+    def close(self):
+        """
+        Reports the final count and elapsed time and adds the count to the metrics
+        :return:
+        """
+
+        elapsed = time.perf_counter() - self.start
+        count(self.label, self.done)
+        self.logger.info(f'{self.label}: {self.done} of {self.total} in {format_seconds(elapsed)}')
+
+
+def format_seconds(seconds: float):
+    if seconds < 60:
+        return f'{seconds:.1f} s'
+    if seconds < 3600:
+        return f'{int(seconds // 60)} min {int(seconds % 60)} s'
+
+    return f'{int(seconds // 3600)} h {int(seconds % 3600 // 60)} min'
+
+
+@contextlib.contextmanager
+def phase(name: str, logger: logging.Logger = log):
+    """
+    Times a phase of a run (e.g., read, sampling, write), recording its wall and cpu time in the metrics. Phases may
+    be nested; a nested phase is recorded under 'outer/inner'
+    :param name: the phase name
+    :param logger: the logger to report the timing to (at debug level)
+    :return:
+    """
+
+    _stack.append(name)
+    path = '/'.join(_stack)
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start_wall
+        cpu = time.process_time() - start_cpu
+        _stack.pop()
+        _phases.append({'phase': path, 'wall_s': wall, 'cpu_s': cpu})
+        logger.debug(f'{path}: {wall:.2f} s wall, {cpu:.2f} s cpu')
+
+
+def count(name: str, n: int = 1):
+    """
+    Adds to a named counter in the metrics (e.g., the number of segments processed)
+    :param name: the counter name
+    :param n: the amount to add
+    :return:
+    """
+
+    _counters[name] = _counters.get(name, 0) + n
+
+
+def metrics():
+    """
+    :return: dict of the phases and counters recorded since the last reset, and the peak memory of the process
+    """
+
+    peak = None
+    if resource is not None:
+        # ru_maxrss is in kB on linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+
+    return {'phases': list(_phases), 'counters': dict(_counters), 'peak_rss_mb': peak}
+
+
+def reset_metrics():
+    _phases.clear()
+    _counters.clear()
+    _stack.clear()
+
+
+def configure_logging(level: str = 'INFO'):
+    """
+    Sends the tools' log messages to stderr without decoration, so they read like plain progress output
+    :param level: a logging level name
+    :return:
+    """
+
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(level.upper())
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+    logger.propagate = False
+
+
+def add_arguments(parser):
+    """
+    Adds the logging, trace and profiling options to a tool's argument parser
+    :param parser: an argparse parser
+    :return:
+    """
+
+    parser.add_argument('--log_level', help='The logging level (DEBUG also reports the time of each phase).',
+                        type=str, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO')
+    parser.add_argument('--trace', help='Path to write a JSON trace of phase timings and counters to.', type=str)
+    parser.add_argument('--profile', help='Profile the run, writing the profile beside the trace file.', type=str,
+                        choices=list(PROFILERS))
+
+
+@contextlib.contextmanager
+def instrumented(trace: str = None, profile: str = None, log_level: str = 'INFO', name: str = None):
+    """
+    Sets up logging for a run and optionally records a JSON trace of its phases and counters and profiles it. The
+    trace is written even if the run fails. The profile is written beside the trace with the extension .prof for
+    cProfile (readable with pstats or snakeviz) or .html for pyinstrument
+    :param trace: optional path to write the JSON trace to
+    :param profile: optional profiler to run, 'cprofile' or 'pyinstrument' (requires a trace path)
+    :param log_level: a logging level name
+    :param name: the name of the run recorded in the trace (defaults to the program name)
+    :return:
+    """
+
+    configure_logging(log_level)
+    if profile is not None:
+        if profile not in PROFILERS:
+            raise Exception(f'Unknown profiler: {profile}')
+        if trace is None:
+            raise Exception('A trace path is required to profile a run')
+
+    reset_metrics()
+    profiler = None
+    if profile == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif profile == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise Exception('pyinstrument is required for --profile pyinstrument (pip install pyinstrument)')
+        profiler = Profiler()
+        profiler.start()
+
+    start = time.time()
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    status = 'failed'
+    try:
+        yield
+        status = 'ok'
+    finally:
+        if profile == 'cprofile':
+            profiler.disable()
+            profiler.dump_stats(os.path.splitext(trace)[0] + '.prof')
+        elif profile == 'pyinstrument':
+            profiler.stop()
+            with open(os.path.splitext(trace)[0] + '.html', 'w') as f:
+                f.write(profiler.output_html())
+
+        if trace is not None:
+            record = {
+                'name': name or os.path.basename(sys.argv[0]),
+                'argv': sys.argv[1:],
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(start)),
+                'status': status,
+                'pid': os.getpid(),
+                'wall_s': time.perf_counter() - start_wall,
+                'cpu_s': time.process_time() - start_cpu
+            }
+            record.update(metrics())
+            with open(trace, 'w') as f:
+                json.dump(record, f, indent=2)
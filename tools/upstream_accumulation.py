@@ -0,0 +1,240 @@
+import argparse
+import logging
+import os
+import numpy as np
+import geopandas as gpd
+from tools.network_graph import NetworkGraph
+from tools.network_io import read_network, write_network
+from tools.telemetry import phase, count, add_arguments, instrumented
+
+log = logging.getLogger(__name__)
+
+UPSTREAM_FIELDS = ('Strahler', 'Shreve', 'US_Length')
+HOW = ('sum', 'max')
+
+
+def upstream_accumulation(network: str, sum_fields: list = None, max_fields: list = None, tolerance: float = 0.):
+    """
+
+    :param network: path to a drainage network layer with the topology fields from network_topology
+    :param sum_fields: optional fields to sum over every segment's upstream network (written as 'US_<field>')
+    :param max_fields: optional fields to take the maximum of over every segment's upstream network (written as
+    'USmax_<field>')
+    :param tolerance: the distance within which end points are the same node, as given to network_topology
+    :return:
+    """
+
+    with phase('read'):
+        dn = read_network(network)
+    columns = calc_upstream(dn, sum_fields, max_fields, tolerance)
+
+    # shapefile field names are cut to 10 characters
+    if os.path.splitext(network)[1].lower() == '.shp':
+        for field in columns:
+            if len(field) > 10:
+                log.warning(f'{field} is written to the shapefile as {field[:10]}')
+
+    with phase('write'):
+        write_network(dn, network, columns=columns)
+
+
+def calc_upstream(dn: gpd.GeoDataFrame, sum_fields: list = None, max_fields: list = None, tolerance: float = 0.):
+    """
+    Adds the fields 'Strahler', 'Shreve' and 'US_Length' (the length of the network upstream of the bottom of each
+    segment, including the segment itself) to a drainage network in memory, along with the sum or maximum of any
+    other fields over each segment's upstream network. Segments are joined where their end points meet, in the
+    direction network_topology found for each of them ('topo_flip'). In shapefiles, field names are cut to 10
+    characters, e.g. 'US_Drain_A' for the sum of 'Drain_Area' and 'USmax_Slop' for the maximum of 'Slope'
+    :param dn: a drainage network GeoDataFrame with a projected crs and the topology fields from network_topology
+    :param sum_fields: optional fields to sum upstream (written as 'US_<field>')
+    :param max_fields: optional fields to take the maximum of upstream (written as 'USmax_<field>')
+    :param tolerance: the distance within which end points are the same node, as given to network_topology
+    :return: the names of the fields added
+    """
+
+    if 'topo_flip' not in dn.columns:
+        raise Exception('The network has no topology fields; run network_topology first')
+    if dn.crs is not None and not dn.crs.is_projected:
+        raise Exception('Network does not have a projected coordinate system')
+
+    for field in (sum_fields or []) + (max_fields or []):
+        if field not in dn.columns:
+            raise Exception(f'The network has no field {field}')
+
+    values = upstream_values(NetworkGraph.from_network(dn, tolerance=tolerance),
+                             {field: dn[field].values for field in sum_fields or []},
+                             {field: dn[field].values for field in max_fields or []})
+    for field, vals in values.items():
+        dn[field] = vals
+
+    return list(values)
+
+
+def upstream_values(graph: NetworkGraph, sum_values: dict = None, max_values: dict = None):
+    """
+    The stream orders, upstream length and accumulated fields of calc_upstream, from the graph of a network
+    :param graph: a NetworkGraph of the network with segment lengths, in the directions found by network_topology
+    :param sum_values: optional dict of field name to array of values to sum upstream (returned as 'US_<field>')
+    :param max_values: optional dict of field name to array of values to take the maximum of upstream (returned as
+    'USmax_<field>')
+    :return: dict of field name to array of values, in the order 'Strahler', 'Shreve', 'US_Length', sums, maxima
+    """
+
+    with phase('ordering'):
+        ds = downstream_positions(graph)
+        levels = topological_levels(ds)
+    count('segments', len(ds))
+    log.info(f'{len(ds)} segments in {len(levels)} levels')
+
+    with phase('accumulation'):
+        out = {'Strahler': strahler(ds, levels),
+               'Shreve': accumulate(ds, (upstream_counts(ds) == 0).astype(np.int64), 'sum', levels),
+               'US_Length': accumulate(ds, graph.length, 'sum', levels)}
+        for how, values, prefix in (('sum', sum_values, 'US_'), ('max', max_values, 'USmax_')):
+            for field, vals in (values or {}).items():
+                out[prefix + field] = accumulate(ds, np.asarray(vals).astype(np.float64), how, levels)
+
+    return out
+
+
+def downstream_positions(graph: NetworkGraph):
+    """
+    Links each segment to the one that flows out of its downstream node
+    :param graph: a NetworkGraph of the network, in the directions found by network_topology
+    :return: array of the position of the segment downstream of each segment, or -1 where there is none
+    """
+
+    indptr, indices = graph.downstream_csr()
+    n_ds = np.diff(indptr)
+    ds = np.full(len(graph), -1, dtype=np.int64)
+    ds[n_ds > 0] = indices[indptr[:-1][n_ds > 0]]
+
+    # where the network splits, everything upstream is accumulated down the first branch only
+    split = np.flatnonzero(n_ds > 1)
+    if len(split) > 0:
+        log.warning(f'{len(split)} segments flow into more than one segment (e.g. {graph.ids[split[0]]}); only the '
+                    f'first is followed')
+
+    return ds
+
+
+def upstream_counts(ds):
+    """
+    :param ds: array of downstream positions (-1 where there is none)
+    :return: array of the number of segments flowing directly into each segment
+    """
+
+    return np.bincount(ds[ds >= 0], minlength=len(ds))
+
+
+def topological_levels(ds):
+    """
+    Orders a network from its sources down: every segment is in a later level than all of the segments upstream of it
+    :param ds: array of downstream positions (-1 where there is none)
+    :return: list of arrays of segment positions, starting with the segments with nothing upstream
+    """
+
+    remaining = upstream_counts(ds)
+    level = np.flatnonzero(remaining == 0)
+    levels = []
+    done = 0
+    while len(level) > 0:
+        levels.append(level)
+        done += len(level)
+        below = ds[level]
+        below = below[below >= 0]
+        np.subtract.at(remaining, below, 1)
+        below = np.unique(below)
+        level = below[remaining[below] == 0]
+
+    if done < len(ds):
+        stuck = np.flatnonzero(remaining > 0)[0]
+        raise Exception(f'The network has a loop through the segment at position {stuck}')
+
+    return levels
+
+
+def accumulate(ds, values, how: str = 'sum', levels: list = None):
+    """
+    Sums or takes the maximum of a value over every segment's upstream network, including the segment itself, in a
+    single pass from the sources down. Missing values are ignored
+    :param ds: array of downstream positions (-1 where there is none)
+    :param values: array of a value for every segment
+    :param how: 'sum' or 'max'
+    :param levels: the topological levels of the network (computed if not given)
+    :return: array of accumulated values (NaN for max where a segment and everything upstream of it is missing)
+    """
+
+    if how not in HOW:
+        raise Exception(f'Unknown accumulation: {how}')
+    levels = topological_levels(ds) if levels is None else levels
+
+    values = np.asarray(values)
+    acc = values.copy()
+    missing = None
+    if np.issubdtype(acc.dtype, np.floating):
+        missing = np.isnan(acc)
+        acc[missing] = 0. if how == 'sum' else -np.inf
+    ufunc = np.add if how == 'sum' else np.maximum
+
+    for level in levels:
+        level = level[ds[level] >= 0]
+        ufunc.at(acc, ds[level], acc[level])
+
+    if how == 'max' and missing is not None:
+        acc[np.isneginf(acc)] = np.nan
+
+    return acc
+
+
+def strahler(ds, levels: list = None):
+    """
+    The Strahler stream order of every segment: 1 at the sources, increasing by one below the confluence of two
+    segments of the same order
+    :param ds: array of downstream positions (-1 where there is none)
+    :param levels: the topological levels of the network (computed if not given)
+    :return: array of stream orders
+    """
+
+    levels = topological_levels(ds) if levels is None else levels
+    order = np.ones(len(ds), dtype=np.int64)
+
+    # the segments flowing into each segment, in compressed sparse row form
+    has_ds = ds >= 0
+    by_ds = np.flatnonzero(has_ds)[np.argsort(ds[has_ds], kind='stable')]
+    ptr = np.zeros(len(ds) + 1, dtype=np.int64)
+    np.cumsum(upstream_counts(ds), out=ptr[1:])
+
+    for level in levels[1:]:
+        starts = ptr[level]
+        n_us = ptr[level + 1] - starts
+        level, starts, n_us = level[n_us > 0], starts[n_us > 0], n_us[n_us > 0]
+        groups = np.zeros(len(level), dtype=np.int64)
+        np.cumsum(n_us[:-1], out=groups[1:])
+        us_orders = order[by_ds[np.repeat(starts - groups, n_us) + np.arange(n_us.sum())]]
+        top = np.maximum.reduceat(us_orders, groups)
+        n_top = np.add.reduceat(us_orders == np.repeat(top, n_us), groups)
+        order[level] = top + (n_top > 1)
+
+    return order
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('network', help='Path to a drainage network layer with the topology fields from '
+                                        'network_topology.', type=str)
+    parser.add_argument('--sum', help='Fields to sum over each segment\'s upstream network (written as US_<field>).',
+                        nargs='+', dest='sum_fields')
+    parser.add_argument('--max', help='Fields to take the maximum of over each segment\'s upstream network (written '
+                                      'as USmax_<field>).', nargs='+', dest='max_fields')
+    parser.add_argument('--tolerance', help='The distance within which segment end points are treated as meeting, as '
+                                            'given to network_topology.', type=float, default=0.)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrumented(args.trace, args.profile, args.log_level):
+        upstream_accumulation(args.network, args.sum_fields, args.max_fields, args.tolerance)
+
+
+if __name__ == '__main__':
+    main()
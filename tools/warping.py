@@ -0,0 +1,184 @@
+import logging
+import math
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager, ExitStack
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import from_bounds, Window
+from tools.conditioning_cache import cache_key, evict_lru
+from tools.telemetry import phase
+
+log = logging.getLogger(__name__)
+
+# the margin added around a network's bounding box, as a fraction of its larger side
+BOUNDS_MARGIN = 0.1
+
+
+def network_bounds(geoms, margin: float = BOUNDS_MARGIN):
+    """
+    The bounding box of a drainage network with a margin around it, so that the catchments of its headwater reaches
+    are not cut off
+    :param geoms: a GeoSeries (or GeoDataFrame) of the network
+    :param margin: the margin as a fraction of the larger side of the bounding box
+    :return: (left, bottom, right, top)
+    """
+
+    left, bottom, right, top = geoms.total_bounds
+    pad = margin * max(right - left, top - bottom)
+
+    return left - pad, bottom - pad, right + pad, top + pad
+
+
+def grow_bounds(bounds, edges, extent, factor: float = 0.5):
+    """
+    Moves the given edges of a bounding box outwards, e.g. where catchments reach them
+    :param bounds: (left, bottom, right, top)
+    :param edges: (left, bottom, right, top) booleans of the edges to move
+    :param extent: the (left, bottom, right, top) the box can't grow beyond (e.g., the extent of the DEM)
+    :param factor: each edge moves by this fraction of the larger side of the box
+    :return: the new (left, bottom, right, top)
+    """
+
+    left, bottom, right, top = bounds
+    step = factor * max(right - left, top - bottom)
+    grown = (left - step, bottom - step, right + step, top + step)
+
+    return tuple(max(g, e) if i < 2 else min(g, e) if move else b
+                 for i, (b, g, e, move) in enumerate(zip(bounds, grown, extent, edges)))
+
+
+def open_edges(bounds, extent, cell_size: float):
+    """
+    :param bounds: the (left, bottom, right, top) of a subset of a raster
+    :param extent: the (left, bottom, right, top) of the whole raster
+    :param cell_size: the cell size of the subset
+    :return: (left, bottom, right, top) booleans, True for an edge of the subset inside the raster
+    """
+
+    return tuple(abs(b - e) > cell_size / 2 for b, e in zip(bounds, extent))
+
+
+def raster_extent(raster: str, crs):
+    """
+    :param raster: path to a raster
+    :param crs: a crs
+    :return: the (left, bottom, right, top) of the raster reprojected (at its default resolution) to the crs
+    """
+
+    with rasterio.open(raster) as src:
+        if src.crs == crs:
+            return tuple(src.bounds)
+        with WarpedVRT(src, crs=crs) as vrt:
+            return tuple(vrt.bounds)
+
+
+def subset_window(transform, height: int, width: int, bounds):
+    """
+    :param transform: the affine transform of a raster
+    :param height: raster rows
+    :param width: raster columns
+    :param bounds: (left, bottom, right, top)
+    :return: a Window of the cells touching the bounds, or None if there are none
+    """
+
+    window = from_bounds(*bounds, transform=transform)
+    row0, col0 = max(math.floor(window.row_off), 0), max(math.floor(window.col_off), 0)
+    row1 = min(math.ceil(window.row_off + window.height), height)
+    col1 = min(math.ceil(window.col_off + window.width), width)
+    if row1 <= row0 or col1 <= col0:
+        return None
+
+    return Window(col0, row0, col1 - col0, row1 - row0)
+
+
+@contextmanager
+def raster_subset(raster: str, dst_crs, bounds, cache_dir: str = None, cache_size: float = 20., tmp_dir: str = None,
+                  resampling=Resampling.cubic):
+    """
+    Clips a raster to the cells covering a bounding box, reprojecting it through a WarpedVRT if it is in another crs,
+    so only that part of the source is read and resampled. Reprojected cells are those of a reprojection of the whole
+    raster (at its default resolution) that fall within the bounds. If a cache directory is given, the subset is kept
+    there under a key built from the fingerprint of the raster (the names, sizes and modification times of its files,
+    including the sources of a VRT, so the raster is never read to build it), the crs, the bounds and the resampling
+    method, and later calls with the same inputs reuse it; otherwise it is written to a temporary file that is removed
+    on exit. A raster in the crs that lies entirely within the bounds is used as it is
+    :param raster: path to the raster
+    :param dst_crs: the crs of the subset
+    :param bounds: (left, bottom, right, top) in dst_crs
+    :param cache_dir: an optional cache directory (shared with the flow grid cache and its size limit)
+    :param cache_size: the maximum size of the cache in GB
+    :param tmp_dir: where to write the temporary file if there is no cache directory
+    :param resampling: the rasterio resampling method for reprojection
+    :return: a context manager giving the path to a GeoTIFF of the subset
+    """
+
+    with rasterio.open(raster) as src:
+        window = subset_window(src.transform, src.height, src.width, bounds) if src.crs == dst_crs else None
+        whole = window is not None and (window.height, window.width) == (src.height, src.width)
+    if whole:
+        yield raster
+        return
+
+    if cache_dir:
+        key = cache_key(raster, crs=str(dst_crs), bounds=[float(b) for b in bounds],
+                        resampling=resampling.name)
+        entry = os.path.join(cache_dir, key)
+        out = os.path.join(entry, 'subset.tif')
+        if os.path.exists(out):
+            log.info(f'using cached subset of {os.path.basename(raster)}')
+            os.utime(entry, None)
+        else:
+            tmp = entry + '.tmp'
+            shutil.rmtree(tmp, ignore_errors=True)
+            os.makedirs(tmp)
+            write_subset(raster, dst_crs, bounds, os.path.join(tmp, 'subset.tif'), resampling)
+            shutil.rmtree(entry, ignore_errors=True)
+            os.rename(tmp, entry)
+            evict_lru(cache_dir, int(cache_size * 1024**3))
+        yield out
+    else:
+        if tmp_dir:
+            os.makedirs(tmp_dir, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix='subset_', dir=tmp_dir)
+        try:
+            out = os.path.join(tmp, 'subset.tif')
+            write_subset(raster, dst_crs, bounds, out, resampling)
+            yield out
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+def write_subset(raster: str, dst_crs, bounds, out_raster: str, resampling=Resampling.cubic, block_rows: int = 1024):
+    """
+    Writes the part of a raster covering a bounding box, reprojected if needed, to a tiled GeoTIFF
+    :param raster: path to the raster
+    :param dst_crs: the crs of the subset
+    :param bounds: (left, bottom, right, top) in dst_crs
+    :param out_raster: path to the output GeoTIFF
+    :param resampling: the rasterio resampling method for reprojection
+    :param block_rows: the number of rows written at a time
+    :return:
+    """
+
+    with phase('clipping'), ExitStack() as stack:
+        src = stack.enter_context(rasterio.open(raster))
+        warp = src.crs != dst_crs
+        if warp:
+            src = stack.enter_context(WarpedVRT(src, crs=dst_crs, resampling=resampling))
+        window = subset_window(src.transform, src.height, src.width, bounds)
+        if window is None:
+            raise Exception(f'{os.path.basename(raster)} does not cover the drainage network')
+        height, width = int(window.height), int(window.width)
+        log.info(f'{"reprojecting" if warp else "clipping"} {height} x {width} cells of '
+                 f'{os.path.basename(raster)}')
+
+        profile = src.profile.copy()
+        profile.update(driver='GTiff', height=height, width=width,
+                       transform=src.window_transform(window), tiled=True, blockxsize=256, blockysize=256)
+        with rasterio.open(out_raster, 'w', **profile) as dst:
+            for row in range(0, height, block_rows):
+                block = Window(window.col_off, window.row_off + row, width, min(block_rows, height - row))
+                dst.write(src.read(window=block), window=Window(0, row, width, block.height))
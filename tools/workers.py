@@ -0,0 +1,15 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+def process_pool(workers: int):
+    """
+    A pool of worker processes for the tools' parallel stages. Workers are spawned rather than forked: the tools use
+    numba (through pysheds), and forking a process after numba has started its threading layer can deadlock the child.
+    Spawned workers import the tools afresh, so work submitted to the pool must be module-level functions whose
+    arguments pickle cheaply (e.g., paths rather than arrays)
+    :param workers: the number of worker processes
+    :return: a ProcessPoolExecutor, to be used as a context manager
+    """
+
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))